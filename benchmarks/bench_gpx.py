@@ -0,0 +1,284 @@
+''' Benchmarks cadence and GPX generation on the bundled sort_gpx rides
+
+Usage (from the root of this repository):
+    python -m benchmarks.bench_gpx --output bench.json
+    python -m benchmarks.bench_gpx --fixtures long.gpx --sizes 100000 --repeat 5
+
+Every (input, function) pair is timed in the current process (best of --repeat)
+and then measured once more in a freshly spawned process for peak memory, so
+that memory already held by earlier measurements can't hide the next one's. Peak RSS growth
+relies on resetting the high-water mark through /proc, so it is Linux only.
+'''
+import argparse
+from datetime import datetime
+import json
+import multiprocessing
+import os
+import platform
+from queue import Empty
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from lxml import etree
+import numpy as np
+
+from flaskr.activities import StreamSet
+from flaskr.cadence import generate_cadence_array, generate_cadence_data, latlng_distances
+from flaskr.gpx import create_gpx
+from flaskr.gpx_reader import read_gpx
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'clean', 'app', 'test-files', 'sort_gpx')
+FIXTURES = ['20_mi_full_5.gpx', 'today.gpx', 'tdf.gpx', 'dune.gpx', 'long.gpx']
+SYNTHETIC_SIZES = [100000, 500000]
+DATETIME_FMT = '%Y-%m-%dT%H:%M:%SZ'
+CHAINRING, COG = 48, 16
+ACTIVITY = {'start_date': '2021-09-14T10:28:25Z', 'name': 'benchmark ride'}
+
+
+def load_fixture(path: str) -> dict:
+    ''' Converts a GPX file into the JSON stream object returned by Strava
+
+    Args:
+        path:
+            the path to the GPX file
+    Returns:
+        A Strava stream object keyed by stream type
+    '''
+    streams, _ = read_gpx(path)
+    raw = {key: {**streams[key], 'data': streams[key]['data'].tolist(), 'series_type': 'distance'}
+           for key in streams}
+    raw['distance'] = {**raw['time'], 'data': latlng_distances(streams['latlng']['data']).round(1).tolist()}
+    return raw
+
+
+def scale_up(streams: dict, size: int) -> dict:
+    ''' Repeats a stream object end to end until it has size points
+
+    Args:
+        streams:
+            a Strava stream object keyed by stream type
+        size:
+            the number of points in the scaled up stream object
+    Returns:
+        A Strava stream object with size points, continuing time and distance
+    '''
+    original_size = streams['latlng']['original_size']
+    repeats = -(-size // original_size)
+    scaled = {}
+    for key, stream in streams.items():
+        data = np.asarray(stream['data'])
+        tiled = np.concatenate([data] * repeats)[:size]
+        if key in ('time', 'distance'):
+            step = data[-1] + (data[-1] - data[-2])
+            tiled = tiled + np.repeat(np.arange(repeats) * step,
+                                      original_size)[:size].astype(tiled.dtype)
+        scaled[key] = {**stream, 'data': tiled.tolist(), 'original_size': size}
+    return scaled
+
+
+def load_inputs(fixtures: list, sizes: list) -> dict:
+    ''' Loads the requested fixtures and synthetic scale-ups of the largest one
+
+    Returns:
+        Stream objects keyed by input name
+    '''
+    inputs = {name: load_fixture(os.path.join(FIXTURE_DIR, name))
+              for name in fixtures}
+    if sizes:
+        largest = max(inputs.values(), key=lambda s: s['latlng']['original_size'])
+        for size in sizes:
+            inputs[f'synthetic_{size}'] = scale_up(largest, size)
+    return inputs
+
+
+def bench_cadence_data(streams: StreamSet, raw: dict, workdir: str) -> None:
+    # the scalar path gets the JSON lists it was written for
+    generate_cadence_data(raw['distance']['data'], CHAINRING, COG)
+
+
+def bench_cadence_array(streams: StreamSet, raw: dict, workdir: str) -> None:
+    generate_cadence_array(streams['distance']['data'], CHAINRING, COG,
+                           times=streams['time']['data'])
+
+
+def bench_create_gpx(streams: StreamSet, raw: dict, workdir: str) -> None:
+    if not create_gpx(streams, ACTIVITY, os.path.join(workdir, 'bench'), 'gpx'):
+        raise RuntimeError('create_gpx failed')
+
+
+def bench_create_gpx_compact(streams: StreamSet, raw: dict, workdir: str) -> None:
+    if not create_gpx(streams, ACTIVITY, os.path.join(workdir, 'bench'), 'gpx',
+                      coordinate_precision=7, elevation_precision=1, pretty_print=False):
+        raise RuntimeError('create_gpx failed')
+
+
+BENCHMARKS = {
+    'generate_cadence_data': bench_cadence_data,
+    'generate_cadence_array': bench_cadence_array,
+    'create_gpx': bench_create_gpx,
+    'create_gpx_compact': bench_create_gpx_compact
+}
+
+
+def prepare(streams: dict) -> StreamSet:
+    ''' Builds the StreamSet used in production, with a cadence stream to serialize '''
+    streams = StreamSet.from_json(json.loads(json.dumps(streams)))
+    streams['cadence'] = {**streams['distance'], 'data': generate_cadence_array(
+        streams['distance']['data'], CHAINRING, COG)}
+    return streams
+
+
+def rss_kb(field: str) -> int:
+    ''' Reads a memory field (VmRSS or VmHWM) of this process from /proc '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure_memory(name: str, raw: dict, queue) -> None:
+    ''' Runs a benchmark once under tracemalloc (in a spawned child process) '''
+    streams = prepare(raw)
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            # resets the peak RSS high-water mark to the current RSS
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+        rss_before = rss_kb('VmRSS')
+        tracemalloc.start()
+        BENCHMARKS[name](streams, raw, workdir)
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss_peak = rss_kb('VmHWM')
+    queue.put({
+        'peak_traced_bytes': peak,
+        'live_allocations': sum(stat.count for stat in snapshot.statistics('filename')),
+        'peak_rss_growth_kb': rss_peak - rss_before if rss_peak and rss_before else None
+    })
+
+
+def collect(queue, process, poll: float = 1.0) -> dict:
+    ''' Waits for the result of a measure_memory child process
+
+    Args:
+        queue:
+            the queue the child puts its result on
+        process:
+            the child process
+        poll:
+            how often (in seconds) to check that the child is still alive
+    Returns:
+        The result object put on the queue
+    Raises:
+        RuntimeError: the child exited without putting a result on the queue
+    '''
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            if process.exitcode is not None:
+                break
+    # the child may have put its result just before exiting
+    try:
+        return queue.get(timeout=poll)
+    except Empty:
+        raise RuntimeError(f'memory measurement exited with code {process.exitcode} '
+                           'without a result')
+
+
+def run(inputs: dict, names: list, repeat: int) -> list:
+    ''' Times and measures every benchmark against every input
+
+    Returns:
+        A list of result objects
+    '''
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for input_name, raw in inputs.items():
+        streams = prepare(raw)
+        points = streams['latlng']['original_size']
+        for name in names:
+            timings = []
+            with tempfile.TemporaryDirectory() as workdir:
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    BENCHMARKS[name](streams, raw, workdir)
+                    timings.append(time.perf_counter() - start)
+                output = os.path.join(workdir, 'bench.gpx')
+                output_bytes = os.path.getsize(output) if os.path.exists(output) else None
+            queue = context.Queue()
+            process = context.Process(target=measure_memory,
+                                      args=(name, raw, queue))
+            process.start()
+            try:
+                memory = collect(queue, process)
+            finally:
+                process.join()
+            result = {
+                'input': input_name,
+                'benchmark': name,
+                'points': points,
+                'best_seconds': min(timings),
+                'mean_seconds': sum(timings) / len(timings),
+                'points_per_second': points / min(timings) if min(timings) else None,
+                'output_bytes': output_bytes,
+                **memory
+            }
+            results.append(result)
+            print(f"{input_name:>20} {name:>24} {points:>8} pts "
+                  f"{result['best_seconds'] * 1000:>10.1f} ms "
+                  f"{result['points_per_second'] or 0:>12.0f} pts/s "
+                  f"{memory['peak_traced_bytes'] / 1e6:>8.1f} MB traced "
+                  f"{(memory['peak_rss_growth_kb'] or 0) / 1e3:>8.1f} MB rss", flush=True)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--fixtures', nargs='*', default=FIXTURES,
+                        help='sort_gpx fixtures to benchmark')
+    parser.add_argument('--sizes', nargs='*', type=int, default=SYNTHETIC_SIZES,
+                        help='synthetic scale-up sizes (in points)')
+    parser.add_argument('--benchmarks', nargs='*', default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='where to save the JSON results')
+    args = parser.parse_args(argv)
+
+    results = run(load_inputs(args.fixtures, args.sizes),
+                  args.benchmarks, args.repeat)
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.utcnow().strftime(DATETIME_FMT),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'lxml': '.'.join(map(str, etree.LXML_VERSION)),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'saved results to {args.output}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,11 +1,12 @@
 import logging
 import os
+import tempfile
 
 from flask import Flask
 from flask import render_template
 from flaskr.auth import auth_url
 # apply the blueprints to the app
-from flaskr import auth, subscriptions
+from flaskr import auth, batch, config, subscriptions
 
 
 def create_app(test_config=None) -> Flask:
@@ -49,6 +50,7 @@ def create_app(test_config=None) -> Flask:
 
     app.register_blueprint(auth.bp)
     app.register_blueprint(subscriptions.bp)
+    app.cli.add_command(batch.cadence_batch_command)
 
     # in another app, you might define a separate main index here with
     # app.route, while giving the blog blueprint a url_prefix, but for
@@ -57,3 +59,19 @@ def create_app(test_config=None) -> Flask:
 
     logging.info('starting app')
     return app
+
+
+def serve() -> Flask:
+    '''Create the app for a server process (e.g. waitress-serve --call "flaskr:serve").
+
+    Unlike create_app, which also runs for flask commands and tests, this
+    schedules the webhook jobs the last run journaled but didn't finish.'''
+    app = create_app()
+    temp_dir = os.path.realpath(tempfile.gettempdir())
+    if os.path.commonpath([os.path.realpath(config.STATE_DB), temp_dir]) == temp_dir:
+        # e.g. a Heroku dyno's filesystem, which every restart and deploy wipes
+        logging.error(f'the state database {config.STATE_DB} is in the temp directory - journaled jobs, '
+                      'seen activities and the rate limit budget are lost on restart. Set CC_STATE_DB '
+                      'to a file on persistent storage')
+    subscriptions.replay_jobs()
+    return app
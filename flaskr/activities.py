@@ -1,15 +1,146 @@
+import asyncio
+import io
 import logging
 import time
 
-import requests
+import numpy as np
 
 from flaskr import config
 from flaskr.auth import verify_strava_creds
-from flaskr.db import get_strava_credential
+from flaskr.cache import ArtifactStore, streams_digest
+from flaskr.db import create_db_conn, get_strava_credential
+from flaskr.fit import create_fit
 from flaskr.gpx import create_gpx
-from flaskr.cadence import generate_cadence_data
+from flaskr.strava import AsyncStravaClient, get_client
+from flaskr.cadence import generate_cadence_array, latlng_distances, smooth_cadence
 from flaskr.webdriver import delete_activity
 
+ACTIVITY_PARAMS = {'include_all_efforts': 'false'}
+# TODO might want to modify params to include other things
+STREAM_PARAMS = {
+    'keys': 'time,latlng,distance,altitude,heartrate,cadence,watts,temp,moving',
+    'key_by_type': 'true'
+}
+
+
+def _fill_gaps(data: np.ndarray) -> np.ndarray:
+    ''' Replaces missing (NaN) samples with the last sample before them - or the first
+        one after them, at the start of the stream
+
+    Args:
+        data:
+            a float channel (rows of latlng count as missing if either value is)
+    Returns:
+        The filled channel, or None if every sample is missing
+    '''
+    missing = np.isnan(data) if data.ndim == 1 else np.isnan(data).any(axis=1)
+    if not missing.any():
+        return data
+    present = np.flatnonzero(~missing)
+    if not present.size:
+        return None
+    index = np.maximum.accumulate(np.where(missing, 0, np.arange(len(data))))
+    index[:present[0]] = present[0]
+    return data[index]
+
+
+class StreamSet:
+    ''' A Strava StreamSet with each channel stored as a typed contiguous array
+    https://developers.strava.com/docs/reference/#api-models-StreamSet
+
+    Supports the keyed access of the JSON object returned by Strava (with
+    key_by_type), e.g. streams['latlng']['data'][ii][0], without keeping a boxed
+    Python object per sample alive. latlng is stored as an Nx2 block.
+
+    Properties:
+        DTYPES: dict
+            the array type used for each known channel
+    '''
+    DTYPES = {
+        'time': np.int32,
+        'latlng': np.float64,
+        'distance': np.float64,
+        'altitude': np.float64,
+        'velocity_smooth': np.float64,
+        'grade_smooth': np.float64,
+        'heartrate': np.int16,
+        'cadence': np.int32,
+        'watts': np.int16,
+        'temp': np.int8,
+        'moving': np.bool_
+    }
+
+    def __init__(self) -> None:
+        self._data = {}
+        self._meta = {}
+
+    @classmethod
+    def from_json(cls, obj: dict) -> 'StreamSet':
+        ''' Creates a StreamSet from the JSON object returned by the Strava streams endpoint
+
+        Args:
+            obj:
+                a StreamSet keyed by stream type (consumed, so each list can be
+                freed as soon as it is converted)
+        Returns:
+            A StreamSet holding the same streams
+        '''
+        streams = cls()
+        for key in list(obj):
+            streams[key] = obj.pop(key)
+        return streams
+
+    def __setitem__(self, key: str, stream: dict) -> None:
+        meta = {k: v for k, v in stream.items() if k != 'data'}
+        data = stream['data']
+        try:
+            data = np.asarray(data, dtype=self.DTYPES.get(key, np.float64))
+            if key == 'latlng':
+                data = data.reshape(-1, 2)
+            if data.dtype.kind == 'f':
+                # nulls become NaN, which would end up in the generated files
+                data = _fill_gaps(data)
+                if data is None:
+                    logging.warning(f'ignoring {key} stream, it has no values')
+                    return
+        except (TypeError, ValueError) as e:
+            # some channels contain nulls - keep those as the original list
+            logging.warning(f'keeping {key} stream as a list:')
+            logging.warning(e)
+        self._data[key] = data
+        self._meta[key] = meta
+
+    def __getitem__(self, key: str) -> dict:
+        return {**self._meta[key], 'data': self._data[key]}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def data(self, key: str):
+        ''' Gets the data of a single channel
+
+        Args:
+            key:
+                the stream type
+        Returns:
+            The channel's data array
+        '''
+        return self._data[key]
+
+    @property
+    def nbytes(self) -> int:
+        ''' The number of bytes used by the typed channel arrays '''
+        return sum(data.nbytes for data in self._data.values() if isinstance(data, np.ndarray))
+
 
 class Activity:
     ''' Represents a Strava activity object
@@ -22,10 +153,15 @@ class Activity:
             the size of the chainring used during this Activity
         cog: int
             the size of the cog used during this Activity
+        wheel_diameter: int
+            the wheel diameter in mm
+        tire_width: int
+            the tire width in mm
     '''
     # TODO - do we actually need athlete ID? should we store access token instead?
 
-    def __init__(self, activity_id: int, athlete_id: int, access_token: int, supabase) -> None:
+    def __init__(self, activity_id: int, athlete_id: int, access_token: int, supabase,
+                 obj: dict = None, streams: StreamSet = None) -> None:
         ''' Initializes an Activity object
 
         Args:
@@ -37,6 +173,11 @@ class Activity:
                 The current access_token for this athlete
             supabase:
                 a supabase Client object
+            obj:
+                the activity object, if it was already fetched (see fetch_activity)
+            streams:
+                the activity's streams, if they were already fetched - used by
+                the first get_streams call instead of fetching them again
         '''
 
         def set_gear_ratio(self: Activity) -> None:
@@ -71,22 +212,25 @@ class Activity:
         self.obj = {}
         self.chainring = None
         self.cog = None
+        self.wheel_diameter = 622
+        self.tire_width = 25
         self.access_token = access_token
         self.supabase = supabase
+        self._streams = streams
         try:
-            headers = {'Authorization': f'Bearer {access_token}'}
-            params = {'include_all_efforts': 'false'}
-            url = f'{config.API_ENDPOINT}/activities/{activity_id}'
-            response = requests.get(headers=headers, params=params, url=url)
-            if response.ok:
-                self.obj = response.json()
-            else:
-                logging.error('error creating Activity:')
-                if 'message' in response.text:
-                    logging.error(response.text['message'])
+            if obj is None:
+                response = get_client().get(f'/activities/{activity_id}', access_token, params=ACTIVITY_PARAMS)
+                if response.ok:
+                    self.obj = response.json()
                 else:
-                    logging.error(response.text)
-                raise Exception('This is an invalid activity')
+                    logging.error('error creating Activity:')
+                    if 'message' in response.text:
+                        logging.error(response.text['message'])
+                    else:
+                        logging.error(response.text)
+                    raise Exception('This is an invalid activity')
+            else:
+                self.obj = obj
             set_gear_ratio(self)
             # TODO - gear ratio might not be set -
             # need to handle this
@@ -94,31 +238,36 @@ class Activity:
             logging.error('error accessing activity:')
             logging.error(e)
 
-    def get_streams(self) -> dict:
+    def __getstate__(self) -> dict:
+        # pickled to generate files in the job pipeline's CPU processes - the
+        # supabase client can't be, and is reconnected when it's needed again
+        state = self.__dict__.copy()
+        state['supabase'] = None
+        return state
+
+    def get_streams(self) -> StreamSet:
         ''' Gets a stream object of this activity
 
         Returns:
-            An object whose keys are a subset of params['keys'].
+            A StreamSet whose keys are a subset of params['keys'].
             Values are objects with relevant data (keys that are specified
             in params['keys'] that don't have existing data are not returned)
         '''
+        if self._streams is not None:
+            # prefetched with the activity - only used once, so a retry fetches fresh streams
+            streams, self._streams = self._streams, None
+            return streams
         try:
             activity_id = self.obj['id']
-            headers = {'Authorization': f'Bearer {self.access_token}'}
-            # TODO might want to modify params to include other things
-            params = {
-                'keys': 'time,latlng,distance,altitude,heartrate,cadence,watts,temp,moving',
-                'key_by_type': 'true'
-            }
             # TODO
             # list of chr strings with any combination of "time", "latlng", "distance",
             # "altitude", "velocity_smooth", "heartrate", "cadence", "watts", "temp",
             # "moving", or "grade_smooth"
             # https://rdrr.io/github/fawda123/rStrava/man/get_streams.html
-            url = f'{config.API_ENDPOINT}/activities/{activity_id}/streams'
-            response = requests.get(headers=headers, params=params, url=url)
+            response = get_client().get(
+                f'/activities/{activity_id}/streams', self.access_token, params=STREAM_PARAMS)
             if response.ok:
-                return response.json()
+                return StreamSet.from_json(response.json())
             else:
                 logging.error('error getting activity stream:')
                 logging.error(response.text)
@@ -127,27 +276,62 @@ class Activity:
             logging.error(e)
         return None
 
-    def generate_stream(self) -> dict:
+    def fetch_streams(self, filetype: str) -> bool:
+        ''' Fetches this activity's streams ahead of create_file, so fetching and
+            generating the file can run as separate pipeline stages
+
+        Args:
+            filetype:
+                the file type the activity is uploaded as
+        Returns:
+            Whether or not the file can be created
+        '''
+        # fetched even when a previous attempt generated a file - the activity may
+        # have been edited since, and only its streams tell (see create_file)
+        self._streams = self.get_streams()
+        return self._streams is not None
+
+    def generate_stream(self, streams: StreamSet = None) -> StreamSet:
         ''' Create a stream with cadence data appended to the original stream
 
+            Args:
+                streams:
+                    the streams to add cadence to (fetched with get_streams by default)
             Returns:
-                A stream object of this Activity with the addition of a cadence stream
+                A StreamSet of this Activity with the addition of a cadence stream
         '''
         try:
-            streams = self.get_streams()
+            if streams is None:
+                streams = self.get_streams()
             if streams:
                 logging.info('Pulled streams from Strava')
                 if 'distance' in streams:
-                    streams['cadence'] = {
-                        'data': generate_cadence_data(streams['distance']['data'], self.chainring, self.cog),
-                        'series_type': 'time',
-                        'original_size': streams['distance']['original_size'],
-                        'resolution': streams['distance']['resolution']
-                    }
-                    return streams
+                    distances = streams['distance']['data']
+                    source_stream = streams['distance']
+                elif 'latlng' in streams:
+                    logging.info('existing stream lacks distance data - using latlng')
+                    distances = latlng_distances(streams['latlng']['data'])
+                    source_stream = streams['latlng']
                 else:
-                    logging.error('existing stream lacks distance data')
+                    logging.error('existing stream lacks distance and latlng data')
+                    return None
+                times = streams['time']['data'] if 'time' in streams else None
+                cadences = generate_cadence_array(
+                    distances, self.chainring, self.cog, self.wheel_diameter, self.tire_width, times=times)
+                if cadences is not None:
+                    cadences = smooth_cadence(cadences, config.CADENCE_SMOOTHING_WINDOW,
+                                              config.CADENCE_SPIKE_THRESHOLD, 0, config.CADENCE_MAX,
+                                              config.CADENCE_CUTOFF_PERCENTILE)
+                if cadences is None:
+                    logging.error('generate_stream: error generating cadence data')
                     return None
+                streams['cadence'] = {
+                    'data': cadences,
+                    'series_type': 'time',
+                    'original_size': source_stream['original_size'],
+                    'resolution': source_stream['resolution']
+                }
+                return streams
             else:
                 logging.error('generate_stream: error getting stream')
                 return None
@@ -227,6 +411,9 @@ class Activity:
             athlete_id = self.obj['athlete']['id']
             activity_id = self.obj['id']
             logging.info('beginning to delete activity')
+            if self.supabase is None:
+                # dropped when this activity was pickled (see __getstate__)
+                self.supabase = create_db_conn()
             email, password = get_strava_credential(self.supabase, athlete_id)
             if not(email and password):
                 logging.error('email or password was not set')
@@ -242,7 +429,7 @@ class Activity:
 
         return False
 
-    def upload_activity(self, data_type: str, external_id: str, file_path: str) -> int:
+    def upload_activity(self, data_type: str, external_id: str, file) -> int:
         ''' Uploads an Activity
 
         Args:
@@ -257,21 +444,21 @@ class Activity:
             commute:
                 TODO
             data_type:
-                the file type of the activity data [gpx, tar.gz, TODO ]
+                the file type of the activity data [gpx, gpx.gz, tar.gz, fit, fit.gz]
             external_id:
                 a string used to identify an uploaded Activity
-            file_path:
-                the path to the activity data file (relative to the root of this repository)
+            file:
+                a binary file object (e.g. io.BytesIO) holding the activity data, or the
+                path to the activity data file (relative to the root of this repository)
         Returns:
             The upload_id of the activity
         '''
         orig_name = self.obj['name']
-        name = orig_name[:-2].rstrip() if len(orig_name >= 2) and orig_name[-2:] == 'cc' else orig_name
+        name = orig_name[:-2].rstrip() if len(orig_name) >= 2 and orig_name[-2:] == 'cc' else orig_name
         description = f'{self.obj["description"]} - cadence by cadecalc.app'
         trainer = self.obj['trainer']
         commute = self.obj['commute']
         try:
-            headers = {'Authorization': f'Bearer {self.access_token}'}
             params = {
                 'name': name,
                 'description': description,
@@ -280,10 +467,6 @@ class Activity:
                 'data_type': data_type,
                 'external_id': external_id
             }
-            files = {
-                'file': open(file_path, 'rb')
-            }
-            url = f'{config.API_ENDPOINT}/uploads'
 
             # TODO review these comments:
             #     'activity_type': self.obj['type'],
@@ -294,8 +477,14 @@ class Activity:
             # # do we also want to be responsible for replacing images and other properties that
             # #  were lost across deleting?
             logging.info('about to post the new activity')
-            response = requests.post(
-                files=files, headers=headers, params=params, url=url)
+            if isinstance(file, str):
+                with open(file, 'rb') as f:
+                    files = {'file': (f'{external_id}.{data_type}', f)}
+                    response = get_client().post('/uploads', self.access_token, files=files, params=params)
+            else:
+                # streamed straight from memory into the multipart body
+                files = {'file': (f'{external_id}.{data_type}', file)}
+                response = get_client().post('/uploads', self.access_token, files=files, params=params)
             logging.info('posted the new activity')
             if response.ok:
                 logging.info('success posting the new activity')
@@ -321,9 +510,8 @@ class Activity:
         '''
         try:
             logging.info('waiting for new activity id to be created')
-            headers = {'Authorization': f'Bearer {self.access_token}'}
-            url = f'{config.API_ENDPOINT}/uploads/{upload_id}'
-            response = requests.get(headers=headers, url=url)
+            path = f'/uploads/{upload_id}'
+            response = get_client().get(path, self.access_token)
             counter = 0
             while response.json()['status'] == 'Your activity is still being processed.':
                 logging.info('activity still being processed')
@@ -332,7 +520,7 @@ class Activity:
                 logging.info('trying response again in 5 seconds')
                 logging.info(response)
                 logging.info(response.json())
-                response = requests.get(headers=headers, url=url)
+                response = get_client().get(path, self.access_token)
                 if counter == 4 and not response.ok:
                     logging.error('why is the upload taking so fucking long')
                     logging.error('giving up')
@@ -355,6 +543,94 @@ class Activity:
         # this is usually because the old activity hasn't been deleted yet
         return None
 
+    def artifact_job(self, filetype: str) -> str:
+        ''' Gets the ArtifactStore job key of the file replacing this activity
+
+        Args:
+            filetype:
+                the file type the activity is uploaded as
+        Returns:
+            A key covering everything the generated file depends on besides the streams
+        '''
+        return ArtifactStore.job_key(
+            activity_id=self.obj['id'], chainring=self.chainring, cog=self.cog,
+            wheel_diameter=self.wheel_diameter, tire_width=self.tire_width, filetype=filetype,
+            options=[config.GPX_COORDINATE_PRECISION, config.GPX_ELEVATION_PRECISION, config.GPX_PRETTY_PRINT,
+                     config.CADENCE_SMOOTHING_WINDOW, config.CADENCE_SPIKE_THRESHOLD, config.CADENCE_MAX,
+                     config.CADENCE_CUTOFF_PERCENTILE])
+
+    def create_file(self, filetype: str) -> bytes:
+        ''' Generates the file replacing this activity, reusing a cached one when a
+            previous attempt of this job already generated it from the same streams
+            (e.g. a retry after the delete failed) - an edited activity's streams
+            have a different digest, so its file is generated again
+
+        Args:
+            filetype:
+                the file type the activity is uploaded as
+        Returns:
+            The file's contents, or None if it couldn't be generated
+        '''
+        streams = self.get_streams()
+        if not streams:
+            logging.error('create_file: streams could not be fetched')
+            return None
+        store = ArtifactStore()
+        job = self.artifact_job(filetype)
+        digest = streams_digest(streams)
+        data = store.get(job, digest)
+        if data is not None:
+            logging.info('reusing cached activity file')
+            return data
+        stream = self.generate_stream(streams)
+        if not stream:
+            logging.error('create_file: stream could not be built')
+            return None
+        # built in memory - concurrent jobs never share a file on disk
+        buffer = io.BytesIO()
+        if filetype.startswith('fit'):
+            file_created = create_fit(stream, self.obj, buffer, filetype)
+        else:
+            file_created = create_gpx(stream, self.obj, buffer, filetype, config.GPX_COORDINATE_PRECISION,
+                                      config.GPX_ELEVATION_PRECISION, config.GPX_PRETTY_PRINT)
+        if not file_created:
+            return None
+        data = buffer.getvalue()
+        store.put(job, digest, data)
+        return data
+
+    def upload_file(self, filetype: str, data: bytes) -> int:
+        ''' Uploads a generated file and waits for Strava to process it
+
+        Args:
+            filetype:
+                the file type of data
+            data:
+                the file's contents (see create_file)
+        Returns:
+            The activity_id of the uploaded activity
+        '''
+        external_id = 'ex_id_1'
+        upload_id = self.upload_activity(filetype, external_id, io.BytesIO(data))
+        logging.info('uploaded id')
+        logging.info(upload_id)
+        logging.info('uploaded id')
+        if upload_id:
+            id = self.uploaded_activity_id(upload_id)
+            logging.info('the id is here')
+            logging.info(id)
+            logging.info('the id is here')
+            if id:
+                logging.info('successfully replaced activity')
+                return id
+            else:
+                logging.error('error getting uploaded activity id')
+                return None
+        else:
+            logging.error(
+                'replace_activity: error uploading activity')
+            return None
+
     def replace_activity(self) -> int:
         ''' Uploads a new activity to Strava with with the addition of cadence data.
             This function is only called when cadence data doesn't already exist
@@ -366,37 +642,12 @@ class Activity:
             # TODO might want tire width, and other props
             # probably want the start_date/start_date_local & timezone? -- use with stream
             # eventually, will want to check gear to see if this bike already has a recorded ratio?
-            filename = 'cadence_test'
-            filetype = 'gpx'
-            external_id = 'ex_id_1'
-            filepath = f'{filename}.{filetype}'
-            stream = self.generate_stream()
-            if not stream:
-                # TODO find a more descriptive exception
-                raise Exception('stream could not be built')
-            file_created = create_gpx(stream, self.obj, filename, filetype)
-            if file_created:
+            filetype = config.UPLOAD_FILETYPE
+            # a retry of a job that already generated its file skips fetching streams
+            data = self.create_file(filetype)
+            if data:
                 if self.delete_activity():
-                    upload_id = self.upload_activity(
-                        filetype, external_id, filepath)
-                    logging.info('uploaded id')
-                    logging.info(upload_id)
-                    logging.info('uploaded id')
-                    if upload_id:
-                        id = self.uploaded_activity_id(upload_id)
-                        logging.info('the id is here')
-                        logging.info(id)
-                        logging.info('the id is here')
-                        if id:
-                            logging.info('successfully replaced activity')
-                            return id
-                        else:
-                            logging.error('error getting uploaded activity id')
-                            return None
-                    else:
-                        logging.error(
-                            'replace_activity: error uploading activity')
-                        return None
+                    return self.upload_file(filetype, data)
                 else:
                     logging.error(
                         'replace_activity: error deleting old activity')
@@ -409,3 +660,51 @@ class Activity:
             logging.error(e)
         logging.info('returning none here1')
         return None
+
+
+async def fetch_activity(client: AsyncStravaClient, activity_id: int, athlete_id: int, access_token: str,
+                         supabase=None, streams: bool = True) -> Activity:
+    ''' Fetches an activity, and its streams at the same time
+
+    Args:
+        client:
+            the AsyncStravaClient to fetch with
+        activity_id:
+            the id of the activity
+        athlete_id:
+            the id of the athlete
+        access_token:
+            the current access_token for this athlete
+        supabase:
+            a supabase Client object
+        streams:
+            whether to fetch the streams alongside the activity - they are wasted
+            if the activity turns out not to need cadence data
+    Returns:
+        An Activity holding the prefetched streams (or fetching them later if
+        that request failed), or None if the activity couldn't be fetched
+    '''
+    try:
+        calls = [client.get(f'/activities/{activity_id}', access_token, params=ACTIVITY_PARAMS)]
+        if streams:
+            calls.append(client.get(f'/activities/{activity_id}/streams', access_token, params=STREAM_PARAMS))
+        responses = await asyncio.gather(*calls, return_exceptions=True)
+        response = responses[0]
+        if isinstance(response, Exception) or not response.is_success:
+            logging.error(f'error fetching activity {activity_id}:')
+            logging.error(response if isinstance(response, Exception) else response.text)
+            return None
+        stream_set = None
+        if streams:
+            stream_response = responses[1]
+            if not isinstance(stream_response, Exception) and stream_response.is_success:
+                stream_set = StreamSet.from_json(stream_response.json())
+            else:
+                logging.error(f'error prefetching activity {activity_id} streams:')
+                logging.error(stream_response if isinstance(stream_response, Exception) else stream_response.text)
+        return Activity(activity_id, athlete_id, access_token, supabase, obj=response.json(), streams=stream_set)
+    except Exception as e:
+        logging.error('error fetching activity:')
+        logging.error(e)
+    return None
+
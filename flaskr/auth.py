@@ -4,9 +4,9 @@ import time
 from flask import Blueprint
 from flask import render_template
 from flask import request
-import requests
 
 from flaskr import config, db, forms, webdriver
+from flaskr.strava import get_client
 from supabase import Client
 
 
@@ -48,14 +48,13 @@ def token_exchange(supabase: Client, code: str, scope: str) -> int:
         the athlete_id of the user exchanging tokens
     '''
     try:
-        url = 'https://www.strava.com/oauth/token'
         data = {
             'client_id': config.STRAVA_CLIENT_ID,
             'client_secret': config.STRAVA_CLIENT_SECRET,
             'code': code,
             'grant_type': 'authorization_code'
         }
-        response = requests.post(data=data, url=url)
+        response = get_client().post(f'{config.OAUTH_ENDPOINT}/token', data=data)
         if response.ok:
             obj = response.json()
             athlete_id = obj['athlete']['id']
@@ -106,8 +105,7 @@ def request_new_access_token(supabase: Client, athlete_id: int) -> str:
             'grant_type': 'refresh_token',
             'refresh_token': stored_refresh_token
         }
-        url = f'{config.API_ENDPOINT}/oauth/token'
-        response = requests.post(data=data, url=url)
+        response = get_client().post('/oauth/token', data=data)
         if response.ok:
             obj = response.json()
             access_token = obj['access_token']
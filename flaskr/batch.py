@@ -0,0 +1,122 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import logging
+import os
+import tempfile
+import time
+
+import click
+
+from flaskr.cadence import CadenceSmoother
+from flaskr.gpx import inject_cadence
+from flaskr import config
+
+OUTPUT_SUFFIX = '.cadence'
+
+
+def _umask() -> int:
+    ''' Gets the process's umask (it can only be read by setting it) '''
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def add_cadence_to_gpx(path: str, chainring: int, cog: int, wheel_diameter: int = 622, tire_width: int = 25) -> tuple:
+    ''' Writes a copy of a GPX file with generated cadence data next to the original
+
+    Args:
+        path:
+            the path to the GPX file
+        chainring:
+            the chainring size
+        cog:
+            the cog size
+        wheel_diameter:
+            the wheel diameter in mm
+        tire_width
+            the tire width in mm
+    Returns:
+        (path, output path or None, seconds taken)
+
+    The copy is written to a temporary file that only replaces the output once
+    it's complete, so a failure never leaves a truncated copy behind
+    '''
+    start = time.perf_counter()
+    output = None
+    temp = None
+    try:
+        smoother = CadenceSmoother(config.CADENCE_SMOOTHING_WINDOW, config.CADENCE_SPIKE_THRESHOLD, 0,
+                                   config.CADENCE_MAX, config.CADENCE_CUTOFF_PERCENTILE)
+        filename = f'{os.path.splitext(path)[0]}{OUTPUT_SUFFIX}.gpx'
+        # in the output's directory, so os.replace doesn't cross filesystems
+        fd, temp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(filename) or '.')
+        with os.fdopen(fd, 'wb') as f:
+            # everything but the added cadence is copied from the original as it is
+            inject_cadence(path, f, chainring, cog, wheel_diameter, tire_width, smoother)
+        # mkstemp makes the file private - give it the mode open() would have
+        os.chmod(temp, 0o666 & ~_umask())
+        os.replace(temp, filename)
+        output = filename
+    except Exception as e:
+        logging.error(f'error adding cadence to {path}:')
+        logging.error(e)
+        if temp is not None and os.path.exists(temp):
+            os.remove(temp)
+    return path, output, time.perf_counter() - start
+
+
+def find_gpx_files(patterns: tuple) -> list:
+    ''' Expands directories and glob patterns into GPX file paths
+
+    Args:
+        patterns:
+            directories, files or glob patterns
+    Returns:
+        The sorted GPX paths, excluding files this command has already written
+    '''
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.gpx')
+        paths.update(glob.glob(pattern, recursive=True))
+    return sorted(path for path in paths
+                  if os.path.isfile(path) and not path.endswith(f'{OUTPUT_SUFFIX}.gpx'))
+
+
+def parse_gear(ctx, param, value: str) -> tuple:
+    ''' Parses a gear ratio like 48x16 into (chainring, cog) '''
+    try:
+        chainring, cog = value.lower().split('x')
+        return int(chainring), int(cog)
+    except ValueError:
+        raise click.BadParameter('gear ratio must look like 48x16')
+
+
+@click.command('cadence-batch')
+@click.argument('patterns', nargs=-1, required=True)
+@click.option('--gear', required=True, callback=parse_gear, help='gear ratio, e.g. 48x16')
+@click.option('--wheel-diameter', default=622, show_default=True, help='wheel diameter in mm')
+@click.option('--tire-width', default=25, show_default=True, help='tire width in mm')
+@click.option('--workers', default=os.cpu_count(), show_default=True, help='number of worker processes')
+def cadence_batch_command(patterns, gear, wheel_diameter, tire_width, workers):
+    '''Add cadence data to local GPX files (directories or globs).'''
+    paths = find_gpx_files(patterns)
+    if not paths:
+        raise click.ClickException('no GPX files found')
+    chainring, cog = gear
+    click.echo(f'adding {chainring}x{cog} cadence to {len(paths)} file(s) with {workers} worker(s)')
+    start = time.perf_counter()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(add_cadence_to_gpx, path, chainring, cog, wheel_diameter, tire_width)
+                   for path in paths]
+        for future in as_completed(futures):
+            path, output, seconds = future.result()
+            if output:
+                click.echo(f'{seconds:8.2f}s  {path} -> {output}')
+            else:
+                failed += 1
+                click.echo(f'{seconds:8.2f}s  {path} FAILED', err=True)
+    click.echo(f'done in {time.perf_counter() - start:.2f}s ({failed} failed)')
+    if failed:
+        raise SystemExit(1)
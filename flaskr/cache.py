@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from flaskr import config
+
+
+def streams_digest(streams) -> str:
+    ''' Hashes the data of a stream object
+
+    Args:
+        streams:
+            a Strava stream object (or StreamSet)
+    Returns:
+        A hex digest that only changes when a channel's data changes
+    '''
+    digest = hashlib.sha256()
+    for key in sorted(streams):
+        data = streams[key]['data']
+        digest.update(key.encode())
+        if isinstance(data, np.ndarray):
+            digest.update(f'{data.dtype.str}{data.shape}'.encode())
+            digest.update(np.ascontiguousarray(data).tobytes())
+        else:
+            digest.update(json.dumps(data).encode())
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    ''' A local, content-addressed store of generated activity files
+
+    Artifacts are stored under a hash of the job that generated them (activity id,
+    gear, wheel and tire size, file format and options) and the digest of the
+    streams they were generated from, so a job only reuses a file generated from
+    the same streams. A ref keyed by the job alone points at the latest artifact,
+    for a job resumed after the original activity was deleted - its streams can't
+    be fetched any more. The least recently used artifacts are evicted once the store is larger
+    than max_bytes
+
+    Properties:
+        directory: str
+            where artifacts and refs are stored
+        max_bytes: int
+            the size cap of all stored artifacts
+    '''
+
+    def __init__(self, directory: str = None, max_bytes: int = None) -> None:
+        self.directory = directory or config.ARTIFACT_DIR
+        self.max_bytes = config.ARTIFACT_MAX_BYTES if max_bytes is None else max_bytes
+        self._artifacts = os.path.join(self.directory, 'artifacts')
+        self._refs = os.path.join(self.directory, 'refs')
+
+    @staticmethod
+    def job_key(**job) -> str:
+        ''' Hashes the fields of a job (e.g. activity_id, chainring, cog, wheel_diameter,
+        tire_width, filetype) into a key '''
+        return hashlib.sha256(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def artifact_key(job_key: str, digest: str) -> str:
+        ''' Gets the content address of a job's artifact for a given streams digest '''
+        return hashlib.sha256(f'{job_key}:{digest}'.encode()).hexdigest()
+
+    def _artifact_path(self, key: str) -> str:
+        return os.path.join(self._artifacts, key[:2], key)
+
+    def _write(self, path: str, data: bytes) -> None:
+        ''' Writes a file atomically, so concurrent readers never see a partial file '''
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, job_key: str, digest: str = None) -> bytes:
+        ''' Gets the artifact a job generated from a set of streams, or the job's latest artifact
+
+        Args:
+            job_key:
+                the key returned by job_key
+            digest:
+                the streams_digest of the streams the artifact has to be generated
+                from - without it the job's ref is followed, for when the streams
+                can't be fetched (e.g. after the original activity was deleted)
+        Returns:
+            The artifact, or None if there isn't one
+        '''
+        if self.max_bytes <= 0:
+            return None
+        try:
+            if digest is None:
+                with open(os.path.join(self._refs, job_key)) as f:
+                    path = self._artifact_path(f.read().strip())
+            else:
+                path = self._artifact_path(self.artifact_key(job_key, digest))
+            with open(path, 'rb') as f:
+                data = f.read()
+            # marks the artifact as recently used
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.error('error reading cached artifact:')
+            logging.error(e)
+        return None
+
+    def put(self, job_key: str, digest: str, data: bytes) -> str:
+        ''' Stores the artifact generated by a job and points the job's ref at it
+
+        Args:
+            job_key:
+                the key returned by job_key
+            digest:
+                the streams_digest of the streams the artifact was generated from
+            data:
+                the artifact
+        Returns:
+            The artifact's content address, or None if it wasn't stored
+        '''
+        if self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return None
+        try:
+            key = self.artifact_key(job_key, digest)
+            path = self._artifact_path(key)
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                self._write(path, data)
+            self._write(os.path.join(self._refs, job_key), key.encode())
+            self.evict()
+            return key
+        except Exception as e:
+            logging.error('error caching artifact:')
+            logging.error(e)
+        return None
+
+    def evict(self) -> int:
+        ''' Deletes the least recently used artifacts until the store fits in max_bytes
+
+        Returns:
+            The number of artifacts deleted
+        '''
+        artifacts = []
+        for root, _, files in os.walk(self._artifacts):
+            for name in files:
+                if name.startswith('.tmp'):
+                    # still being written
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                artifacts.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in artifacts)
+        deleted = 0
+        for _, size, path in sorted(artifacts):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        if deleted:
+            self._prune_refs()
+        return deleted
+
+    def _prune_refs(self) -> None:
+        ''' Deletes refs pointing at artifacts that no longer exist '''
+        try:
+            names = os.listdir(self._refs)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.startswith('.tmp'):
+                continue
+            path = os.path.join(self._refs, name)
+            try:
+                with open(path) as f:
+                    if not os.path.exists(self._artifact_path(f.read().strip())):
+                        os.unlink(path)
+            except (FileNotFoundError, IsADirectoryError):
+                pass
@@ -1,7 +1,11 @@
+from itertools import islice
 import logging
 # from collections import deque
 # from statistics import mean
 import math
+import warnings
+
+import numpy as np
 
 # from utils import applicableElements, distance
 # from tester import havList
@@ -69,10 +73,377 @@ def generate_cadence_data(distances: list, chainring: int, cog: int, wheel_diame
         logging.error(e)
     # TODO we might want to clean cadences to smooth over?
 
-# establishing a maxium cadence value
-# 	max_cutoff = distances[int(len(distances) * .96)] * 60 / (math.pi * (wheel_diameter + (2 * tire_width)) * (chainring / cog))
-# 	if (distances[int(len(distances) * .96)] > 25000):
-# 		exit("you got some SHIT GPS - fuck off")
+
+def wheel_roll_out(chainring: int, cog: int, wheel_diameter: int = 622, tire_width: int = 25) -> float:
+    ''' Computes the distance travelled for a single revolution of the cranks
+
+    Args:
+        chainring:
+            the chainring size
+        cog:
+            the cog size
+        wheel_diameter:
+            the wheel diameter in mm
+        tire_width
+            the tire width in mm
+    Returns:
+        The roll-out in meters per crank revolution
+    '''
+    return math.pi * (wheel_diameter + (2 * tire_width)) / 1000 * (chainring / cog)
+
+
+def generate_cadence_array(distances, chainring: int, cog: int, wheel_diameter: int = 622, tire_width: int = 25, times=None) -> np.ndarray:
+    ''' Generates cadence values for an entire distance stream in a single batched pass
+
+    Gives the same values as generate_cadence_data, but the roll-out is only
+    computed once and the differences and cadences are computed on arrays
+
+    Args:
+        distances:
+            distances measured from the origin (a list or array)
+        chainring:
+            the chainring size
+        cog:
+            the cog size
+        wheel_diameter:
+            the wheel diameter in mm
+        tire_width
+            the tire width in mm
+        times:
+            seconds since the start for each distance sample - when omitted,
+            samples are assumed to be 1 second apart
+
+    Returns:
+        The instantaneous cadence values in revolutions per minute as an int32 array
+    '''
+    try:
+        return CadenceStream(chainring, cog, wheel_diameter, tire_width).update(distances, times)
+    except Exception as e:
+        logging.error('error generating cadence array:')
+        logging.error(e)
+    return None
+
+
+EARTH_RADIUS = 6371008.8  # mean earth radius in meters (same as the haversine package)
+
+
+def latlng_distances(latlng, previous=None, offset: float = 0.0) -> np.ndarray:
+    ''' Computes a cumulative distance stream from GPS coordinates with a batched haversine
+
+    Args:
+        latlng:
+            (lat, lng) pairs in degrees (an Nx2 list or array)
+        previous:
+            the (lat, lng) pair preceding this batch, when processing a stream in chunks
+        offset:
+            the cumulative distance at previous
+
+    Returns:
+        Distances measured from the origin in meters (shaped like a Strava distance stream)
+    '''
+    coordinates = np.radians(np.asarray(latlng, dtype=np.float64).reshape(-1, 2))
+    if not len(coordinates):
+        return np.empty(0)
+    if previous is None:
+        start = coordinates[:1]
+    else:
+        start = np.radians(np.asarray(previous, dtype=np.float64).reshape(1, 2))
+    points = np.concatenate((start, coordinates))
+    lat, lng = points[:, 0], points[:, 1]
+    d = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * \
+        np.cos(lat[1:]) * np.sin(np.diff(lng) / 2) ** 2
+    steps = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(d, 1.0)))
+    return offset + np.cumsum(steps)
+
+
+class CadenceStream:
+    ''' Generates cadence values from consecutive chunks of a distance stream
+
+    Only the previous distance and time are kept between chunks, so arbitrarily
+    long activities can be processed in bounded memory
+
+    Properties:
+        roll_out: float
+            the distance travelled (in meters) per crank revolution
+        last_distance: float
+            the last distance seen in the previous chunk
+        last_time: float
+            the last time seen in the previous chunk (None until times are seen)
+    '''
+
+    def __init__(self, chainring: int, cog: int, wheel_diameter: int = 622, tire_width: int = 25) -> None:
+        self.roll_out = wheel_roll_out(
+            chainring, cog, wheel_diameter, tire_width)
+        self.last_distance = 0.0
+        self.last_time = None
+
+    def update(self, distances, times=None) -> np.ndarray:
+        ''' Generates cadence values for the next chunk of distances
+
+        Args:
+            distances:
+                the next distances measured from the origin (a list or array)
+            times:
+                seconds since the start for each of these distances - when omitted,
+                samples are assumed to be 1 second apart
+        Returns:
+            The cadence values for this chunk as an int32 array
+        '''
+        distances = np.asarray(distances, dtype=np.float64)
+        if not distances.size:
+            return np.empty(0, dtype=np.int32)
+        distance_travelled = np.diff(distances, prepend=self.last_distance)
+        self.last_distance = float(distances[-1])
+        if times is not None:
+            times = np.asarray(times, dtype=np.float64)
+            last_time = times[0] - 1 if self.last_time is None else self.last_time
+            elapsed = np.diff(times, prepend=last_time)
+            self.last_time = float(times[-1])
+            # paused or duplicated samples would otherwise divide by zero
+            elapsed[elapsed <= 0] = 1
+            distance_travelled /= elapsed
+        # same operation order as generate_cadence so truncation matches exactly
+        return (distance_travelled * 60 / self.roll_out).astype(np.int32)
+
+
+def generate_cadence_chunks(distances, chainring: int, cog: int, wheel_diameter: int = 622, tire_width: int = 25, chunk_size: int = 4096, times=None):
+    ''' Lazily generates cadence values from an iterable of distance samples
+
+    Args:
+        distances:
+            an iterable of distances measured from the origin (usually 1 second apart)
+        chainring:
+            the chainring size
+        cog:
+            the cog size
+        wheel_diameter:
+            the wheel diameter in mm
+        tire_width
+            the tire width in mm
+        chunk_size:
+            the number of samples consumed per yielded chunk
+        times:
+            an iterable of seconds since the start for each distance sample - when
+            omitted, samples are assumed to be 1 second apart
+
+    Yields:
+        int32 arrays of cadence values, at most chunk_size long
+    '''
+    stream = CadenceStream(chainring, cog, wheel_diameter, tire_width)
+    distances = iter(distances)
+    times = iter(times) if times is not None else None
+    while True:
+        chunk = np.fromiter(islice(distances, chunk_size),
+                            dtype=np.float64, count=-1)
+        if not chunk.size:
+            return
+        time_chunk = None
+        if times is not None:
+            time_chunk = np.fromiter(
+                islice(times, len(chunk)), dtype=np.float64, count=len(chunk))
+        yield stream.update(chunk, time_chunk)
+
+
+def _trailing_mean(values: np.ndarray, window: int, count: int, inclusive: bool = True) -> np.ndarray:
+    ''' Computes running-sum means over the trailing window of the last count positions
+
+    Args:
+        values:
+            the history followed by the values being averaged
+        window:
+            the maximum number of values in each mean
+        count:
+            the number of trailing positions to compute means for
+        inclusive:
+            whether the value at each position is part of its own window
+    Returns:
+        The trailing means (NaN where a position has no values to average)
+    '''
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    end = np.arange(len(values) - count, len(values)) + (1 if inclusive else 0)
+    start = np.maximum(end - window, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums[end] - sums[start]) / (end - start)
+
+
+def percentile_cutoff(values, percentile: float = 0.96) -> float:
+    ''' Selects the value at a percentile in linear time (without sorting)
+
+    Args:
+        values:
+            the values to select from (a list or array)
+        percentile:
+            the percentile as a fraction, e.g. 0.96
+    Returns:
+        The value at index int(len(values) * percentile) of the sorted values (None if empty)
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    if not values.size:
+        return None
+    k = min(int(len(values) * percentile), len(values) - 1)
+    return float(np.partition(values, k)[k])
+
+
+class CadenceQuantile:
+    ''' Tracks percentiles of a cadence stream in bounded memory
+
+    Cadence values are integers in a small range, so a histogram gives exact
+    percentiles (matching percentile_cutoff) while only storing one count per rpm
+
+    Properties:
+        bins: int
+            the number of histogram bins - values at or above bins - 1 share the last bin
+        count: int
+            the number of values seen so far
+    '''
+
+    def __init__(self, bins: int = 512) -> None:
+        self.bins = bins
+        self.count = 0
+        self._histogram = np.zeros(bins, dtype=np.int64)
+
+    def update(self, values) -> None:
+        ''' Adds the next chunk of cadence values
+
+        Args:
+            values:
+                the next cadence values (a list or array)
+        '''
+        values = np.clip(np.asarray(values), 0, self.bins - 1).astype(np.intp)
+        self._histogram += np.bincount(values, minlength=self.bins)
+        self.count += len(values)
+
+    def quantile(self, percentile: float) -> float:
+        ''' Gets the value at a percentile of every value seen so far
+
+        Args:
+            percentile:
+                the percentile as a fraction, e.g. 0.96
+        Returns:
+            The value at that percentile (None if nothing has been seen)
+        '''
+        if not self.count:
+            return None
+        k = min(int(self.count * percentile), self.count - 1)
+        return float(np.searchsorted(np.cumsum(self._histogram), k, side='right'))
+
+
+class CadenceSmoother:
+    ''' Clamps, rejects spikes from and smooths consecutive chunks of cadence values
+
+    Every chunk is processed with vectorized numpy operations, and only the last
+    window of values is kept between chunks
+
+    Properties:
+        window: int
+            the number of samples averaged for each smoothed value
+        spike_threshold: float
+            values further than this from the median of the previous window of
+            clamped values are replaced by that median (None disables spike rejection)
+        min_cadence: float
+            values below this are clamped to it (None disables the lower clamp)
+        max_cadence: float
+            values above this are clamped to it (None disables the upper clamp)
+        cutoff_percentile: float
+            values above this percentile of the values seen so far are clamped to it
+            (None disables the percentile cap)
+    '''
+
+    def __init__(self, window: int = 3, spike_threshold: float = None, min_cadence: float = 0, max_cadence: float = None, cutoff_percentile: float = None) -> None:
+        self.window = max(int(window), 1)
+        self.spike_threshold = spike_threshold
+        self.min_cadence = min_cadence
+        self.max_cadence = max_cadence
+        self.cutoff_percentile = cutoff_percentile
+        self._quantile = CadenceQuantile() if cutoff_percentile is not None else None
+        self._clamped = np.empty(0)
+        self._rejected = np.empty(0)
+
+    def update(self, cadences) -> np.ndarray:
+        ''' Smooths the next chunk of cadence values
+
+        Args:
+            cadences:
+                the next cadence values (a list or array)
+        Returns:
+            The smoothed cadence values for this chunk as an int32 array
+        '''
+        values = np.asarray(cadences, dtype=np.float64)
+        if not values.size:
+            return np.empty(0, dtype=np.int32)
+        if self.min_cadence is not None:
+            values = np.maximum(values, self.min_cadence)
+        if self.max_cadence is not None:
+            values = np.minimum(values, self.max_cadence)
+        if self._quantile is not None:
+            self._quantile.update(values)
+            values = np.minimum(
+                values, self._quantile.quantile(self.cutoff_percentile))
+
+        if self.spike_threshold is not None:
+            values = self._reject_spikes(values)
+
+        rejected = np.concatenate((self._rejected, values))
+        self._rejected = rejected[max(len(rejected) - self.window + 1, 0):]
+        smoothed = _trailing_mean(rejected, self.window, len(values))
+        return np.rint(smoothed).astype(np.int32)
+
+    def _reject_spikes(self, values: np.ndarray) -> np.ndarray:
+        # each value is compared to the median of the clamped input before it - a lone
+        # spike can't move the median of the values after it, and a real change in
+        # cadence takes over the median (and stops being rejected) within half a window
+        clamped = np.concatenate((np.full(self.window - len(self._clamped), np.nan), self._clamped, values))
+        self._clamped = clamped[-self.window:]
+        windows = np.lib.stride_tricks.sliding_window_view(clamped, self.window)[:len(values)]
+        with warnings.catch_warnings():
+            # the first value of a stream has nothing before it to compare to
+            warnings.simplefilter('ignore', RuntimeWarning)
+            reference = np.nanmedian(windows, axis=1)
+        with np.errstate(invalid='ignore'):
+            spikes = np.abs(values - reference) > self.spike_threshold
+        return np.where(spikes, reference, values)
+
+
+def smooth_cadence(cadences, window: int = 3, spike_threshold: float = None, min_cadence: float = 0, max_cadence: float = None, cutoff_percentile: float = None) -> np.ndarray:
+    ''' Clamps, rejects spikes from and smooths a full cadence stream
+
+    Args:
+        cadences:
+            the generated cadence values (a list or array)
+        window:
+            the number of samples averaged for each smoothed value
+        spike_threshold:
+            values further than this from the median of the previous window are replaced by that median
+        min_cadence:
+            the lowest allowed cadence value
+        max_cadence:
+            the highest allowed cadence value
+        cutoff_percentile:
+            values above this percentile of the stream are clamped to it, e.g. 0.96
+
+    Returns:
+        The smoothed cadence values as an int32 array
+    '''
+    try:
+        if cutoff_percentile is not None:
+            cadences = np.asarray(cadences, dtype=np.float64)
+            clamped = cadences
+            if min_cadence is not None:
+                clamped = np.maximum(clamped, min_cadence)
+            if max_cadence is not None:
+                clamped = np.minimum(clamped, max_cadence)
+            cutoff = percentile_cutoff(clamped, cutoff_percentile)
+            if cutoff is not None:
+                max_cadence = cutoff
+        smoother = CadenceSmoother(
+            window, spike_threshold, min_cadence, max_cadence)
+        return smoother.update(cadences)
+    except Exception as e:
+        logging.error('error smoothing cadence data:')
+        logging.error(e)
+    return None
+
+# establishing a maxium cadence value - see percentile_cutoff and CadenceQuantile
 
 # 	window = deque([0,0,0], maxlen=3)
 # 	delta = int(sys.argv[2]) # 100 # larger value, less smooth - min val is 0
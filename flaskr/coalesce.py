@@ -0,0 +1,98 @@
+import logging
+import threading
+
+from flaskr import config
+from flaskr.scheduler import DelayedScheduler, get_scheduler
+
+
+def merge_events(first: dict, later: dict) -> dict:
+    ''' Merges two webhook events about the same object into one
+
+    Args:
+        first:
+            the earlier event
+        later:
+            the later event
+    Returns:
+        An event with the later event's fields, the updates of both (later ones
+        win), and the aspect_type that matters most - a delete outweighs a
+        create, which outweighs an update
+    '''
+    merged = {**first, **later}
+    if 'updates' in first or 'updates' in later:
+        merged['updates'] = {**first.get('updates', {}), **later.get('updates', {})}
+    aspects = (first.get('aspect_type'), later.get('aspect_type'))
+    for aspect_type in ('delete', 'create'):
+        if aspect_type in aspects:
+            merged['aspect_type'] = aspect_type
+            break
+    return merged
+
+
+class EventCoalescer:
+    ''' Merges the events about the same object that arrive before its job starts
+
+    Strava often sends a create and several updates (title, type, privacy) for
+    an activity within seconds. Each (owner_id, object_id) has at most one
+    pending call - a later event is merged into it and pushes it back to the
+    later event's due time, but never more than window seconds past the first
+    event's due time
+
+    Properties:
+        function: callable
+            called with the merged event once it comes due
+        window: float
+            the most seconds merging may delay a job
+        on_merge: callable
+            called with the pending event and the event it was merged into, if set
+    '''
+
+    def __init__(self, function, window: float = None, scheduler: DelayedScheduler = None, on_merge=None) -> None:
+        self.function = function
+        self.on_merge = on_merge
+        self.window = config.EVENT_COALESCE_WINDOW if window is None else window
+        self._scheduler = scheduler
+        # (owner_id, object_id) -> [event, first due time, due time, scheduler entry]
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def scheduler(self) -> DelayedScheduler:
+        # not `or` - an empty scheduler is falsy
+        return get_scheduler() if self._scheduler is None else self._scheduler
+
+    def add(self, event: dict, due: float) -> bool:
+        ''' Schedules an event, or merges it into the pending event about the same object
+
+        Args:
+            event:
+                a webhook event https://developers.strava.com/docs/webhooks/
+            due:
+                when the event should be handled
+        Returns:
+            Whether or not the event was merged into a pending one
+        '''
+        key = (event['owner_id'], event['object_id'])
+        scheduler = self.scheduler
+        with self._lock:
+            pending = self._pending.get(key)
+            # a pending call the scheduler has already started can't take more events
+            if pending is not None and scheduler.cancel(pending[3]):
+                merged = merge_events(pending[0], event)
+                if self.on_merge:
+                    self.on_merge(pending[0], merged)
+                pending[0] = merged
+                pending[2] = min(max(pending[2], due), pending[1] + self.window)
+                pending[3] = scheduler.schedule(pending[2], self._fire, key, pending)
+                logging.info(f'merged event into pending {key} event')
+                return True
+            pending = [event, due, due, None]
+            pending[3] = scheduler.schedule(due, self._fire, key, pending)
+            self._pending[key] = pending
+            return False
+
+    def _fire(self, key: tuple, pending: list) -> None:
+        with self._lock:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+        self.function(pending[0])
@@ -1,10 +1,23 @@
 import os
+import tempfile
 # maybe add another .env file and move environemnt variables there
 
 STRAVA_CLIENT_ID = os.environ.get('CADENCE_CALCULATOR_CLIENT_ID')
 STRAVA_CLIENT_SECRET = os.environ.get('CADENCE_CALCULATOR_CLIENT_SECRET')
 VERIFY_TOKEN = os.environ.get('CADENCE_CALCULATOR_VERIFY_TOKEN')
 API_ENDPOINT = 'https://www.strava.com/api/v3'
+OAUTH_ENDPOINT = 'https://www.strava.com/oauth'
+# Strava API connection pooling and (connect, read) timeouts in seconds (see strava.StravaClient)
+STRAVA_POOL_SIZE = int(os.environ.get('CC_STRAVA_POOL_SIZE', 10))
+STRAVA_CONNECT_TIMEOUT = float(os.environ.get('CC_STRAVA_CONNECT_TIMEOUT', 5))
+STRAVA_READ_TIMEOUT = float(os.environ.get('CC_STRAVA_READ_TIMEOUT', 30))
+# Strava rate limits assumed until a response reports the real ones (see ratelimit.RateLimiter)
+STRAVA_SHORT_LIMIT = int(os.environ.get('CC_STRAVA_SHORT_LIMIT', 200))
+STRAVA_DAILY_LIMIT = int(os.environ.get('CC_STRAVA_DAILY_LIMIT', 2000))
+# share of each window background work may use - the rest is kept for webhook jobs
+STRAVA_BACKGROUND_SHARE = float(os.environ.get('CC_STRAVA_BACKGROUND_SHARE', 0.75))
+# longest a call waits for rate limit budget before giving up, in seconds
+STRAVA_RATE_LIMIT_MAX_WAIT = float(os.environ.get('CC_STRAVA_RATE_LIMIT_MAX_WAIT', 900))
 
 SERVER_DOMAIN = 'https://cadecalc.app'
 # SERVER_DOMAIN = 'https://cadencecalculator.herokuapp.com'
@@ -24,3 +37,51 @@ PERSONAL_STRAVA_PASSWORD = os.environ.get('STRAVA_ATHLETE_PASSWORD')
 
 GOOGLE_CHROME_BIN = os.environ.get('GOOGLE_CHROME_BIN')
 CHROMEDRIVER_PATH = os.environ.get('CHROMEDRIVER_PATH')
+
+# generated cadence post-processing (see cadence.smooth_cadence)
+CADENCE_SMOOTHING_WINDOW = int(os.environ.get('CC_CADENCE_SMOOTHING_WINDOW', 3))
+CADENCE_SPIKE_THRESHOLD = float(os.environ.get('CC_CADENCE_SPIKE_THRESHOLD', 40))
+CADENCE_MAX = float(os.environ.get('CC_CADENCE_MAX', 200))
+# e.g. 0.96 to cap cadence at the 96th percentile of each activity (unset disables the cap)
+CADENCE_CUTOFF_PERCENTILE = float(os.environ['CC_CADENCE_CUTOFF_PERCENTILE']) if os.environ.get(
+    'CC_CADENCE_CUTOFF_PERCENTILE') else None
+
+# file type replacement activities are uploaded as (gpx, gpx.gz, tar.gz, fit or fit.gz)
+UPLOAD_FILETYPE = os.environ.get('CC_UPLOAD_FILETYPE', 'gpx.gz')
+# GPX formatting for uploads - decimal places kept (7 is ~1 cm of latitude) and indentation
+GPX_COORDINATE_PRECISION = int(os.environ.get('CC_GPX_COORDINATE_PRECISION', 7))
+GPX_ELEVATION_PRECISION = int(os.environ.get('CC_GPX_ELEVATION_PRECISION', 1))
+GPX_PRETTY_PRINT = os.environ.get('CC_GPX_PRETTY_PRINT', '').lower() in ('1', 'true', 'yes')
+
+# generated upload files are cached so retried jobs can reuse them (see cache.ArtifactStore)
+ARTIFACT_DIR = os.environ.get('CC_ARTIFACT_DIR', os.path.join(tempfile.gettempdir(), 'cadence-calculator-artifacts'))
+# 0 disables the cache
+ARTIFACT_MAX_BYTES = int(os.environ.get('CC_ARTIFACT_MAX_BYTES', 256 * 1024 * 1024))
+
+# local SQLite database shared by the workers on this machine (see state.connect)
+STATE_DB = os.environ.get('CC_STATE_DB', os.path.join(tempfile.gettempdir(), 'cadence-calculator.sqlite3'))
+# seconds to wait for another worker's write lock
+STATE_DB_TIMEOUT = float(os.environ.get('CC_STATE_DB_TIMEOUT', 30))
+
+# webhook job pipeline (see pipeline.Pipeline) - workers per stage and the most jobs in flight at once
+PIPELINE_IO_WORKERS = int(os.environ.get('CC_PIPELINE_IO_WORKERS', 8))
+# file generation runs in processes - each is a separate interpreter with its own copy of the app's imports
+PIPELINE_CPU_WORKERS = int(os.environ.get('CC_PIPELINE_CPU_WORKERS', 1))
+# each browser worker runs its own Chrome
+PIPELINE_BROWSER_WORKERS = int(os.environ.get('CC_PIPELINE_BROWSER_WORKERS', 1))
+PIPELINE_MAX_JOBS = int(os.environ.get('CC_PIPELINE_MAX_JOBS', 32))
+# seconds after its event_time a webhook event is handled, so Strava is done updating the activity
+EVENT_SETTLE_DELAY = float(os.environ.get('CC_EVENT_SETTLE_DELAY', 30))
+# the most seconds later events about the same activity may push back its pending job (see coalesce.EventCoalescer)
+EVENT_COALESCE_WINDOW = float(os.environ.get('CC_EVENT_COALESCE_WINDOW', 60))
+# seconds before a settled event is offered to a full pipeline again
+EVENT_RETRY_DELAY = float(os.environ.get('CC_EVENT_RETRY_DELAY', 5))
+# the most events waiting to settle - subscribe answers 503 past this
+EVENT_MAX_PENDING = int(os.environ.get('CC_EVENT_MAX_PENDING', 10000))
+# how long (seconds) and how many activity ids are remembered as already handled (see dedupe.SeenSet)
+SEEN_TTL = float(os.environ.get('CC_SEEN_TTL', 7 * 24 * 60 * 60))
+SEEN_MAX_SIZE = int(os.environ.get('CC_SEEN_MAX_SIZE', 100000))
+# attempts a webhook job gets, and the seconds before its first retry (doubling up to the max) (see journal.JobJournal)
+JOURNAL_MAX_ATTEMPTS = int(os.environ.get('CC_JOURNAL_MAX_ATTEMPTS', 5))
+JOURNAL_BACKOFF = float(os.environ.get('CC_JOURNAL_BACKOFF', 30))
+JOURNAL_MAX_BACKOFF = float(os.environ.get('CC_JOURNAL_MAX_BACKOFF', 60 * 60))
@@ -0,0 +1,90 @@
+import logging
+import time
+
+from flaskr import config, state
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS seen (
+    id INTEGER PRIMARY KEY,
+    expires REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS seen_expires ON seen (expires);'''
+
+
+class SeenSet:
+    ''' A set of ids shared by every worker on this machine, whose members expire
+
+    Ids are kept in an indexed table of the local state database, so lookups
+    don't grow with the set and separate processes see each other's ids. Each
+    id expires ttl seconds after it was added, and once the set holds more than
+    max_size ids the ones closest to expiring are dropped
+
+    Properties:
+        path: str
+            the state database file
+        ttl: float
+            seconds an id stays in the set
+        max_size: int
+            the most ids kept
+    '''
+    # expired and excess ids are pruned every this many adds
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, path: str = None, ttl: float = None, max_size: int = None, clock=time.time) -> None:
+        self.path = path or config.STATE_DB
+        self.ttl = config.SEEN_TTL if ttl is None else ttl
+        self.max_size = max_size or config.SEEN_MAX_SIZE
+        self.clock = clock
+        self._adds = 0
+
+    def _connection(self):
+        return state.local_connection(self.path, SCHEMA)
+
+    def __contains__(self, id: int) -> bool:
+        row = self._connection().execute('SELECT expires FROM seen WHERE id = ?', (id,)).fetchone()
+        return row is not None and row[0] > self.clock()
+
+    def __len__(self) -> int:
+        ''' The number of ids that haven't expired '''
+        return self._connection().execute('SELECT COUNT(*) FROM seen WHERE expires > ?', (self.clock(),)).fetchone()[0]
+
+    def add(self, id: int) -> bool:
+        ''' Adds an id, or renews it if it's already in the set
+
+        Returns:
+            Whether or not the id was new (an expired id counts as new)
+        '''
+        conn = self._connection()
+        now = self.clock()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            new = id not in self
+            conn.execute('INSERT OR REPLACE INTO seen VALUES (?, ?)', (id, now + self.ttl))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self._adds += 1
+        if self._adds % self.PRUNE_INTERVAL == 0:
+            self.prune()
+        return new
+
+    def prune(self) -> int:
+        ''' Deletes expired ids, then the ids closest to expiring past max_size
+
+        Returns:
+            The number of ids deleted
+        '''
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            deleted = conn.execute('DELETE FROM seen WHERE expires <= ?', (self.clock(),)).rowcount
+            excess = conn.execute('SELECT COUNT(*) FROM seen').fetchone()[0] - self.max_size
+            if excess > 0:
+                deleted += conn.execute(
+                    'DELETE FROM seen WHERE id IN (SELECT id FROM seen ORDER BY expires LIMIT ?)', (excess,)).rowcount
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        if deleted:
+            logging.info(f'pruned {deleted} seen ids')
+        return deleted
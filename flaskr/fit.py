@@ -0,0 +1,268 @@
+from calendar import timegm
+from datetime import datetime
+import gzip
+import logging
+import struct
+
+import numpy as np
+
+from flaskr.cadence import latlng_distances
+
+# FIT date_time values count seconds from 1989-12-31T00:00:00Z
+FIT_EPOCH = 631065600
+DATETIME_FMT = '%Y-%m-%dT%H:%M:%SZ'
+PROTOCOL_VERSION = 0x10
+PROFILE_VERSION = 2100
+HEADER = struct.Struct('<BBHI4s')
+HEADER_CRC = struct.Struct('<H')
+# number of records converted from arrays to Python objects at a time
+CHUNK_SIZE = 4096
+SEMICIRCLES = 2 ** 31 / 180
+
+# base types (https://developer.garmin.com/fit/protocol/)
+ENUM, UINT8, UINT16, SINT32, UINT32, UINT32Z = 0x00, 0x02, 0x84, 0x85, 0x86, 0x8C
+FORMATS = {ENUM: 'B', UINT8: 'B', UINT16: 'H', SINT32: 'i', UINT32: 'I', UINT32Z: 'I'}
+INVALID = {ENUM: 0xFF, UINT8: 0xFF, UINT16: 0xFFFF, SINT32: 0x7FFFFFFF, UINT32: 0xFFFFFFFF, UINT32Z: 0}
+
+# profile values
+FILE_ACTIVITY = 4
+MANUFACTURER_DEVELOPMENT = 255
+SPORT_CYCLING = 2
+EVENT_TIMER, EVENT_SESSION, EVENT_LAP, EVENT_ACTIVITY = 0, 8, 9, 26
+EVENT_TYPE_START, EVENT_TYPE_STOP, EVENT_TYPE_STOP_ALL = 0, 1, 4
+TIMESTAMP = 253
+MESSAGE_INDEX = 254
+
+
+def _crc_table() -> list:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def crc16(data: bytes, crc: int = 0) -> int:
+    ''' Computes the FIT (CRC-16/ARC) checksum of data
+
+    Args:
+        data:
+            the bytes to check
+        crc:
+            the checksum of the bytes before data, to continue from
+    Returns:
+        The 16 bit checksum
+    '''
+    table = CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class Message:
+    ''' A FIT message type with its definition and precompiled data record layout
+
+    Properties:
+        local_type: int
+            the local message type data records refer to (0-15)
+        definition: bytes
+            the definition record, written once before the first data record
+        layout: struct.Struct
+            the data record layout - the record header followed by each field
+    '''
+
+    def __init__(self, local_type: int, global_number: int, fields: list) -> None:
+        ''' Args:
+            local_type:
+                the local message type (0-15)
+            global_number:
+                the FIT profile message number
+            fields:
+                (field number, base type) pairs, in the order values are packed
+        '''
+        self.local_type = local_type
+        self.definition = struct.pack('<BBBHB', 0x40 | local_type, 0, 0, global_number, len(fields)) + b''.join(
+            struct.pack('<BBB', number, struct.calcsize(FORMATS[base_type]), base_type)
+            for number, base_type in fields)
+        self.layout = struct.Struct('<B' + ''.join(FORMATS[base_type] for _, base_type in fields))
+
+    def pack(self, *values) -> bytes:
+        return self.layout.pack(self.local_type, *values)
+
+
+FILE_ID = Message(0, 0, [(0, ENUM), (1, UINT16), (2, UINT16), (3, UINT32Z), (4, UINT32)])
+EVENT = Message(1, 21, [(TIMESTAMP, UINT32), (0, ENUM), (1, ENUM)])
+LAP = Message(3, 19, [(TIMESTAMP, UINT32), (MESSAGE_INDEX, UINT16), (0, ENUM), (1, ENUM), (2, UINT32),
+                      (7, UINT32), (8, UINT32), (9, UINT32), (15, UINT8), (16, UINT8), (17, UINT8),
+                      (18, UINT8), (25, ENUM)])
+SESSION = Message(4, 18, [(TIMESTAMP, UINT32), (MESSAGE_INDEX, UINT16), (0, ENUM), (1, ENUM), (2, UINT32),
+                          (5, ENUM), (6, ENUM), (7, UINT32), (8, UINT32), (9, UINT32), (16, UINT8),
+                          (17, UINT8), (18, UINT8), (19, UINT8), (25, UINT16), (26, UINT16)])
+ACTIVITY = Message(5, 34, [(TIMESTAMP, UINT32), (0, UINT32), (1, UINT16), (2, ENUM), (3, ENUM), (4, ENUM)])
+# record fields (timestamp, position_lat, position_long, altitude, heart_rate, cadence, distance)
+# keyed by the stream they come from - only the streams present are defined
+RECORD_FIELDS = [
+    ('time', TIMESTAMP, UINT32),
+    ('lat', 0, SINT32),
+    ('lng', 1, SINT32),
+    ('altitude', 2, UINT16),
+    ('heartrate', 3, UINT8),
+    ('cadence', 4, UINT8),
+    ('distance', 5, UINT32)
+]
+
+
+def _summary(data) -> tuple:
+    ''' Gets the (average, maximum) of a heart rate or cadence stream as uint8 values
+
+    Zeros (coasting or dropouts) are left out of the average, like a head unit does
+    '''
+    if data is None:
+        return INVALID[UINT8], INVALID[UINT8]
+    data = np.asarray(data)
+    moving = data[data > 0]
+    if not moving.size:
+        return 0, 0
+    return min(int(round(moving.mean())), 254), min(int(moving.max()), 254)
+
+
+def _record_columns(stream: dict, start_time: int, distances, start: int, end: int) -> list:
+    ''' Gets the scaled record field values of points start:end, one list per defined field '''
+    columns = []
+    latlng = np.asarray(stream['latlng']['data'][start:end], dtype=np.float64).reshape(-1, 2)
+    for key, _, base_type in RECORD_FIELDS:
+        if key == 'time':
+            values = np.asarray(stream['time']['data'][start:end], dtype=np.int64) + start_time
+        elif key == 'lat':
+            values = np.rint(latlng[:, 0] * SEMICIRCLES)
+        elif key == 'lng':
+            values = np.rint(latlng[:, 1] * SEMICIRCLES)
+        elif key == 'distance':
+            values = np.rint(np.asarray(distances[start:end], dtype=np.float64) * 100)
+        elif key not in stream:
+            continue
+        elif key == 'altitude':
+            # 1/5 m resolution with a 500 m offset
+            values = np.asarray(stream[key]['data'][start:end], dtype=np.float64)
+            values = np.where(np.isnan(values), INVALID[UINT16],
+                              np.clip(np.rint((values + 500) * 5), 0, INVALID[UINT16] - 1))
+        else:
+            values = np.clip(np.asarray(stream[key]['data'][start:end]), 0, INVALID[UINT8] - 1)
+        columns.append(values.astype(np.int64).tolist())
+    return columns
+
+
+def write_fit(stream: dict, activity: dict, output) -> None:
+    ''' Writes a FIT activity file with this stream's data
+
+    The file holds a file_id message, timer start/stop events, a record per point,
+    and a single lap, session and activity summary
+
+    Args:
+        stream:
+            a Strava stream object (or StreamSet) with all
+            https://developers.strava.com/docs/reference/#api-models-StreamSet
+        activity:
+            a Strava activity object
+        output:
+            a file name or a binary file object
+    '''
+    # we are assuming that all streams will have latlng based on the range parameter
+    size = stream['latlng']['original_size']
+    times = stream['time']['data']
+    start_time = timegm(datetime.strptime(activity['start_date'], DATETIME_FMT).timetuple()) - FIT_EPOCH
+    end_time = start_time + int(times[size - 1]) if size else start_time
+    distances = stream['distance']['data'] if 'distance' in stream else latlng_distances(stream['latlng']['data'])
+    elapsed = (end_time - start_time) * 1000
+    total_distance = int(round(float(distances[size - 1]) * 100)) if size else 0
+    heartrates = stream['heartrate']['data'] if 'heartrate' in stream else None
+    cadences = stream['cadence']['data'] if 'cadence' in stream else None
+    avg_hr, max_hr = _summary(heartrates)
+    avg_cad, max_cad = _summary(cadences)
+
+    fields = [(number, base_type) for key, number, base_type in RECORD_FIELDS
+              if key in ('time', 'lat', 'lng', 'distance') or key in stream]
+    record = Message(2, 20, fields)
+    body = bytearray()
+    body += FILE_ID.definition
+    body += FILE_ID.pack(FILE_ACTIVITY, MANUFACTURER_DEVELOPMENT, 0, 0, start_time)
+    body += EVENT.definition
+    body += EVENT.pack(start_time, EVENT_TIMER, EVENT_TYPE_START)
+    body += record.definition
+    offset = len(body)
+    body += bytes(size * record.layout.size)
+    pack_into, local_type, record_size = record.layout.pack_into, record.local_type, record.layout.size
+    for start in range(0, size, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, size)
+        for values in zip(*_record_columns(stream, start_time, distances, start, end)):
+            pack_into(body, offset, local_type, *values)
+            offset += record_size
+    body += EVENT.pack(end_time, EVENT_TIMER, EVENT_TYPE_STOP_ALL)
+    body += LAP.definition
+    body += LAP.pack(end_time, 0, EVENT_LAP, EVENT_TYPE_STOP, start_time, elapsed, elapsed,
+                     total_distance, avg_hr, max_hr, avg_cad, max_cad, SPORT_CYCLING)
+    body += SESSION.definition
+    body += SESSION.pack(end_time, 0, EVENT_SESSION, EVENT_TYPE_STOP, start_time, SPORT_CYCLING, 0,
+                         elapsed, elapsed, total_distance, avg_hr, max_hr, avg_cad, max_cad, 0, 1)
+    body += ACTIVITY.definition
+    body += ACTIVITY.pack(end_time, elapsed, 1, 0, EVENT_ACTIVITY, EVENT_TYPE_STOP)
+
+    header = HEADER.pack(14, PROTOCOL_VERSION, PROFILE_VERSION, len(body), b'.FIT')
+    header += HEADER_CRC.pack(crc16(header))
+    crc = HEADER_CRC.pack(crc16(body, crc16(header)))
+    if hasattr(output, 'write'):
+        output.write(header)
+        output.write(body)
+        output.write(crc)
+    else:
+        with open(output, 'wb') as f:
+            f.write(header)
+            f.write(body)
+            f.write(crc)
+
+
+def create_fit(stream: dict, activity: dict, filename, filetype: str = 'fit') -> bool:
+    ''' Creates a FIT file with this stream's data
+
+    Args:
+        stream:
+            a Strava stream object (or StreamSet) with all
+            https://developers.strava.com/docs/reference/#api-models-StreamSet
+        activity:
+            a Strava activity object
+        filename:
+            the desired file name (without an extension), or a binary file object
+            (e.g. io.BytesIO) to build the file in memory without touching the disk
+        filetype:
+            the desired file type (fit or fit.gz)
+    Returns:
+        Whether or not the file was successfully created
+    '''
+    try:
+        if filetype not in ['fit', 'fit.gz']:
+            logging.error('invalid file type')
+            return False
+        if filetype == 'fit.gz':
+            if hasattr(filename, 'write'):
+                gz = gzip.GzipFile(fileobj=filename, mode='wb', mtime=0)
+            else:
+                gz = gzip.GzipFile(f'{filename}.fit.gz', mode='wb', mtime=0)
+            with gz:
+                write_fit(stream, activity, gz)
+        else:
+            write_fit(stream, activity, filename if hasattr(filename, 'write') else f'{filename}.fit')
+        return True
+    except Exception as e:
+        logging.error('failed to create fit file')
+        logging.error(e)
+    return False
+
+
+# NOTES
+# * FIT protocol and profile https://developer.garmin.com/fit/overview/
+# * Strava accepts fit and fit.gz uploads https://developers.strava.com/docs/uploads/
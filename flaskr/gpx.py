@@ -1,15 +1,24 @@
-from datetime import datetime, timedelta
-import json
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import gzip
+import io
 import os
 from lxml import etree
 import logging
+import re
 import tarfile
 
+import numpy as np
+
+from flaskr.cadence import CadenceStream, latlng_distances
+
 # TODO this needs to be broken down into smaller logical parts
 # TODO ditto ^^^
 
 XSI = 'http://www.w3.org/2001/XMLSchema-instance'
+GPX = 'http://www.topografix.com/GPX/1/1'
 GPXTPX = 'http://www.garmin.com/xmlschemas/TrackPointExtension/v1'
+GPXTPX_V2 = 'http://www.garmin.com/xmlschemas/TrackPointExtension/v2'
 GPXX = 'http://www.garmin.com/xmlschemas/GpxExtensions/v3'
 NSMAP = {
     'xsi': XSI,
@@ -18,127 +27,494 @@ NSMAP = {
 }
 
 
-def create_gpx(stream: dict, activity: dict, filename: str, filetype: str) -> bool:
+DATETIME_FMT = '%Y-%m-%dT%H:%M:%SZ'
+SCHEMA_LOCATION = ' '.join([
+    'http://www.topografix.com/GPX/1/1', 'http://www.topografix.com/GPX/1/1/gpx.xsd',
+    'http://www.garmin.com/xmlschemas/GpxExtensions/v3', 'http://www.garmin.com/xmlschemas/GpxExtensionsv3.xsd',
+    'http://www.garmin.com/xmlschemas/TrackPointExtension/v1', 'http://www.garmin.com/xmlschemas/TrackPointExtensionv1.xsd'])
+# number of points converted from arrays to Python objects at a time
+CHUNK_SIZE = 4096
+# gzip level for gpx.gz output - higher levels are much slower for little gain on GPX
+GZIP_LEVEL = 6
+# pretty printing indentation for each depth
+INDENT = ['\n' + '  ' * depth for depth in range(8)]
+NO_INDENT = [''] * len(INDENT)
+# zero padded hours, minutes and seconds
+TWO_DIGITS = [f'{value:02d}' for value in range(60)]
+# elements that hold trkpts and are opened (not buffered) when cadence is injected
+CONTAINERS = {f'{{{GPX}}}{tag}' for tag in ('gpx', 'trk', 'trkseg')}
+TRKPT, TIME, EXTENSIONS = f'{{{GPX}}}trkpt', f'{{{GPX}}}time', f'{{{GPX}}}extensions'
+# TrackPointExtension children that come after cad in the schema
+AFTER_CAD = {'speed', 'course', 'bearing', 'Extensions'}
+# the name and namespace declarations at the start of a serialized element
+START_TAG = re.compile(rb'<([^\s/>]+)((?:\s+xmlns(?::[^=\s]+)?="[^"]*")*)')
+DECLARATION = re.compile(rb'\s+xmlns(?::[^=\s]+)?="[^"]*"')
+
+
+def _chunk(data, start: int, end: int) -> list:
+    ''' Gets data[start:end] as a list of Python objects (from a list or an array) '''
+    if data is None:
+        return None
+    chunk = data[start:end]
+    return chunk.tolist() if hasattr(chunk, 'tolist') else chunk
+
+
+def format_numbers(values: list, precision: int = None) -> list:
+    ''' Formats numbers as compact decimal strings
+
+    Args:
+        values:
+            a list of numbers
+        precision:
+            the maximum number of decimal places (trailing zeros are dropped),
+            or None for the shortest string that round trips
+    Returns:
+        A list of strings
+    '''
+    if precision is None:
+        return [str(value) for value in values]
+    fmt = f'{{:.{precision}f}}'.format
+    if precision == 0:
+        return [fmt(value) for value in values]
+    return [fmt(value).rstrip('0').rstrip('.') for value in values]
+
+
+class TimestampFormatter:
+    ''' Formats second offsets from a start time as GPX timestamps
+
+    The date part is only formatted once per day, and the time part is joined
+    from precomputed two digit strings, so no datetime is created per point
+
+    Properties:
+        start: int
+            the start time in seconds since the epoch
+    '''
+
+    def __init__(self, start_datetime: datetime) -> None:
+        self.start = int((start_datetime - datetime(1970, 1, 1)).total_seconds())
+        self._day = None
+        self._prefix = None
+
+    def format(self, seconds: int) -> str:
+        ''' Gets the timestamp seconds after the start time '''
+        day, seconds = divmod(self.start + int(seconds), 86400)
+        if day != self._day:
+            self._day = day
+            self._prefix = (datetime(1970, 1, 1) + timedelta(days=day)).strftime('%Y-%m-%dT')
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return f'{self._prefix}{TWO_DIGITS[hours]}:{TWO_DIGITS[minutes]}:{TWO_DIGITS[seconds]}Z'
+
+
+@lru_cache(maxsize=64)
+def _epoch_day(date: str) -> int:
+    ''' Gets the seconds since the epoch at midnight UTC of a YYYY-MM-DD date '''
+    return int(datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+
+
+def parse_time(text: str) -> int:
+    ''' Parses a GPX (ISO 8601) timestamp into whole seconds since the epoch
+
+    UTC timestamps (YYYY-MM-DDTHH:MM:SS[.sss]Z) are sliced directly, with the date
+    looked up once per day - anything else goes through datetime.fromisoformat
+
+    Args:
+        text:
+            the timestamp
+    Returns:
+        The seconds since the epoch
+    '''
+    if len(text) >= 20 and text[-1] == 'Z' and text[10] == 'T':
+        return _epoch_day(text[:10]) + int(text[11:13]) * 3600 + int(text[14:16]) * 60 + int(text[17:19])
+    moment = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+def write_gpx(stream: dict, activity: dict, output, coordinate_precision: int = None,
+              elevation_precision: int = None, pretty_print: bool = True) -> None:
+    ''' Incrementally writes a GPX document with this stream's data
+
+    Every trkpt is written as soon as it is generated, so no element tree is
+    kept in memory regardless of the number of points
+
+    Args:
+        stream:
+            a Strava stream object (or StreamSet) with all
+            https://developers.strava.com/docs/reference/#api-models-StreamSet
+        activity:
+            a Strava activity object
+        output:
+            a file name or a binary file object
+        coordinate_precision:
+            the number of decimal places kept in lat and lon (None keeps every digit)
+        elevation_precision:
+            the number of decimal places kept in ele (None keeps every digit)
+        pretty_print:
+            whether or not to indent the document
+    '''
+    start_date = activity['start_date']
+    timestamp = TimestampFormatter(datetime.strptime(start_date, DATETIME_FMT)).format
+    indent = INDENT if pretty_print else NO_INDENT
+    creator = 'todo replace creator name'
+    attrib = {
+        'creator': creator,
+        'xmlns': 'http://www.topografix.com/GPX/1/1',
+        'version': '1.1',
+        '{%s}schemaLocation' % (XSI): SCHEMA_LOCATION
+    }
+    trackpoint_extension = '{%s}TrackPointExtension' % (GPXTPX)
+    hr, cad = '{%s}hr' % (GPXTPX), '{%s}cad' % (GPXTPX)
+
+    # we are assuming that all streams will have latlng based on the range parameter
+    latlngs = stream['latlng']['data']
+    times = stream['time']['data']
+    altitudes = stream['altitude']['data'] if 'altitude' in stream else None
+    heartrates = stream['heartrate']['data'] if 'heartrate' in stream else None
+    cadences = stream['cadence']['data'] if 'cadence' in stream else None
+    size = stream['latlng']['original_size']
+
+    with etree.xmlfile(output, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        with xf.element('gpx', attrib, nsmap=NSMAP):
+            xf.write(indent[1])
+            with xf.element('metadata'):
+                xf.write(indent[2])
+                with xf.element('time'):
+                    xf.write(start_date)
+                xf.write(indent[1])
+            xf.write(indent[1])
+            with xf.element('trk'):
+                xf.write(indent[2])
+                with xf.element('name'):
+                    xf.write(activity['name'])
+                xf.write(indent[2])
+                with xf.element('type'):
+                    # TODO investigate this
+                    # I thinkkkkk 1==bikeActivity, but I could be wrong
+                    xf.write('1')
+                xf.write(indent[2])
+                with xf.element('trkseg'):
+                    for start in range(0, size, CHUNK_SIZE):
+                        end = min(start + CHUNK_SIZE, size)
+                        latlng_chunk = _chunk(latlngs, start, end)
+                        lat_chunk = format_numbers([lat for lat, _ in latlng_chunk], coordinate_precision)
+                        lon_chunk = format_numbers([lon for _, lon in latlng_chunk], coordinate_precision)
+                        time_chunk = _chunk(times, start, end)
+                        altitude_chunk = _chunk(altitudes, start, end)
+                        if altitude_chunk is not None:
+                            altitude_chunk = format_numbers(altitude_chunk, elevation_precision)
+                        heartrate_chunk = _chunk(heartrates, start, end)
+                        cadence_chunk = _chunk(cadences, start, end)
+                        for ii in range(end - start):
+                            xf.write(indent[3])
+                            with xf.element('trkpt', {'lat': lat_chunk[ii], 'lon': lon_chunk[ii]}):
+                                xf.write(indent[4])
+                                with xf.element('time'):
+                                    xf.write(timestamp(time_chunk[ii]))
+                                if altitude_chunk is not None:
+                                    xf.write(indent[4])
+                                    with xf.element('ele'):
+                                        xf.write(altitude_chunk[ii])
+                                xf.write(indent[4])
+                                with xf.element('extensions'):
+                                    xf.write(indent[5])
+                                    with xf.element(trackpoint_extension):
+                                        # TrackpointExtension Elements:
+                                        if heartrate_chunk is not None:
+                                            xf.write(indent[6])
+                                            with xf.element(hr):
+                                                xf.write(str(heartrate_chunk[ii]))
+                                        if cadence_chunk is not None:
+                                            xf.write(indent[6])
+                                            with xf.element(cad):
+                                                xf.write(str(cadence_chunk[ii]))
+                                        if heartrate_chunk is not None or cadence_chunk is not None:
+                                            xf.write(indent[5])
+                                        # watts, temp, moving, velocity_smooth and grade_smooth
+                                        # aren't TrackPointExtension v1 elements
+                                    xf.write(indent[4])
+                                xf.write(indent[3])
+                        xf.flush()
+                    xf.write(indent[2])
+                xf.write(indent[1])
+            xf.write(indent[0])
+
+
+def create_gpx(stream: dict, activity: dict, filename, filetype: str, coordinate_precision: int = None,
+               elevation_precision: int = None, pretty_print: bool = True) -> bool:
     """ Creates a GPX file with this stream's data
 
     Args:
         stream:
-            a Strava stream object with all
+            a Strava stream object (or StreamSet) with all
             https://developers.strava.com/docs/reference/#api-models-StreamSet
         activity:
             a Strava activity object
         filename:
-            the desired file name
+            the desired file name (without an extension), or a binary file object
+            (e.g. io.BytesIO) to build the file in memory without touching the disk
         filetype:
-            the desired file type
+            the desired file type (gpx, gpx.gz or tar.gz)
+        coordinate_precision, elevation_precision, pretty_print:
+            formatting options passed on to write_gpx
     Returns:
         Whether or not the file was successfully created
     """
-    # activity = {
-    #     'start_time': '2021-09-14T10:28:25Z',
-    #     'device_name': 'wahooo',
-    #     'name': 'mornnning ride'
-    # }
     try:
-        datetime_fmt = '%Y-%m-%dT%H:%M:%SZ'
-        start_datetime = activity['start_date']
-        schema_location = ''
-        schema = ['http://www.topografix.com/GPX/1/1 ', 'http://www.topografix.com/GPX/1/1/gpx.xsd ',
-                  'http://www.garmin.com/xmlschemas/GpxExtensions/v3 ', 'http://www.garmin.com/xmlschemas/GpxExtensionsv3.xsd ',
-                  'http://www.garmin.com/xmlschemas/TrackPointExtension/v1 ', 'http://www.garmin.com/xmlschemas/TrackPointExtensionv1.xsd']
-        for s in schema:
-            schema_location += s
-
-        # f = open('st.json')
-        # stream = json.load(f)
-        creator = 'todo replace creator name'
-        gpx = etree.Element('gpx', creator=creator,
-                            xmlns='http://www.topografix.com/GPX/1/1', version='1.1', nsmap=NSMAP)
-        gpx.set(
-            '{http://www.w3.org/2001/XMLSchema-instance}schemaLocation', schema_location)
-
-        doc = etree.ElementTree(gpx)
-
-        metadata = etree.SubElement(gpx, 'metadata')
-
-        time = etree.SubElement(metadata, 'time')
-        time.text = start_datetime
-        start_datetime = datetime.strptime(start_datetime, datetime_fmt)
-
-        trk = etree.SubElement(gpx, 'trk')
-
-        name = etree.SubElement(trk, 'name')
-        name.text = activity['name']
-
-        type = etree.SubElement(trk, 'type')
-        type.text = '1'
-        # TODO investigate this
-        # I thinkkkkk 1==bikeActivity, but I could be wrong
-
-        trkseg = etree.SubElement(trk, 'trkseg')
-
-        # we are assuming that all streams will have latlng based on the range parameter
-        for ii in range(stream['latlng']['original_size']):
-            trkpt = etree.SubElement(trkseg, 'trkpt', lat=str(
-                stream['latlng']['data'][ii][0]), lon=str(stream['latlng']['data'][ii][1]))
-
-            time = etree.SubElement(trkpt, 'time')
-            time.text = (start_datetime + timedelta(seconds=int(
-                stream['time']['data'][ii]))).strftime('%Y-%m-%dT%H:%M:%SZ')
-
-            if 'altitude' in stream:
-                ele = etree.SubElement(trkpt, 'ele')
-                ele.text = str(stream['altitude']['data'][ii])
-
-            # invalid tag name with the colon below - use a xmlns or something
-            extensions = etree.SubElement(trkpt, 'extensions')
-            trackpoint_extension = etree.SubElement(
-                extensions, '{%s}TrackPointExtension' % (GPXTPX))
-            # TrackpointExtension Elements:
-            if 'heartrate' in stream:
-                heartrate = etree.SubElement(
-                    trackpoint_extension, '{%s}hr' % (GPXTPX))
-                heartrate.text = str(stream['heartrate']['data'][ii])
-            if 'cadence' in stream:
-                cadence = etree.SubElement(
-                    trackpoint_extension, '{%s}cad' % (GPXTPX))
-                cadence.text = str(stream['cadence']['data'][ii])
-            # if 'watts' in stream:
-            #     watts = etree.SubElement(trackpoint_extension, 'watts')
-            #     watts.text = str(stream['watts']['data'][ii])
-            # if 'temp' in stream:
-            #     temp = etree.SubElement(trackpoint_extension, 'temp')
-            #     temp.text = str(stream['temp']['data'][ii])
-            # if 'moving' in stream:
-            #     moving = etree.SubElement(trackpoint_extension, 'moving')
-            #     moving.text = str(stream['moving']['data'][ii])
-            # if 'velocity_smooth' in stream:
-            #     velocity_smooth = etree.SubElement(trackpoint_extension, 'velocity_smooth')
-            #     velocity_smooth.text = str(stream['velocity_smooth']['data'][ii])
-            # if 'grade_smooth' in stream:
-            #     grade_smooth = etree.SubElement(trackpoint_extension, 'grade_smooth')
-            #     grade_smooth.text = str(stream['grade_smooth']['data'][ii])
-                # OTHER STREAM
-                # distance - don't need(?)
-                # DistanceStream	An instance of DistanceStream.
-        if filetype in ['tar.gz', 'gpx']:
-            gpx_filename = f'{filename}.gpx'
-            doc.write(gpx_filename, xml_declaration=True,
-                      encoding='UTF-8', pretty_print=True)
-            if filetype == 'tar.gz':
-                targz_filename = f'{filename}.tar.gz'
-                tar = tarfile.open(targz_filename, 'w:gz')
-                tar.add(gpx_filename)
-                tar.close()
-                return os.path.exists(targz_filename)
-            else:
-                return os.path.exists(gpx_filename)
-        else:
+        if filetype not in ['tar.gz', 'gpx', 'gpx.gz']:
             logging.error('invalid file type')
             return False
+        options = {
+            'coordinate_precision': coordinate_precision,
+            'elevation_precision': elevation_precision,
+            'pretty_print': pretty_print
+        }
+        if filetype == 'gpx.gz':
+            # compressed while it is serialized - no intermediate file or buffer
+            if hasattr(filename, 'write'):
+                gz = gzip.GzipFile(fileobj=filename, mode='wb',
+                                   compresslevel=GZIP_LEVEL, mtime=0)
+            else:
+                gz = gzip.GzipFile(f'{filename}.gpx.gz', mode='wb',
+                                   compresslevel=GZIP_LEVEL, mtime=0)
+            with gz:
+                write_gpx(stream, activity, gz, **options)
+            return True
+        if hasattr(filename, 'write'):
+            if filetype == 'gpx':
+                write_gpx(stream, activity, filename, **options)
+            else:
+                gpx = io.BytesIO()
+                write_gpx(stream, activity, gpx, **options)
+                info = tarfile.TarInfo('activity.gpx')
+                info.size = gpx.tell()
+                gpx.seek(0)
+                with tarfile.open(fileobj=filename, mode='w:gz') as tar:
+                    tar.addfile(info, gpx)
+            return True
+        gpx_filename = f'{filename}.gpx'
+        write_gpx(stream, activity, gpx_filename, **options)
+        if filetype == 'tar.gz':
+            targz_filename = f'{filename}.tar.gz'
+            tar = tarfile.open(targz_filename, 'w:gz')
+            tar.add(gpx_filename)
+            tar.close()
+            return os.path.exists(targz_filename)
+        else:
+            return os.path.exists(gpx_filename)
     except Exception as e:
         logging.error('failed to create gpx file')
         logging.error(e)
+    return False
+
+
+def _insert(parent, child, index: int) -> None:
+    ''' Inserts child at index, copying the indentation of its new siblings '''
+    if index < len(parent):
+        child.tail = parent[index - 1].tail if index else parent.text
+        parent.insert(index, child)
+        return
+    if len(parent):
+        last = parent[-1]
+        child.tail = last.tail
+        last.tail = parent[-2].tail if len(parent) > 1 else parent.text
+    parent.append(child)
+
+
+def _set_cadence(trkpt, cadence: int, nsmap: dict = None) -> None:
+    ''' Adds a gpxtpx:cad to a trkpt, creating its extensions and TrackPointExtension if needed
+
+    A cad the trkpt already has (i.e. recorded by a sensor) is left as it is. nsmap
+    is used for a new TrackPointExtension when GPXTPX isn't declared in the document
+    '''
+    extensions = trkpt.find(EXTENSIONS)
+    if extensions is None:
+        extensions = etree.Element(EXTENSIONS)
+        # extensions is the last child of a trkpt
+        _insert(trkpt, extensions, len(trkpt))
+    for namespace in (GPXTPX, GPXTPX_V2):
+        trackpoint_extension = extensions.find(f'{{{namespace}}}TrackPointExtension')
+        if trackpoint_extension is not None:
+            break
+    else:
+        namespace = GPXTPX
+        if GPXTPX in trkpt.nsmap.values():
+            nsmap = None
+        trackpoint_extension = etree.Element(f'{{{GPXTPX}}}TrackPointExtension', nsmap=nsmap)
+        _insert(extensions, trackpoint_extension, len(extensions))
+    if trackpoint_extension.find(f'{{{namespace}}}cad') is not None:
+        return
+    index = len(trackpoint_extension)
+    for ii, child in enumerate(trackpoint_extension):
+        if isinstance(child.tag, str) and etree.QName(child).localname in AFTER_CAD:
+            index = ii
+            break
+    cad = etree.Element(f'{{{namespace}}}cad')
+    cad.text = str(cadence)
+    _insert(trackpoint_extension, cad, index)
+
+
+def _serialize(element, scope: set) -> bytes:
+    ''' Serializes a parsed element (and its tail) without the namespace declarations already in scope
+
+    etree.tostring declares every namespace in scope on the element it starts from,
+    which would otherwise be repeated on every trkpt
+    '''
+    data = etree.tostring(element, encoding='UTF-8')
+    match = START_TAG.match(data)
+    if match and match.group(2):
+        kept = b''.join(declaration for declaration in DECLARATION.findall(match.group(2))
+                        if declaration.lstrip() not in scope)
+        data = data[:match.start(2)] + kept + data[match.end(2):]
+    return data
+
+
+def _declarations(nsmap: dict) -> set:
+    ''' Gets the xmlns attributes etree.tostring writes for these namespaces '''
+    return {(f'xmlns:{prefix}="{uri}"' if prefix else f'xmlns="{uri}"').encode() for prefix, uri in nsmap.items()}
+
+
+def inject_cadence(source, output, chainring: int, cog: int, wheel_diameter: int = 622, tire_width: int = 25,
+                   smoother=None, chunk_size: int = CHUNK_SIZE) -> int:
+    ''' Copies a GPX document, adding a generated gpxtpx:cad to every trkpt
+
+    The document is read and written in a single streaming pass - everything
+    other than the added cad elements (metadata, unknown extensions, comments,
+    processing instructions, whitespace) is passed through as it is. Only gpx, trk and trkseg are kept open, and at
+    most chunk_size trkpts are held in memory at a time, so memory does not
+    grow with the size of the document. A cad recorded by a sensor is kept
+
+    Args:
+        source:
+            the path to the GPX file, or a binary file object
+        output:
+            a file name or a binary file object
+        chainring:
+            the chainring size
+        cog:
+            the cog size
+        wheel_diameter:
+            the wheel diameter in mm
+        tire_width
+            the tire width in mm
+        smoother:
+            a cadence.CadenceSmoother to post-process the generated values with
+        chunk_size:
+            the number of trkpts cadence is generated for at a time
+    Returns:
+        The number of trkpts written
+    '''
+    if not hasattr(output, 'write'):
+        with open(output, 'wb') as f:
+            return inject_cadence(source, f, chainring, cog, wheel_diameter, tire_width, smoother, chunk_size)
+    cadence_stream = CadenceStream(chainring, cog, wheel_diameter, tire_width)
+    # (element, tail only) pairs waiting to be written - a tail is only complete
+    # once the parser has moved past its element
+    pending = []
+    trkpts = []
+    # open containers as [element, xmlfile context, namespaces in scope, xmlns attributes in scope, text written]
+    containers = []
+    state = {'previous': None, 'distance': 0.0, 'count': 0}
+    # when the document doesn't declare GPXTPX, it is declared once on gpx rather than on every trkpt
+    extension_nsmap, extension_declaration = None, None
+
+    def add_cadence() -> None:
+        latlng = np.array([(float(trkpt.get('lat')), float(trkpt.get('lon'))) for trkpt in trkpts])
+        distances = latlng_distances(latlng, state['previous'], state['distance'])
+        state['previous'], state['distance'] = latlng[-1], float(distances[-1])
+        times = [trkpt.findtext(TIME) for trkpt in trkpts]
+        times = None if None in times else [parse_time(text) for text in times]
+        cadences = cadence_stream.update(distances, times)
+        cadences = smoother.update(cadences) if smoother else np.maximum(cadences, 0)
+        for trkpt, cadence in zip(trkpts, cadences.tolist()):
+            _set_cadence(trkpt, cadence, extension_nsmap)
+        state['count'] += len(trkpts)
+        trkpts.clear()
+
+    def flush() -> None:
+        if trkpts:
+            add_cadence()
+        # everything xf has buffered has to be out before writing serialized elements directly
+        xf.flush()
+        declarations = containers[-1][3] if containers else set()
+        for element, tail_only in pending:
+            if tail_only:
+                if element.tail:
+                    xf.write(element.tail)
+                    xf.flush()
+            else:
+                data = _serialize(element, declarations)
+                if extension_declaration:
+                    data = data.replace(extension_declaration, b'')
+                output.write(data)
+            element.clear()
+        if pending:
+            last = pending[-1][0]
+            # comments and processing instructions outside gpx have no parent
+            while last.getprevious() is not None and last.getparent() is not None:
+                del last.getparent()[0]
+        pending.clear()
+
+    def write_text() -> None:
+        container = containers[-1]
+        if not container[4]:
+            if container[0].text:
+                xf.write(container[0].text)
+            container[4] = True
+
+    with etree.xmlfile(output, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        depth = 0
+        for event, element in etree.iterparse(source, events=('start', 'end', 'comment', 'pi')):
+            if event in ('comment', 'pi'):
+                # complete as soon as they're parsed - inside a buffered element they're
+                # written with it, and otherwise written like a sibling element
+                if depth == len(containers):
+                    if containers:
+                        write_text()
+                    pending.append((element, False))
+                continue
+            if event == 'start':
+                depth += 1
+                if depth != len(containers) + 1:
+                    # inside a trkpt or another buffered element
+                    continue
+                if containers:
+                    write_text()
+                if element.tag in CONTAINERS:
+                    flush()
+                    scope = containers[-1][2] if containers else {}
+                    nsmap = {prefix: uri for prefix, uri in element.nsmap.items() if scope.get(prefix) != uri}
+                    if not containers and GPXTPX not in element.nsmap.values():
+                        prefix = 'gpxtpx' if 'gpxtpx' not in element.nsmap else 'cadgpxtpx'
+                        nsmap[prefix] = GPXTPX
+                        extension_nsmap = {prefix: GPXTPX}
+                        extension_declaration = f' xmlns:{prefix}="{GPXTPX}"'.encode()
+                    scope = {**scope, **nsmap}
+                    context = xf.element(element.tag, dict(element.attrib), nsmap=nsmap or None)
+                    context.__enter__()
+                    containers.append([element, context, scope, _declarations(scope), False])
+                elif len(pending) >= chunk_size:
+                    flush()
+                continue
+            depth -= 1
+            if containers and containers[-1][0] is element:
+                write_text()
+                flush()
+                containers.pop()[1].__exit__(None, None, None)
+                if containers:
+                    pending.append((element, True))
+            elif depth == len(containers):
+                pending.append((element, False))
+                if element.tag == TRKPT:
+                    trkpts.append(element)
+                    if len(trkpts) >= chunk_size:
+                        add_cadence()
+        # comments after the end of gpx
+        flush()
+    return state['count']
 
 
 # NOTES
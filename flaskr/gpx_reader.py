@@ -0,0 +1,98 @@
+from array import array
+from datetime import datetime, timezone
+import logging
+import os
+
+from lxml import etree
+import numpy as np
+
+from flaskr.activities import StreamSet
+from flaskr.gpx import parse_time
+
+GPX = 'http://www.topografix.com/GPX/1/1'
+GPXTPX = ('http://www.garmin.com/xmlschemas/TrackPointExtension/v1',
+          'http://www.garmin.com/xmlschemas/TrackPointExtension/v2')
+TRKPT, ELE, TIME, NAME, EXTENSIONS = (f'{{{GPX}}}{tag}' for tag in ('trkpt', 'ele', 'time', 'name', 'extensions'))
+HR = tuple(f'{{{namespace}}}hr' for namespace in GPXTPX)
+CAD = tuple(f'{{{namespace}}}cad' for namespace in GPXTPX)
+DATETIME_FMT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def read_gpx(source) -> tuple:
+    ''' Reads every trkpt of a GPX file into a StreamSet in a single pass
+
+    Each trkpt is cleared as soon as it is read and its values are appended to
+    typed arrays, so memory is bounded by the size of the arrays rather than
+    the size of the document
+
+    Args:
+        source:
+            the path to the GPX file, or a binary file object
+    Returns:
+        (StreamSet, activity) where activity holds the 'name' and 'start_date' create_gpx needs.
+        time is in seconds from the first trkpt (1 second sampling is assumed unless every
+        trkpt has a time - mixing the two would run time backwards), and altitude, heartrate and cadence are only included if every
+        trkpt has them
+    '''
+    lats, lons = array('d'), array('d')
+    seconds, altitudes = array('q'), array('d')
+    heartrates, cadences = array('l'), array('l')
+    start_date, name = None, None
+    start = None
+    timed = 0
+    for _, element in etree.iterparse(source, tag=(TRKPT, TIME, NAME)):
+        tag = element.tag
+        if tag != TRKPT:
+            # trkpt times are read with their trkpt - this only catches the metadata time and names
+            parent = element.getparent().tag
+            if tag == NAME and parent in (f'{{{GPX}}}metadata', f'{{{GPX}}}trk'):
+                name = name or element.text
+            elif tag == TIME and parent != TRKPT:
+                start_date = start_date or element.text
+            continue
+        lats.append(float(element.get('lat')))
+        lons.append(float(element.get('lon')))
+        moment = None
+        for child in element:
+            child_tag = child.tag
+            if child_tag == ELE:
+                altitudes.append(float(child.text))
+            elif child_tag == TIME:
+                moment = parse_time(child.text)
+            elif child_tag == EXTENSIONS:
+                for value in child.iter(*HR, *CAD):
+                    (heartrates if value.tag in HR else cadences).append(int(float(value.text)))
+        if moment is None:
+            # without trkpt times, assume 1 second sampling
+            seconds.append(len(seconds))
+        else:
+            if start is None:
+                start = moment
+            seconds.append(moment - start)
+            timed += 1
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    size = len(lats)
+    if timed and timed < size:
+        logging.warning(f'ignoring trkpt times, only {timed} of {size} trkpts have them')
+        seconds = array('q', range(size))
+    channels = {'time': seconds, 'latlng': np.column_stack((np.frombuffer(lats), np.frombuffer(lons)))}
+    for key, data in (('altitude', altitudes), ('heartrate', heartrates), ('cadence', cadences)):
+        if data and len(data) == size:
+            channels[key] = data
+        elif data:
+            logging.warning(f'ignoring {key}, only {len(data)} of {size} trkpts have it')
+    streams = StreamSet()
+    for key, data in channels.items():
+        streams[key] = {'data': data, 'series_type': 'time', 'original_size': size, 'resolution': 'high'}
+    if start is not None:
+        start_date = datetime.fromtimestamp(start, timezone.utc).strftime(DATETIME_FMT)
+    if name is None:
+        name = os.path.splitext(os.path.basename(source))[0] if isinstance(source, str) else 'Ride'
+    activity = {
+        'name': name,
+        'start_date': start_date or datetime.utcnow().strftime(DATETIME_FMT)
+    }
+    return streams, activity
@@ -0,0 +1,298 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from flaskr import config, state
+
+PENDING, RUNNING = 'pending', 'running'
+SCHEMA = '''CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    claimed_by TEXT,
+    created_at REAL NOT NULL,
+    last_error TEXT);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at);
+CREATE TABLE IF NOT EXISTS dead_letter (
+    id INTEGER PRIMARY KEY,
+    event TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    failed_at REAL NOT NULL);'''
+
+
+def _identity(pid: int) -> str:
+    ''' Gets the boot id and start time of a running process, which (unlike its pid)
+        aren't reused by a later process - None if it isn't running or /proc isn't available '''
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            boot_id = f.read().strip()
+        with open(f'/proc/{pid}/stat') as f:
+            # starttime is the 22nd field - counted after the command name, which may contain spaces
+            start = f.read().rsplit(')', 1)[1].split()[19]
+        return f'{boot_id}-{start}'
+    except (OSError, IndexError):
+        return None
+
+
+_tokens = {}
+
+
+def process_token() -> str:
+    ''' Gets the token this process claims jobs with - a restarted container often gets
+        the same pid as the process it replaced, so the pid alone doesn't identify a claim '''
+    pid = os.getpid()
+    token = _tokens.get(pid)
+    if token is None:
+        _tokens.clear()
+        token = _tokens[pid] = f'{pid}:{_identity(pid) or uuid.uuid4().hex}'
+    return token
+
+
+def _alive(token: str) -> bool:
+    ''' Checks whether the process that claimed a job with a token is still running '''
+    if token == process_token():
+        return True
+    pid = str(token).split(':', 1)[0]
+    if not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    identity = _identity(int(pid))
+    if identity is not None:
+        return token == f'{pid}:{identity}'
+    # without /proc all that can be checked is the pid
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobJournal:
+    ''' A durable journal of webhook jobs in the local state database
+
+    Appended events are written by a single writer thread, which commits every
+    event buffered while the previous commit was running in one transaction,
+    so a burst of webhooks costs a few commits rather than one each. append only
+    returns once its event is committed. A worker claims a job before running
+    it, and either completes it or records a failure - failed jobs are retried
+    with exponential backoff, and moved to the dead_letter table after
+    max_attempts. Jobs that were pending, or claimed by a process that has since
+    died, are returned by replay so they can be scheduled again after a restart
+
+    Events are returned with their job's id under 'job_id'
+
+    Properties:
+        path: str
+            the state database file
+        max_attempts: int
+            the attempts a job gets before it is dead-lettered
+        backoff: float
+            seconds before a job's first retry, doubling with each failure
+        max_backoff: float
+            the longest wait between retries
+    '''
+
+    def __init__(self, path: str = None, max_attempts: int = None, backoff: float = None,
+                 max_backoff: float = None, clock=time.time) -> None:
+        self.path = path or config.STATE_DB
+        self.max_attempts = max_attempts or config.JOURNAL_MAX_ATTEMPTS
+        self.backoff = config.JOURNAL_BACKOFF if backoff is None else backoff
+        self.max_backoff = config.JOURNAL_MAX_BACKOFF if max_backoff is None else max_backoff
+        self.clock = clock
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _connection(self):
+        return state.local_connection(self.path, SCHEMA)
+
+    def _start(self) -> None:
+        # the writer thread doesn't survive a fork - a child starts its own
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._condition = threading.Condition()
+            self._buffer = []
+            self._writer = threading.Thread(target=self._write, name='job-journal', daemon=True)
+            self._writer.start()
+            self._pid = os.getpid()
+
+    def append(self, event: dict, available_at: float = None) -> int:
+        ''' Durably records a job
+
+        Args:
+            event:
+                the webhook event the job handles
+            available_at:
+                when the job may be claimed (now by default)
+        Returns:
+            The job's id, once it has been committed
+        '''
+        if self._pid != os.getpid():
+            self._start()
+        # [row, committed, job id, error]
+        entry = [(self._dumps(event), available_at or self.clock()), threading.Event(), None, None]
+        with self._condition:
+            self._buffer.append(entry)
+            self._condition.notify()
+        entry[1].wait()
+        if entry[3] is not None:
+            raise entry[3]
+        return entry[2]
+
+    def _write(self) -> None:
+        while True:
+            with self._condition:
+                while not self._buffer:
+                    self._condition.wait()
+                batch, self._buffer = self._buffer, []
+            try:
+                now = self.clock()
+                conn = self._connection()
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    for entry in batch:
+                        event, available_at = entry[0]
+                        entry[2] = conn.execute(
+                            'INSERT INTO jobs (event, status, available_at, created_at) VALUES (?, ?, ?, ?)',
+                            (event, PENDING, available_at, now)).lastrowid
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+            except Exception as e:
+                logging.error(f'error journaling {len(batch)} jobs:')
+                logging.error(e)
+                for entry in batch:
+                    entry[3] = e
+            for entry in batch:
+                entry[1].set()
+
+    @staticmethod
+    def _dumps(event: dict) -> str:
+        return json.dumps({key: value for key, value in event.items() if key != 'job_id'})
+
+    @staticmethod
+    def _loads(job_id: int, event: str) -> dict:
+        return {**json.loads(event), 'job_id': job_id}
+
+    def _transaction(self, function, *args):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = function(conn, *args)
+            conn.execute('COMMIT')
+            return result
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def claim(self, job_id: int) -> bool:
+        ''' Claims a pending job for this process (see process_token)
+
+        Returns:
+            Whether or not the job was claimed (False if another worker has it or it's done)
+        '''
+        return self._connection().execute(
+            'UPDATE jobs SET status = ?, claimed_by = ? WHERE id = ? AND status = ?',
+            (RUNNING, process_token(), job_id, PENDING)).rowcount == 1
+
+    def release(self, job_id: int) -> None:
+        ''' Returns a claimed job to the pending jobs without counting an attempt '''
+        self._connection().execute(
+            'UPDATE jobs SET status = ?, claimed_by = NULL WHERE id = ?', (PENDING, job_id))
+
+    def complete(self, job_id: int) -> None:
+        ''' Removes a finished job '''
+        self._connection().execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def fail(self, job_id: int, error: str) -> float:
+        ''' Records a failed attempt of a job
+
+        Args:
+            job_id:
+                the failed job
+            error:
+                what went wrong
+        Returns:
+            When the job should be retried, or None if it was dead-lettered
+        '''
+        return self._transaction(self._fail, job_id, error)
+
+    def save(self, event: dict) -> None:
+        ''' Stores changes to a job's event (e.g. progress a retry should resume from)
+
+        Args:
+            event:
+                the event, with its job's id under 'job_id'
+        '''
+        self._connection().execute('UPDATE jobs SET event = ? WHERE id = ?', (self._dumps(event), event['job_id']))
+
+    def _fail(self, conn, job_id: int, error: str) -> float:
+        row = conn.execute('SELECT event, attempts, created_at FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        event, attempts, created_at = row
+        attempts += 1
+        now = self.clock()
+        if attempts >= self.max_attempts:
+            conn.execute('INSERT OR REPLACE INTO dead_letter VALUES (?, ?, ?, ?, ?, ?)',
+                         (job_id, event, attempts, error, created_at, now))
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            logging.error(f'job {job_id} failed {attempts} times - moved to dead letters')
+            return None
+        available_at = now + min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        conn.execute('''UPDATE jobs SET status = ?, claimed_by = NULL, attempts = ?, available_at = ?,
+                        last_error = ? WHERE id = ?''', (PENDING, attempts, available_at, error, job_id))
+        return available_at
+
+    def supersede(self, job_id: int, event: dict) -> None:
+        ''' Replaces a pending job with the job of an event merged from it (see coalesce.merge_events)
+
+        Args:
+            job_id:
+                the job being merged away
+            event:
+                the merged event, whose job_id is the job that remains
+        '''
+        def supersede(conn, job_id, event):
+            conn.execute('DELETE FROM jobs WHERE id = ? AND status = ?', (job_id, PENDING))
+            conn.execute('UPDATE jobs SET event = ? WHERE id = ?', (self._dumps(event), event['job_id']))
+
+        self._transaction(supersede, job_id, event)
+
+    def replay(self) -> list:
+        ''' Gets the jobs to schedule after a restart, first returning jobs claimed by
+            processes that have died to the pending jobs
+
+        A died claim counts as a failed attempt, so a job that keeps killing its
+        worker (e.g. running out of memory) is dead-lettered like any other
+
+        Returns:
+            (event, available_at) of each pending job, soonest first
+        '''
+        def replay(conn):
+            for job_id, token in conn.execute('SELECT id, claimed_by FROM jobs WHERE status = ?', (RUNNING,)).fetchall():
+                if not _alive(token):
+                    self._fail(conn, job_id, f'the process running it ({token}) died')
+            return conn.execute('SELECT id, event, available_at FROM jobs WHERE status = ? ORDER BY available_at',
+                                (PENDING,)).fetchall()
+
+        return [(self._loads(job_id, event), available_at) for job_id, event, available_at in self._transaction(replay)]
+
+    def dead_letters(self, limit: int = 100) -> list:
+        ''' Gets the most recently dead-lettered jobs
+
+        Returns:
+            (event, attempts, error) of each job, most recent first
+        '''
+        rows = self._connection().execute(
+            'SELECT id, event, attempts, error FROM dead_letter ORDER BY failed_at DESC LIMIT ?', (limit,))
+        return [(self._loads(job_id, event), attempts, error) for job_id, event, attempts, error in rows]
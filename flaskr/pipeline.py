@@ -0,0 +1,134 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import logging
+import multiprocessing
+import os
+import threading
+
+from flaskr import config
+
+# stages - each runs on its own executor so slow browser work can't starve Strava calls
+IO, CPU, BROWSER = 'io', 'cpu', 'browser'
+
+
+class StageFailed(Exception):
+    ''' Raised by a stage that couldn't do its work, so its job is retried -
+        unlike returning None, which means the job has nothing left to do '''
+
+
+class Pipeline:
+    ''' Runs jobs as chains of stages, each stage on the executor sized for its kind of work
+
+    Each stage is a function taking the previous stage's result (the job's input
+    for the first stage). A stage returning None ends its job early. CPU stages
+    run in worker processes, so they are module level functions whose input and
+    result can be pickled. At most
+    max_jobs jobs are in flight at once - submit refuses more instead of queueing
+    them without bound, so memory and concurrency are capped by configuration
+    rather than by traffic
+
+    Properties:
+        executors: dict
+            the executor of each stage kind
+        max_jobs: int
+            the most jobs in flight at once
+    '''
+
+    def __init__(self, io_workers: int = None, cpu_workers: int = None, browser_workers: int = None,
+                 max_jobs: int = None) -> None:
+        # generating a file holds the GIL for much of its time, so it runs in separate
+        # processes rather than contending with the IO threads - spawned, since forking
+        # a process that is running threads can copy held locks into the child
+        self.executors = {
+            IO: ThreadPoolExecutor(io_workers or config.PIPELINE_IO_WORKERS, thread_name_prefix='pipeline-io'),
+            CPU: ProcessPoolExecutor(cpu_workers or config.PIPELINE_CPU_WORKERS,
+                                     mp_context=multiprocessing.get_context('spawn')),
+            BROWSER: ThreadPoolExecutor(browser_workers or config.PIPELINE_BROWSER_WORKERS,
+                                        thread_name_prefix='pipeline-browser')
+        }
+        self.max_jobs = max_jobs or config.PIPELINE_MAX_JOBS
+        self._slots = threading.BoundedSemaphore(self.max_jobs)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    @property
+    def in_flight(self) -> int:
+        ''' The number of jobs submitted but not yet finished '''
+        return self._in_flight
+
+    def submit(self, stages: list, value=None) -> Future:
+        ''' Starts a job
+
+        Args:
+            stages:
+                (stage kind, function) pairs, run in order
+            value:
+                the first stage's argument
+        Returns:
+            A Future of the last stage's result (None if a stage ended the job early),
+            or None if the pipeline is full
+        '''
+        if not self._slots.acquire(blocking=False):
+            logging.warning(f'pipeline is full - {self.max_jobs} jobs in flight')
+            return None
+        with self._lock:
+            self._in_flight += 1
+        job = Future()
+        job.set_running_or_notify_cancel()
+        try:
+            self._run(job, stages, 0, value)
+        except BaseException:
+            self._finish()
+            raise
+        return job
+
+    def _run(self, job: Future, stages: list, index: int, value) -> None:
+        kind, stage = stages[index]
+        future = self.executors[kind].submit(stage, value)
+        future.add_done_callback(lambda future: self._next(job, stages, index, future))
+
+    def _next(self, job: Future, stages: list, index: int, future: Future) -> None:
+        try:
+            result = future.result()
+            if result is not None and index + 1 < len(stages):
+                self._run(job, stages, index + 1, result)
+                return
+            job.set_result(result)
+        except BaseException as e:
+            logging.error(f'pipeline stage {stages[index][1].__name__} failed:')
+            logging.error(e)
+            job.set_exception(e)
+        self._finish()
+
+    def _finish(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def shutdown(self, wait: bool = True) -> None:
+        ''' Stops the executors, waiting for running stages to finish by default '''
+        for executor in self.executors.values():
+            executor.shutdown(wait=wait)
+
+
+# one pipeline per process - executor threads don't survive a fork
+_pipelines = {}
+_lock = threading.Lock()
+
+
+def get_pipeline() -> Pipeline:
+    ''' Gets this process's Pipeline, creating it on first use
+
+    Returns:
+        The shared Pipeline
+    '''
+    pid = os.getpid()
+    pipeline = _pipelines.get(pid)
+    if pipeline is None:
+        # request threads may race to create it
+        with _lock:
+            pipeline = _pipelines.get(pid)
+            if pipeline is None:
+                _pipelines.clear()
+                pipeline = _pipelines[pid] = Pipeline()
+                logging.info(f'created job pipeline for process {pid}')
+    return pipeline
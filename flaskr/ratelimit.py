@@ -0,0 +1,196 @@
+import asyncio
+from contextlib import contextmanager
+import contextvars
+import logging
+import time
+
+from flaskr import config, state
+
+# Strava counts calls in 15 minute windows starting on the quarter hour, and daily windows starting at midnight UTC
+# https://developers.strava.com/docs/rate-limits/
+SHORT, DAILY = 'short', 'daily'
+WINDOWS = {SHORT: 15 * 60, DAILY: 24 * 60 * 60}
+HIGH, LOW = 'high', 'low'
+# the priority of the calls made in this context - webhook jobs are high, backfills are low
+PRIORITY = contextvars.ContextVar('strava_priority', default=HIGH)
+SCHEMA = '''CREATE TABLE IF NOT EXISTS rate_limit (
+    window TEXT PRIMARY KEY,
+    start INTEGER NOT NULL,
+    usage INTEGER NOT NULL,
+    usage_limit INTEGER NOT NULL);'''
+
+
+class RateLimitExceeded(Exception):
+    ''' Raised instead of waiting longer than the limiter's max_wait for budget
+
+    Properties:
+        retry_after: float
+            seconds until the budget is expected to be available again
+    '''
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f'Strava rate limit reached - retry in {retry_after:.0f} seconds')
+        self.retry_after = retry_after
+
+
+@contextmanager
+def background():
+    ''' Runs the calls made in this block at low priority '''
+    token = PRIORITY.set(LOW)
+    try:
+        yield
+    finally:
+        PRIORITY.reset(token)
+
+
+def parse_header(value: str) -> tuple:
+    ''' Parses a rate limit header (e.g. "600,30000") into (15 minute, daily) values, or None '''
+    try:
+        short, daily = value.split(',')[:2]
+        return int(short), int(daily)
+    except (AttributeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    ''' Tracks the 15 minute and daily Strava rate limits shared by every worker on this machine
+
+    Each call reserves one unit of both windows before it is sent, and usage and
+    limits are corrected from the X-RateLimit-Usage and X-RateLimit-Limit headers
+    of every response. Low priority calls may only use background_share of each
+    window, so the rest is kept for fresh webhook jobs. State lives in the local
+    state database, so separate processes draw from the same budget
+
+    Properties:
+        path: str
+            the state database file
+        background_share: float
+            the share of each window low priority calls may use
+        max_wait: float
+            the longest a call waits for budget before RateLimitExceeded is raised
+    '''
+
+    def __init__(self, path: str = None, background_share: float = None, max_wait: float = None,
+                 clock=time.time) -> None:
+        self.path = path or config.STATE_DB
+        self.background_share = config.STRAVA_BACKGROUND_SHARE if background_share is None else background_share
+        self.max_wait = config.STRAVA_RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait
+        self.clock = clock
+
+    def _connection(self):
+        return state.local_connection(self.path, SCHEMA)
+
+    def _windows(self, conn, now: float) -> dict:
+        ''' Gets [start, usage, limit] of the current windows, starting over any window that has ended '''
+        rows = {window: [start, usage, limit]
+                for window, start, usage, limit in conn.execute('SELECT * FROM rate_limit')}
+        defaults = {SHORT: config.STRAVA_SHORT_LIMIT, DAILY: config.STRAVA_DAILY_LIMIT}
+        windows = {}
+        for window, length in WINDOWS.items():
+            start = int(now // length * length)
+            row = rows.get(window)
+            if row is None:
+                windows[window] = [start, 0, defaults[window]]
+            elif row[0] != start:
+                windows[window] = [start, 0, row[2]]
+            else:
+                windows[window] = row
+        return windows
+
+    def _save(self, conn, windows: dict) -> None:
+        conn.executemany('INSERT OR REPLACE INTO rate_limit VALUES (?, ?, ?, ?)',
+                         [(window, *row) for window, row in windows.items()])
+
+    def reserve(self, priority: str = None) -> float:
+        ''' Reserves budget for one call
+
+        Args:
+            priority:
+                HIGH or LOW (the context's PRIORITY by default)
+        Returns:
+            0 if the call can be sent now, otherwise the seconds until budget frees up
+        '''
+        priority = priority or PRIORITY.get()
+        share = 1 if priority == HIGH else self.background_share
+        conn = self._connection()
+        now = self.clock()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            windows = self._windows(conn, now)
+            delay = 0
+            for window, (start, usage, limit) in windows.items():
+                if usage >= int(limit * share):
+                    delay = max(delay, start + WINDOWS[window] - now)
+            if not delay:
+                for row in windows.values():
+                    row[1] += 1
+                self._save(conn, windows)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return delay
+
+    def update(self, headers, status_code: int = None) -> None:
+        ''' Corrects usage and limits from a response
+
+        Args:
+            headers:
+                the response headers
+            status_code:
+                the response status code - a 429 marks the budget as used up
+        '''
+        limits = parse_header(headers.get('X-RateLimit-Limit'))
+        usages = parse_header(headers.get('X-RateLimit-Usage'))
+        if not (limits and usages) and status_code != 429:
+            return
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            windows = self._windows(conn, self.clock())
+            if limits and usages:
+                for window, limit, usage in zip((SHORT, DAILY), limits, usages):
+                    # other workers' calls may have been counted since this response was sent
+                    windows[window][1] = max(windows[window][1], usage)
+                    windows[window][2] = limit
+            if status_code == 429 and all(usage < limit for _, usage, limit in windows.values()):
+                logging.warning('Strava rate limited a call the headers say is within budget')
+                windows[SHORT][1] = windows[SHORT][2]
+            self._save(conn, windows)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _delay(self, priority: str) -> float:
+        delay = self.reserve(priority)
+        if delay > self.max_wait:
+            raise RateLimitExceeded(delay)
+        if delay:
+            logging.info(f'waiting {delay:.0f} seconds for Strava rate limit budget')
+        return delay
+
+    def wait(self, priority: str = None) -> None:
+        ''' Blocks until budget for one call is reserved
+
+        Raises:
+            RateLimitExceeded if budget won't free up within max_wait
+        '''
+        while True:
+            delay = self._delay(priority)
+            if not delay:
+                return
+            time.sleep(delay)
+
+    async def wait_async(self, priority: str = None) -> None:
+        ''' Waits without blocking the event loop until budget for one call is reserved
+
+        Raises:
+            RateLimitExceeded if budget won't free up within max_wait
+        '''
+        while True:
+            # reserving takes a database lock - keep it off the event loop
+            delay = await asyncio.to_thread(self._delay, priority)
+            if not delay:
+                return
+            await asyncio.sleep(delay)
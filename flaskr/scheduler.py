@@ -0,0 +1,139 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+
+class DelayedScheduler:
+    ''' Calls functions at given times from a single timer thread
+
+    Pending calls are kept in a heap ordered by due time, so each one costs a
+    heap entry rather than a sleeping thread or process. Calls run on the timer
+    thread one at a time, so they should only hand work off (e.g. to the
+    pipeline) rather than do it
+
+    Properties:
+        clock: callable
+            the time source due times are measured against (time.time by default)
+    '''
+
+    def __init__(self, clock=time.time) -> None:
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self) -> int:
+        ''' The number of calls waiting to run '''
+        return self._pending
+
+    def schedule(self, due: float, function, *args) -> list:
+        ''' Schedules a call
+
+        Args:
+            due:
+                when to call function, in the clock's time (past times run right away)
+            function:
+                the function to call
+            *args:
+                function's arguments
+        Returns:
+            An entry that can be passed to cancel
+        '''
+        # [due, tie breaker, function, args] - function is cleared once the entry is cancelled or run
+        entry = [due, next(self._counter), function, args]
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError('cannot schedule calls after shutdown')
+            heapq.heappush(self._heap, entry)
+            self._pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='delayed-scheduler', daemon=True)
+                self._thread.start()
+            if self._heap[0] is entry:
+                # due before whatever the timer thread is waiting for
+                self._condition.notify()
+        return entry
+
+    def cancel(self, entry: list) -> bool:
+        ''' Cancels a scheduled call
+
+        Returns:
+            Whether or not the call was cancelled (False if it already ran)
+        '''
+        with self._condition:
+            if entry[2] is None:
+                return False
+            # left in the heap and skipped when it comes due
+            entry[2] = None
+            self._pending -= 1
+            return True
+
+    def _next(self) -> tuple:
+        ''' Waits for the next due call, or returns None once shut down '''
+        with self._condition:
+            while not self._stopped:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                delay = self._heap[0][0] - self.clock()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                entry = heapq.heappop(self._heap)
+                if entry[2] is None:
+                    continue
+                function, args = entry[2], entry[3]
+                entry[2] = None
+                self._pending -= 1
+                return function, args
+        return None
+
+    def _run(self) -> None:
+        while True:
+            call = self._next()
+            if call is None:
+                return
+            function, args = call
+            try:
+                function(*args)
+            except Exception as e:
+                logging.error(f'scheduled call to {function.__name__} failed:')
+                logging.error(e)
+
+    def shutdown(self) -> None:
+        ''' Stops the timer thread - calls that haven't come due are dropped '''
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+# one scheduler per process - the timer thread doesn't survive a fork
+_schedulers = {}
+_lock = threading.Lock()
+
+
+def get_scheduler() -> DelayedScheduler:
+    ''' Gets this process's DelayedScheduler, creating it on first use
+
+    Returns:
+        The shared DelayedScheduler
+    '''
+    pid = os.getpid()
+    scheduler = _schedulers.get(pid)
+    if scheduler is None:
+        # request threads may race to create it
+        with _lock:
+            scheduler = _schedulers.get(pid)
+            if scheduler is None:
+                _schedulers.clear()
+                scheduler = _schedulers[pid] = DelayedScheduler()
+                logging.info(f'created delayed scheduler for process {pid}')
+    return scheduler
@@ -0,0 +1,57 @@
+import os
+import sqlite3
+import threading
+
+from flaskr import config
+
+_local = threading.local()
+
+
+def connect(path: str = None) -> sqlite3.Connection:
+    ''' Opens the local state database shared by the workers on this machine
+
+    The database is in WAL mode so readers don't block the writer, and
+    connections are in autocommit mode - callers group statements with an
+    explicit BEGIN IMMEDIATE when they need a transaction
+
+    Args:
+        path:
+            the database file (config.STATE_DB by default)
+    Returns:
+        A sqlite3 Connection
+    '''
+    path = path or config.STATE_DB
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=config.STATE_DB_TIMEOUT, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def local_connection(path: str = None, schema: str = None) -> sqlite3.Connection:
+    ''' Gets this thread's connection to the state database, opening it on first use
+
+    sqlite3 connections can't be used from other threads, or shared with forked
+    children, so each thread of each process gets its own
+
+    Args:
+        path:
+            the database file (config.STATE_DB by default)
+        schema:
+            CREATE ... IF NOT EXISTS statements run the first time this thread uses them
+    Returns:
+        A sqlite3 Connection (see connect)
+    '''
+    path = path or config.STATE_DB
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        _local.pid, _local.connections, _local.schemas = pid, {}, set()
+    conn = _local.connections.get(path)
+    if conn is None:
+        conn = _local.connections[path] = connect(path)
+    if schema and (path, schema) not in _local.schemas:
+        conn.executescript(schema)
+        _local.schemas.add((path, schema))
+    return conn
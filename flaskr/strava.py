@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import os
+import threading
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from flaskr import config
+from flaskr.ratelimit import PRIORITY, RateLimiter
+
+
+# methods safe to send again after a 429
+RETRYABLE = ('GET', 'DELETE')
+
+
+class StravaClient:
+    ''' A client for the Strava API that keeps its connections alive between calls
+
+    Every call goes through one requests.Session, so the TCP and TLS handshakes
+    are only paid once per pooled connection, and every call has a timeout so a
+    hung socket can't tie up a worker
+
+    Properties:
+        base_url: str
+            the url paths are relative to
+        timeout: tuple
+            the (connect, read) timeouts in seconds
+        session: requests.Session
+            the pooled session used for every call
+        limiter: RateLimiter
+            reserves rate limit budget for calls to base_url (None to send calls unchecked)
+    '''
+
+    def __init__(self, base_url: str = None, timeout: tuple = None, pool_size: int = None,
+                 limiter: RateLimiter = None) -> None:
+        self.base_url = base_url or config.API_ENDPOINT
+        self.limiter = limiter
+        self.timeout = timeout or (config.STRAVA_CONNECT_TIMEOUT, config.STRAVA_READ_TIMEOUT)
+        pool_size = pool_size or config.STRAVA_POOL_SIZE
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method: str, path: str, access_token: str = None, **kwargs) -> requests.Response:
+        ''' Sends a request to the Strava API
+
+        Args:
+            method:
+                the HTTP method
+            path:
+                a path relative to base_url (e.g. /activities/1234) or an absolute url
+            access_token:
+                the athlete's access_token, sent as a bearer token
+            **kwargs:
+                passed on to requests (params, data, files, ...)
+        Returns:
+            The response
+        Raises:
+            RateLimitExceeded if the limiter has no budget for this call within its max_wait
+        '''
+        url = path if path.startswith('http') else f'{self.base_url}{path}'
+        headers = kwargs.pop('headers', None) or {}
+        if access_token:
+            headers['Authorization'] = f'Bearer {access_token}'
+        kwargs.setdefault('timeout', self.timeout)
+        limiter = self.limiter if url.startswith(self.base_url) else None
+        if limiter is None:
+            return self.session.request(method, url, headers=headers, **kwargs)
+        for attempt in range(2):
+            limiter.wait()
+            response = self.session.request(method, url, headers=headers, **kwargs)
+            limiter.update(response.headers, response.status_code)
+            # a consumed upload can't be sent again - callers see the 429, and later calls wait
+            if response.status_code != 429 or method not in RETRYABLE or attempt:
+                return response
+            logging.warning(f'{method} {path} was rate limited - retrying once budget frees up')
+
+    def get(self, path: str, access_token: str = None, **kwargs) -> requests.Response:
+        return self.request('GET', path, access_token, **kwargs)
+
+    def post(self, path: str, access_token: str = None, **kwargs) -> requests.Response:
+        return self.request('POST', path, access_token, **kwargs)
+
+    def delete(self, path: str, access_token: str = None, **kwargs) -> requests.Response:
+        return self.request('DELETE', path, access_token, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+# one client per process - pooled sockets must not be shared with forked children
+_clients = {}
+
+
+def get_client() -> StravaClient:
+    ''' Gets this process's StravaClient, creating it on first use
+
+    Returns:
+        The shared StravaClient
+    '''
+    pid = os.getpid()
+    client = _clients.get(pid)
+    if client is None:
+        # a forked child starts with its parent's client - leave that one to the parent
+        _clients.clear()
+        client = _clients[pid] = StravaClient(limiter=RateLimiter())
+        logging.info(f'created Strava client for process {pid}')
+    return client
+
+
+class AsyncStravaClient:
+    ''' An asyncio client for the Strava API
+
+    Calls made from many coroutines share one httpx connection pool, so one event
+    loop can wait on many athletes' requests at once instead of each job holding
+    an OS process while it waits. Use it as an async context manager so the pool
+    is closed with the loop that owns it
+
+    Properties:
+        base_url: str
+            the url paths are relative to
+        timeout: tuple
+            the (connect, read) timeouts in seconds
+        client: httpx.AsyncClient
+            the pooled client used for every call
+        limiter: RateLimiter
+            reserves rate limit budget for calls to base_url (None to send calls unchecked)
+    '''
+
+    def __init__(self, base_url: str = None, timeout: tuple = None, pool_size: int = None,
+                 transport: httpx.AsyncBaseTransport = None, limiter: RateLimiter = None) -> None:
+        self.base_url = base_url or config.API_ENDPOINT
+        self.limiter = limiter
+        self.timeout = timeout or (config.STRAVA_CONNECT_TIMEOUT, config.STRAVA_READ_TIMEOUT)
+        pool_size = pool_size or config.STRAVA_POOL_SIZE
+        connect, read = self.timeout
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            transport=transport)
+
+    async def request(self, method: str, path: str, access_token: str = None, **kwargs) -> httpx.Response:
+        ''' Sends a request to the Strava API
+
+        Args:
+            method:
+                the HTTP method
+            path:
+                a path relative to base_url (e.g. /activities/1234) or an absolute url
+            access_token:
+                the athlete's access_token, sent as a bearer token
+            **kwargs:
+                passed on to httpx (params, data, files, ...)
+        Returns:
+            The response
+        Raises:
+            RateLimitExceeded if the limiter has no budget for this call within its max_wait
+        '''
+        url = path if path.startswith('http') else f'{self.base_url}{path}'
+        headers = kwargs.pop('headers', None) or {}
+        if access_token:
+            headers['Authorization'] = f'Bearer {access_token}'
+        limiter = self.limiter if url.startswith(self.base_url) else None
+        if limiter is None:
+            return await self.client.request(method, url, headers=headers, **kwargs)
+        for attempt in range(2):
+            await limiter.wait_async()
+            response = await self.client.request(method, url, headers=headers, **kwargs)
+            await asyncio.to_thread(limiter.update, response.headers, response.status_code)
+            if response.status_code != 429 or method not in RETRYABLE or attempt:
+                return response
+            logging.warning(f'{method} {path} was rate limited - retrying once budget frees up')
+
+    async def get(self, path: str, access_token: str = None, **kwargs) -> httpx.Response:
+        return await self.request('GET', path, access_token, **kwargs)
+
+    async def post(self, path: str, access_token: str = None, **kwargs) -> httpx.Response:
+        return await self.request('POST', path, access_token, **kwargs)
+
+    async def delete(self, path: str, access_token: str = None, **kwargs) -> httpx.Response:
+        return await self.request('DELETE', path, access_token, **kwargs)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    async def __aenter__(self) -> 'AsyncStravaClient':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+class AsyncRunner:
+    ''' Runs coroutines on one background event loop that owns an AsyncStravaClient
+
+    Pipeline stages run on executor threads, so each one hands its Strava calls
+    to this loop and waits for the result - every job in the process shares the
+    loop's connection pool, and a job's concurrent calls (e.g. an activity and
+    its streams) are waited on together
+
+    Properties:
+        loop: asyncio.AbstractEventLoop
+            the event loop, running on its own daemon thread
+        client: AsyncStravaClient
+            the client coroutines run on this loop should use
+    '''
+
+    def __init__(self, client: AsyncStravaClient = None) -> None:
+        self.client = client or AsyncStravaClient(limiter=RateLimiter())
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='strava-async', daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine):
+        ''' Runs a coroutine on the loop, blocking the calling thread until it finishes
+
+        The caller's ratelimit.PRIORITY carries over to the coroutine
+
+        Returns:
+            The coroutine's result (its exception is raised)
+        '''
+        priority = PRIORITY.get()
+
+        async def with_priority():
+            PRIORITY.set(priority)
+            return await coroutine
+
+        return asyncio.run_coroutine_threadsafe(with_priority(), self.loop).result()
+
+    def close(self) -> None:
+        ''' Closes the client and stops the loop '''
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+# one runner per process - the loop's thread doesn't survive a fork
+_runners = {}
+_lock = threading.Lock()
+
+
+def get_runner() -> AsyncRunner:
+    ''' Gets this process's AsyncRunner, creating it on first use
+
+    Returns:
+        The shared AsyncRunner
+    '''
+    pid = os.getpid()
+    runner = _runners.get(pid)
+    if runner is None:
+        # pipeline threads may race to create it
+        with _lock:
+            runner = _runners.get(pid)
+            if runner is None:
+                _runners.clear()
+                runner = _runners[pid] = AsyncRunner()
+                logging.info(f'created async Strava runner for process {pid}')
+    return runner
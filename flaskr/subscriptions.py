@@ -1,25 +1,30 @@
 import json
 import logging
-from multiprocessing import Process
 import time
 
 from flask import Blueprint
 from flask import make_response
 from flask import request
-import requests
 
-from flaskr.activities import Activity
+from flaskr.activities import Activity, fetch_activity
 from flaskr.auth import SCOPE
+from flaskr.cache import ArtifactStore
+from flaskr.coalesce import EventCoalescer
+from flaskr.dedupe import SeenSet
 from flaskr.db import create_db_conn, get_athlete_scope, get_access_token
+from flaskr.journal import JobJournal
+from flaskr.pipeline import BROWSER, CPU, IO, StageFailed, get_pipeline
+from flaskr.scheduler import get_scheduler
+from flaskr.strava import get_client, get_runner
 
 from flaskr import config
 
 bp = Blueprint('subscriptions', __name__)
 
-SEEN_ACTIVITY_IDS = []
-
-# TODO add support for handling 429s
-# https://developers.strava.com/docs/rate-limits/
+# activities this app uploaded (or deleted) - their events need no work
+SEEN_ACTIVITIES = SeenSet()
+# webhook events not yet handled, kept across restarts
+JOURNAL = JobJournal()
 
 
 def get_existing_subscriptions() -> dict:
@@ -40,12 +45,11 @@ def get_existing_subscriptions() -> dict:
         ]
     '''
     try:
-        url = f'{config.API_ENDPOINT}/push_subscriptions'
         data = {
             'client_id': config.STRAVA_CLIENT_ID,
             'client_secret': config.STRAVA_CLIENT_SECRET
         }
-        response = requests.get(url=url, data=data)
+        response = get_client().get('/push_subscriptions', data=data)
         if response.ok:
             return response.json()
         else:
@@ -61,7 +65,6 @@ def get_subscription_id() -> int:
     ''' Gets the id of an available subscription (existing or new id) '''
     try:
         callback_url = config.SERVER_DOMAIN + '/subscribe'
-        url = f'{config.API_ENDPOINT}/push_subscriptions'
         data = {
             'client_id': config.STRAVA_CLIENT_ID,
             'client_secret': config.STRAVA_CLIENT_SECRET,
@@ -69,7 +72,7 @@ def get_subscription_id() -> int:
             'verify_token': config.VERIFY_TOKEN
         }
         logging.info(data)
-        response = requests.post(data=data, url=url)
+        response = get_client().post('/push_subscriptions', data=data)
         # TODO rather than sending a post everytime to Strava, why don't we store subscription information? is this nonsensical?
         # or should we call get existing subscriptions first?????
         logging.warning(response.json())
@@ -100,12 +103,11 @@ def delete_subscription(subscription_id: int) -> bool:
         Whether or not the subscription was deleted
     '''
     try:
-        url = f'{config.API_ENDPOINT}/push_subscriptions/{subscription_id}'
         data = {
             'client_id': config.STRAVA_CLIENT_ID,
             'client_secret': config.STRAVA_CLIENT_SECRET
         }
-        response = requests.delete(data=data, url=url)
+        response = get_client().delete(f'/push_subscriptions/{subscription_id}', data=data)
         if response.ok:
             return True
         else:
@@ -118,98 +120,272 @@ def delete_subscription(subscription_id: int) -> bool:
     return False
 
 
+def load_event(event: dict) -> Activity:
+    ''' The first stage of handling an event - finds the activity it is about, if it needs cadence data
+
+    Args:
+        event:
+            a webhook event https://developers.strava.com/docs/webhooks/
+    Returns:
+        The Activity to replace, or None if the event doesn't require any action
+    Raises:
+        StageFailed if the activity couldn't be fetched
+    '''
+    object_type = event['object_type']
+    object_id = event['object_id']
+    aspect_type = event['aspect_type']
+    owner_id = event['owner_id']
+    # TODO: determine if we need a new token for user - not sure if this is relevant
+    logging.info('NEW EVENT')
+    logging.info(event)
+    if object_type == 'athlete':
+        logging.info("Ignoring athlete update event")
+        return None
+    if not (object_type == 'activity' and aspect_type in ('create', 'update')):
+        logging.info("Event doesn't require updating")
+        return None
+    # checked before any Strava or Supabase call
+    if object_id in SEEN_ACTIVITIES:
+        logging.info(
+            'already saw this activity - should theoretically have cadence data')
+        return None
+    logging.info('this is an unseen activity!')
+    # bring this raised exception into get_access_token
+    supabase = create_db_conn()
+    athlete_scope, access_token = get_athlete_scope(
+        supabase, owner_id), get_access_token(supabase, owner_id)
+    if not access_token:
+        raise LookupError(
+            f'Cannot find access token for athlete {owner_id}')
+    if not athlete_scope or athlete_scope != SCOPE:
+        raise Exception(  # todo pick a better exception type
+            f'This athlete does not have proper scope authorization')
+    # the activity and its streams are fetched at the same time
+    runner = get_runner()
+    activity = runner.run(fetch_activity(runner.client, object_id, owner_id, access_token, supabase))
+    if activity is None:
+        raise StageFailed(f'load_event: error fetching activity {object_id}')
+    if not activity.requires_cadence_data():
+        logging.info("Event doesn't require updating")
+        return None
+    activity.event = event
+    return activity
+
+
+def fetch_streams(activity: Activity) -> Activity:
+    ''' Fetches the streams the replacement file is generated from, unless load_event already did '''
+    if activity.fetch_streams(config.UPLOAD_FILETYPE):
+        return activity
+    raise StageFailed('fetch_streams: error getting stream')
+
+
+def build_file(activity: Activity) -> tuple:
+    ''' Generates the replacement file
+
+    Returns:
+        (activity, file contents)
+    Raises:
+        StageFailed if the file couldn't be created
+    '''
+    data = activity.create_file(config.UPLOAD_FILETYPE)
+    if data:
+        return activity, data
+    raise StageFailed('build_file: error creating activity file')
+
+
+def delete_original(job: tuple) -> tuple:
+    ''' Deletes the original activity (in a browser - the API can't delete activities) '''
+    #
+    # KUDOS WILL BE DELETED
+    # IMAGES WILL BE DELETED
+    # DESC WILL BE DELETED
+    # VERY LITTLE WILL BE PRESERVED
+    activity, _ = job
+    if activity.delete_activity():
+        # late update events for it can be ignored
+        SEEN_ACTIVITIES.add(activity.obj['id'])
+        # the original can't be fetched again - a retry has to resume from the generated file
+        event = activity.event
+        event['checkpoint'] = {'activity': activity.obj, 'job_key': activity.artifact_job(config.UPLOAD_FILETYPE)}
+        if event.get('job_id') is not None:
+            JOURNAL.save(event)
+        return job
+    raise StageFailed('delete_original: error deleting old activity')
+
+
+def upload_replacement(job: tuple) -> int:
+    ''' Uploads the replacement file
+
+    Returns:
+        The id of the new activity
+    Raises:
+        StageFailed if the file couldn't be uploaded
+    '''
+    activity, data = job
+    new_activity_id = activity.upload_file(config.UPLOAD_FILETYPE, data)
+    if not new_activity_id:
+        raise StageFailed('upload_replacement: error uploading new activity')
+    logging.info('new activity id')
+    logging.info(new_activity_id)
+    SEEN_ACTIVITIES.add(new_activity_id)
+    return new_activity_id
+
+
+def resume_upload(event: dict) -> tuple:
+    ''' The first stage of retrying an event whose original activity was already deleted -
+        picks up the file generated before the delete, leaving only the upload
+
+    Args:
+        event:
+            a webhook event with the checkpoint delete_original left on it
+    Returns:
+        (activity, file contents)
+    Raises:
+        StageFailed if the file is no longer in the ArtifactStore
+    '''
+    checkpoint = event['checkpoint']
+    owner_id = event['owner_id']
+    logging.info(f'resuming upload of activity {event["object_id"]}')
+    supabase = create_db_conn()
+    access_token = get_access_token(supabase, owner_id)
+    if not access_token:
+        raise LookupError(
+            f'Cannot find access token for athlete {owner_id}')
+    activity = Activity(event['object_id'], owner_id, access_token, supabase, obj=checkpoint['activity'])
+    activity.event = event
+    data = ArtifactStore().get(checkpoint['job_key'])
+    if data is None:
+        raise StageFailed(f'resume_upload: the file replacing activity {event["object_id"]} is no longer cached')
+    return activity, data
+
+
+# the stages of handling an event, and the kind of executor each runs on
+EVENT_STAGES = [
+    (IO, load_event),
+    (IO, fetch_streams),
+    (CPU, build_file),
+    (BROWSER, delete_original),
+    (IO, upload_replacement)
+]
+# the stages of retrying an event whose original activity was deleted
+RESUME_STAGES = [
+    (IO, resume_upload),
+    (IO, upload_replacement)
+]
+
+
+def submit_event(event: dict) -> None:
+    ''' Claims a settled event's job and hands it to the pipeline, trying again later if the pipeline is full '''
+    job_id = event.get('job_id')
+    if job_id is not None and not JOURNAL.claim(job_id):
+        logging.info(f'job {job_id} is already claimed or finished')
+        return
+    stages = RESUME_STAGES if 'checkpoint' in event else EVENT_STAGES
+    job = get_pipeline().submit(stages, event)
+    if job is None:
+        if job_id is not None:
+            JOURNAL.release(job_id)
+        get_scheduler().schedule(time.time() + config.EVENT_RETRY_DELAY, submit_event, event)
+    elif job_id is not None:
+        job.add_done_callback(lambda job: finish_event(event, job))
+
+
+def finish_event(event: dict, job) -> None:
+    ''' Completes an event's job, or schedules its retry if a stage raised '''
+    error = job.exception()
+    if error is None:
+        JOURNAL.complete(event['job_id'])
+        return
+    retry_at = JOURNAL.fail(event['job_id'], repr(error))
+    if retry_at is not None:
+        get_scheduler().schedule(retry_at, submit_event, event)
+
+
+def merge_jobs(pending: dict, merged: dict) -> None:
+    ''' Folds the journaled job of a pending event into the job of the event it was merged into '''
+    if pending.get('job_id') is not None and merged.get('job_id') is not None:
+        JOURNAL.supersede(pending['job_id'], merged)
+
+
+def replay_jobs() -> int:
+    ''' Schedules the journaled jobs left unfinished by the last run of this app
+
+    Returns:
+        The number of jobs scheduled
+    '''
+    jobs = JOURNAL.replay()
+    for event, available_at in jobs:
+        get_scheduler().schedule(available_at, submit_event, event)
+    if jobs:
+        logging.info(f'replaying {len(jobs)} unfinished jobs')
+    return len(jobs)
+
+
+EVENT_COALESCER = EventCoalescer(submit_event, on_merge=merge_jobs)
+
+
+def schedule_event(event: dict) -> bool:
+    ''' Schedules an event to be handled once Strava has settled
+
+    Activities keep changing for a while after they're created (e.g. the
+    athlete editing the title), so events are handled config.EVENT_SETTLE_DELAY
+    seconds after their event_time instead of as soon as they arrive, and
+    events about an activity that is still pending are merged into one
+
+    Args:
+        event:
+            a webhook event https://developers.strava.com/docs/webhooks/
+    Returns:
+        Whether or not the event was scheduled (False if too many events are pending)
+    '''
+    scheduler = EVENT_COALESCER.scheduler
+    if len(scheduler) >= config.EVENT_MAX_PENDING:
+        logging.warning(f'{len(scheduler)} events are already pending')
+        return False
+    # 20 seconds was too short when the sleep for alert confirmation was 3 seconds - 30 should be conservative
+    due = event.get('event_time', time.time()) + config.EVENT_SETTLE_DELAY
+    # journaled before it's acknowledged, so a restart can't lose it
+    event['job_id'] = JOURNAL.append(event, due)
+    # a burst of updates to one activity becomes a single job
+    EVENT_COALESCER.add(event, due)
+    return True
+
+
 def handle_event(event: dict) -> str:
-    ''' Handles users' activity & profile updates and acts accordingly
+    ''' Handles users' activity & profile updates on the calling thread, right away
+    (subscribe schedules the same EVENT_STAGES on the job pipeline instead)
 
     Args:
         event:
-            TODO
+            a webhook event https://developers.strava.com/docs/webhooks/
 
     Returns:
         returns the body of the response to be sent back...... TODO
     '''
-    response = None
     try:
-        object_type = event['object_type']
-        object_id = event['object_id']
-        aspect_type = event['aspect_type']
-        owner_id = event['owner_id']
-        # TODO: determine if we need a new token for user - not sure if this is relevant
-        logging.info('NEW EVENT')
-        logging.info('NEW EVENT')
-        logging.info('NEW EVENT')
-        logging.info(event)
-        potentially_require_cadence_data = False
-        if object_type == 'activity' and aspect_type in ('create', 'update'):
-            # might not need to wait for updates - add activity id earlier maybe?- just being safe for now
-            logging.info('waiting for activity updates to finish')
-            # 20 was too short when the sleep for alert confirmation was 3 seconds- 30 should be conservative
-            time.sleep(30)
-            logging.info('seen activity ids')
-            logging.info(SEEN_ACTIVITY_IDS)
-            if object_id in SEEN_ACTIVITY_IDS:
-                logging.info(
-                    'already saw this activity - should theoretically have cadence data')
-                potentially_require_cadence_data = False
-            else:
-                logging.info('this is an unseen activity!')
-                potentially_require_cadence_data = True
-            if potentially_require_cadence_data:
-                # bring this raised exception into get_access_token
-                supabase = create_db_conn()
-                athlete_scope, access_token = get_athlete_scope(
-                    supabase, owner_id), get_access_token(supabase, owner_id)
-                if not access_token:
-                    raise LookupError(
-                        f'Cannot find access token for athlete {owner_id}')
-                if not athlete_scope or athlete_scope != SCOPE:
-                    raise Exception(  # todo pick a better exception type
-                        f'This athlete does not have proper scope authorization')
-                activity = Activity(object_id, owner_id,
-                                    access_token, supabase)
-                if activity.requires_cadence_data():
-
-                    #
-                    # KUDOS WILL BE DELETED
-                    # IMAGES WILL BE DELETED
-                    # DESC WILL BE DELETED
-                    # VERY LITTLE WILL BE PRESERVED
-
-                    new_activity_id = activity.replace_activity()
-                    logging.info('new activity id')
-                    logging.info(new_activity_id)
-                    logging.info('new activity id')
-                    if new_activity_id:
-                        response = {
-                            'status': 200,
-                            # could append upload id here, but not sure how accurate that'll be
-                            'body': 'activity successfully replaced'
-                        }
-                        logging.info('success replcing')
-                        SEEN_ACTIVITY_IDS.append(new_activity_id)
-                    else:
-                        response = {
-                            'status': 500,
-                            'body': 'error replacing activity'
-                        }
-                        logging.info('errorrorror replacing')
-                        # TODO change this ^ - look into what th expected response should be
-                        # maybe we want to store GPX so that we don't lose data - store with activity_id and athletE_id I guess?
-        if object_type == 'athlete':
+        value = event
+        for _, stage in EVENT_STAGES:
+            value = stage(value)
+            if value is None:
+                break
+        if value is not None:
             response = {
                 'status': 200,
                 # could append upload id here, but not sure how accurate that'll be
-                'body': "athlete update event doesn't require action"
+                'body': 'activity successfully replaced'
             }
-            logging.info("Ignoring athlete update event")
-        elif not potentially_require_cadence_data:  # delete aspect_type or other
+        else:
             response = {
                 'status': 200,
-                # could append upload id here, but not sure how accurate that'll be
-                'body': "activity doesn't require modification"
+                'body': "event doesn't require modification"
             }
-            logging.info("Event doesn't require updating")
-
+    except StageFailed as e:
+        logging.error(e)
+        # TODO maybe we want to store GPX so that we don't lose data - store with activity_id and athletE_id I guess?
+        response = {
+            'status': 500,
+            'body': 'error replacing activity'
+        }
     except Exception as e:
         logging.error('failed handling event:')
         logging.error(e)
@@ -242,9 +418,13 @@ def subscribe():
         logging.info('/subscribe POST')
         try:
             event = request.get_json()
-            Process(target=handle_event, args=(event,)).start()
-            body = 'handling new /subscribe POST event'
-            status_code = 200
+            if schedule_event(event):
+                body = 'handling new /subscribe POST event'
+                status_code = 200
+            else:
+                # full - Strava retries events that aren't acknowledged
+                body = 'too many events pending'
+                status_code = 503
         except Exception as e:
             logging.error('error handling /subscribe POST')
             logging.error(e)
@@ -9,6 +9,12 @@ def when_ready(server):
     pass
 
 
+def post_worker_init(worker):
+    # jobs are scheduled in the workers that run them - a job claimed by one
+    # worker is skipped by the others
+    subscriptions.replay_jobs()
+
+
 def on_exit(server):
     subscription_id = subscriptions.get_subscription_id()
     logging.info('getting current subscription id for deleting')
@@ -0,0 +1,51 @@
+import pytest
+
+from flaskr import config, subscriptions
+from flaskr.dedupe import SeenSet
+from flaskr.journal import JobJournal
+
+
+class Clock:
+    ''' A clock that only moves when a test moves it (or sleeps on it) '''
+
+    def __init__(self, now: float = 1_000_000.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture(autouse=True)
+def state_db(tmp_path, monkeypatch):
+    ''' Keeps every test's journal, seen ids and rate limits out of the real state database '''
+    path = str(tmp_path / 'state.sqlite3')
+    monkeypatch.setattr(config, 'STATE_DB', path)
+    monkeypatch.setattr(subscriptions, 'JOURNAL', JobJournal(path))
+    monkeypatch.setattr(subscriptions, 'SEEN_ACTIVITIES', SeenSet(path))
+    return path
+
+
+@pytest.fixture
+def stream():
+    size = 3
+    return {
+        'time': {'data': [0, 1, 86400], 'original_size': size},
+        'latlng': {'data': [[40.685516, -73.931366], [40.685524, -73.931297], [40.68553, -73.9312]], 'original_size': size},
+        'distance': {'data': [0.0, 5.9, 14.2], 'original_size': size},
+        'altitude': {'data': [20.2, 20.1, 19.8], 'original_size': size},
+        'heartrate': {'data': [105, 106, 107], 'original_size': size},
+        'cadence': {'data': [0, 88, 91], 'original_size': size},
+    }
+
+
+@pytest.fixture
+def activity():
+    return {'start_date': '2021-09-14T23:59:59Z', 'name': 'late & <windy> ride'}
@@ -0,0 +1,147 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import io
+import pickle
+
+import httpx
+import numpy as np
+import pytest
+
+from flaskr.activities import Activity, StreamSet, fetch_activity
+from flaskr.gpx import create_gpx, write_gpx
+from flaskr.strava import AsyncRunner, AsyncStravaClient, StravaClient
+
+
+@pytest.fixture
+def streams():
+    size = 120
+    rng = np.random.default_rng(16)
+    latlng = np.cumsum(rng.normal(0, 1e-4, (size, 2)), axis=0) + (40.68, -73.93)
+    return {
+        'time': {'data': list(range(size)), 'series_type': 'distance', 'original_size': size, 'resolution': 'high'},
+        'latlng': {'data': latlng.round(6).tolist(), 'series_type': 'distance', 'original_size': size, 'resolution': 'high'},
+        'distance': {'data': np.cumsum(rng.uniform(0, 10, size)).round(1).tolist(), 'series_type': 'distance', 'original_size': size, 'resolution': 'high'},
+        'altitude': {'data': rng.uniform(-2, 80, size).round(1).tolist(), 'series_type': 'distance', 'original_size': size, 'resolution': 'high'},
+        'heartrate': {'data': rng.integers(90, 180, size).tolist(), 'series_type': 'distance', 'original_size': size, 'resolution': 'high'},
+    }
+
+
+@pytest.fixture
+def activity():
+    return {'start_date': '2021-09-14T10:28:25Z', 'name': 'mornnning ride'}
+
+
+def test_stream_set_keyed_access(streams):
+    expected = copy.deepcopy(streams)
+    stream_set = StreamSet.from_json(streams)
+    assert set(stream_set) == set(expected)
+    assert 'cadence' not in stream_set
+    assert stream_set['latlng']['data'].shape == (120, 2)
+    assert stream_set['latlng']['data'][3][1] == expected['latlng']['data'][3][1]
+    assert stream_set['time']['original_size'] == 120
+    assert stream_set['heartrate']['data'].dtype == np.int16
+    assert stream_set.nbytes < 120 * 8 * 6
+
+
+def test_stream_set_keeps_channels_with_nulls(streams):
+    streams['watts'] = {'data': [None, 120, 130], 'original_size': 3}
+    stream_set = StreamSet.from_json(streams)
+    assert stream_set['watts']['data'] == [None, 120, 130]
+
+
+def test_stream_set_fills_null_floats(streams, activity):
+    streams['altitude']['data'][:3] = [None, None, 5.0]
+    streams['altitude']['data'][10] = None
+    streams['latlng']['data'][20] = [None, None]
+    streams['distance']['data'] = [None] * len(streams['distance']['data'])
+    expected = copy.deepcopy(streams)
+    stream_set = StreamSet.from_json(streams)
+    altitudes = stream_set.data('altitude')
+    assert altitudes[:3].tolist() == [5.0] * 3 and altitudes[10] == expected['altitude']['data'][9]
+    assert stream_set.data('latlng')[20].tolist() == expected['latlng']['data'][19]
+    # a channel without values is left out, so cadence falls back to latlng
+    assert 'distance' not in stream_set
+    output = io.BytesIO()
+    write_gpx(stream_set, activity, output)
+    assert b'nan' not in output.getvalue()
+
+
+def test_create_gpx_from_stream_set(streams, activity, tmp_path):
+    create_gpx(copy.deepcopy(streams), activity, str(tmp_path / 'json'), 'gpx')
+    create_gpx(StreamSet.from_json(streams), activity,
+               str(tmp_path / 'stream_set'), 'gpx')
+    expected = (tmp_path / 'json.gpx').read_bytes()
+    assert (tmp_path / 'stream_set.gpx').read_bytes() == expected
+
+
+class FakeResponse:
+    ok = True
+
+    def json(self):
+        return {'id': 1234}
+
+
+def test_upload_activity_from_memory(monkeypatch):
+    posted = {}
+
+    def fake_request(method, url, **kwargs):
+        posted.update(kwargs, method=method, url=url)
+        return FakeResponse()
+
+    client = StravaClient('https://strava.test')
+    monkeypatch.setattr(client.session, 'request', fake_request)
+    monkeypatch.setattr('flaskr.activities.get_client', lambda: client)
+    activity = Activity.__new__(Activity)
+    activity.access_token = 'token'
+    activity.obj = {'name': 'Morning Ride cc', 'description': '48x16',
+                    'trainer': False, 'commute': False}
+    buffer = io.BytesIO(b'<gpx/>')
+    assert activity.upload_activity('gpx', 'ex_id_1', buffer) == 1234
+    assert (posted['method'], posted['url']) == ('POST', 'https://strava.test/uploads')
+    assert posted['headers'] == {'Authorization': 'Bearer token'}
+    assert posted['files'] == {'file': ('ex_id_1.gpx', buffer)}
+    assert posted['params']['name'] == 'Morning Ride'
+
+
+def test_fetch_activity(streams, monkeypatch):
+    in_flight, most_in_flight = set(), []
+
+    async def handler(request):
+        in_flight.add(request.url.path)
+        most_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.discard(request.url.path)
+        activity_id = int(request.url.path.split('/')[2])
+        if activity_id == 3:
+            return httpx.Response(404, json={'message': 'Record Not Found'})
+        if request.url.path.endswith('/streams'):
+            if activity_id == 2:
+                return httpx.Response(500)
+            return httpx.Response(200, json=copy.deepcopy(streams))
+        return httpx.Response(200, json={'id': activity_id, 'description': '48x16'})
+
+    monkeypatch.setattr('flaskr.activities.get_client', lambda: pytest.fail('streams were fetched again'))
+    runner = AsyncRunner(AsyncStravaClient('https://strava.test', transport=httpx.MockTransport(handler)))
+    with ThreadPoolExecutor(3) as executor:
+        # pipeline threads handing their jobs to the one event loop
+        first, second, missing = executor.map(
+            lambda activity_id: runner.run(fetch_activity(runner.client, activity_id, 7, 'token')), (1, 2, 3))
+    runner.close()
+    # every activity and stream request was waited on at once
+    assert max(most_in_flight) == 6
+    assert first.obj['id'] == 1 and (first.chainring, first.cog) == (48, 16)
+    assert first.get_streams().data('latlng').shape == (120, 2)
+    # a failed streams request is left for get_streams to retry
+    assert second.obj['id'] == 2 and second._streams is None
+    assert missing is None
+
+
+def test_activity_pickles_without_supabase(streams, activity):
+    # as it's sent to the pipeline's CPU processes
+    original = Activity(1, 7, 'token', supabase=object(), obj={**activity, 'id': 1, 'description': '48x16'},
+                        streams=StreamSet.from_json(streams))
+    copied = pickle.loads(pickle.dumps(original))
+    assert copied.supabase is None and original.supabase is not None
+    assert (copied.obj, copied.chainring, copied.cog) == (original.obj, 48, 16)
+    assert np.array_equal(copied.get_streams().data('latlng'), original.get_streams().data('latlng'))
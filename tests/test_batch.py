@@ -0,0 +1,59 @@
+import os
+import shutil
+
+from lxml import etree
+import pytest
+
+from flaskr import create_app
+from flaskr.batch import add_cadence_to_gpx, find_gpx_files
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                           'clean', 'app', 'test-files', 'sort_gpx')
+GPXTPX = 'http://www.garmin.com/xmlschemas/TrackPointExtension/v1'
+
+
+@pytest.fixture
+def gpx_dir(tmp_path):
+    for name in ('20_mi_full_5.gpx', 'today.gpx'):
+        shutil.copy(os.path.join(FIXTURE_DIR, name), tmp_path)
+    return tmp_path
+
+
+def test_cadence_batch_command(gpx_dir):
+    runner = create_app({'TESTING': True}).test_cli_runner()
+    result = runner.invoke(
+        args=['cadence-batch', str(gpx_dir), '--gear', '48x16', '--workers', '2'])
+    assert result.exit_code == 0, result.output
+    assert '(0 failed)' in result.output
+    for name in ('20_mi_full_5', 'today'):
+        tree = etree.parse(str(gpx_dir / f'{name}.cadence.gpx'))
+        cadences = tree.findall(f'.//{{{GPXTPX}}}cad')
+        assert cadences and all(c.text.isnumeric() for c in cadences)
+    # outputs are never picked up as inputs
+    assert len(find_gpx_files((str(gpx_dir),))) == 2
+
+
+def test_cadence_batch_command_bad_gear(gpx_dir):
+    runner = create_app({'TESTING': True}).test_cli_runner()
+    result = runner.invoke(args=['cadence-batch', str(gpx_dir), '--gear', '48-16'])
+    assert result.exit_code != 0
+    assert '48x16' in result.output
+
+
+def test_failed_file_leaves_no_output(gpx_dir):
+    source = gpx_dir / 'today.gpx'
+    data = source.read_bytes()
+    # cut off partway through the track
+    source.write_bytes(data[:len(data) // 2])
+    path, output, _ = add_cadence_to_gpx(str(source), 48, 16)
+    assert output is None
+    assert sorted(os.listdir(gpx_dir)) == ['20_mi_full_5.gpx', 'today.gpx']
+
+
+def test_output_mode_follows_umask(gpx_dir):
+    umask = os.umask(0o022)
+    try:
+        _, output, _ = add_cadence_to_gpx(str(gpx_dir / 'today.gpx'), 48, 16)
+    finally:
+        os.umask(umask)
+    assert os.stat(output).st_mode & 0o777 == 0o644
@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+import pytest
+
+from flaskr import config
+from flaskr.activities import Activity, StreamSet
+from flaskr.cache import ArtifactStore, streams_digest
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ArtifactStore(str(tmp_path / 'artifacts'), max_bytes=1000)
+
+
+def job(**fields):
+    return ArtifactStore.job_key(**{'activity_id': 1, 'chainring': 48, 'cog': 16, 'wheel_diameter': 622,
+                                    'tire_width': 25, 'filetype': 'gpx.gz', **fields})
+
+
+def test_job_key():
+    assert job() == job()
+    assert len({job(), job(cog=17), job(tire_width=28), job(filetype='fit'), job(activity_id=2)}) == 5
+
+
+def test_streams_digest():
+    streams = StreamSet.from_json({'time': {'data': [0, 1, 2]}, 'latlng': {'data': [[1.0, 2.0], [1.5, 2.5], [2.0, 3.0]]}})
+    digest = streams_digest(streams)
+    assert digest == streams_digest({'time': {'data': np.array([0, 1, 2], dtype=np.int32)},
+                                     'latlng': {'data': np.array([[1.0, 2.0], [1.5, 2.5], [2.0, 3.0]])}})
+    streams['time'] = {'data': [0, 1, 3]}
+    assert streams_digest(streams) != digest
+
+
+def test_put_and_get(store):
+    assert store.get(job()) is None
+    key = store.put(job(), 'digest', b'a' * 100)
+    assert key == ArtifactStore.artifact_key(job(), 'digest')
+    assert store.get(job()) == b'a' * 100
+    # the ref follows the latest streams the job was generated from
+    store.put(job(), 'newer digest', b'b' * 100)
+    assert store.get(job()) == b'b' * 100
+    # looked up by content, not just the job
+    assert store.get(job(), 'digest') == b'a' * 100
+    assert store.get(job(), 'edited digest') is None
+    assert store.get(job(cog=17)) is None
+
+
+def test_least_recently_used_eviction(store):
+    def path(ii):
+        key = ArtifactStore.artifact_key(job(activity_id=ii), 'digest')
+        return os.path.join(store._artifacts, key[:2], key)
+
+    for ii in range(4):
+        store.put(job(activity_id=ii), 'digest', bytes(300))
+        # mtime resolution can be coarse - make the order explicit
+        os.utime(path(ii), (100 * ii, 100 * ii))
+    assert [os.path.exists(path(ii)) for ii in range(4)] == [False, True, True, True]
+    # reading an artifact makes it the most recently used
+    assert store.get(job(activity_id=1))
+    store.put(job(activity_id=4), 'digest', bytes(300))
+    assert [os.path.exists(path(ii)) for ii in range(5)] == [False, True, False, True, True]
+    assert store.get(job(activity_id=2)) is None
+    assert len(os.listdir(store._refs)) == 3
+
+
+def test_disabled_or_oversized(store, tmp_path):
+    assert store.put(job(), 'digest', bytes(1001)) is None
+    disabled = ArtifactStore(str(tmp_path / 'disabled'), max_bytes=0)
+    assert disabled.put(job(), 'digest', b'data') is None
+    assert disabled.get(job()) is None
+
+
+def test_replace_activity_reuses_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'ARTIFACT_DIR', str(tmp_path))
+    size = 60
+    calls = {'generate_stream': 0, 'upload_activity': []}
+
+    def get_streams():
+        return StreamSet.from_json({
+            'time': {'data': list(range(size)), 'original_size': size},
+            'latlng': {'data': [[40.68 + ii * 1e-4, -73.93] for ii in range(size)], 'original_size': size},
+        })
+
+    def generate_stream(streams):
+        calls['generate_stream'] += 1
+        streams['cadence'] = {'data': [90] * len(streams['time']['data']), 'original_size': size}
+        return streams
+
+    def upload_activity(data_type, external_id, file):
+        calls['upload_activity'].append(file.read())
+        return None
+
+    activity = Activity.__new__(Activity)
+    activity.obj = {'id': 1234, 'start_date': '2021-09-14T10:28:25Z', 'name': 'ride'}
+    activity.chainring, activity.cog, activity.wheel_diameter, activity.tire_width = 48, 16, 622, 25
+    monkeypatch.setattr(activity, 'get_streams', get_streams)
+    monkeypatch.setattr(activity, 'generate_stream', generate_stream)
+    monkeypatch.setattr(activity, 'delete_activity', lambda: True)
+    monkeypatch.setattr(activity, 'upload_activity', upload_activity)
+    # the upload fails both times, and the retry reuses the generated file
+    assert activity.replace_activity() is None
+    assert activity.replace_activity() is None
+    assert calls['generate_stream'] == 1
+    first, retry = calls['upload_activity']
+    assert first and retry == first
+    # the athlete crops the activity - its file is generated again
+    size = 30
+    assert activity.replace_activity() is None
+    assert calls['generate_stream'] == 2
+    assert calls['upload_activity'][2] != first
@@ -0,0 +1,158 @@
+import numpy as np
+import pytest
+
+from flaskr.cadence import (CadenceQuantile, CadenceSmoother, generate_cadence_array, generate_cadence_chunks,
+                            generate_cadence_data, latlng_distances, percentile_cutoff, smooth_cadence)
+
+
+@pytest.fixture
+def distances():
+    ''' A noisy distance stream, including GPS jitter that moves backwards '''
+    rng = np.random.default_rng(48)
+    steps = rng.normal(8.5, 3, 5000)
+    return list(np.cumsum(steps))
+
+
+@pytest.mark.parametrize('chainring,cog,wheel_diameter,tire_width', [
+    (48, 16, 622, 25),
+    (46, 17, 622, 28),
+    (44, 15, 559, 50),
+])
+def test_cadence_array_parity(distances, chainring, cog, wheel_diameter, tire_width):
+    expected = generate_cadence_data(
+        distances, chainring, cog, wheel_diameter, tire_width)
+    actual = generate_cadence_array(
+        distances, chainring, cog, wheel_diameter, tire_width)
+    assert actual.dtype == np.int32
+    assert actual.tolist() == expected
+
+
+def test_cadence_array_empty():
+    assert generate_cadence_array([], 48, 16).tolist() == []
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096, 10000])
+def test_cadence_chunks_match_array(distances, chunk_size):
+    expected = generate_cadence_array(distances, 48, 16)
+    chunks = list(generate_cadence_chunks(
+        iter(distances), 48, 16, chunk_size=chunk_size))
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+    assert np.concatenate(chunks).tolist() == expected.tolist()
+
+
+def test_cadence_chunks_empty():
+    assert list(generate_cadence_chunks([], 48, 16)) == []
+
+
+def test_smooth_cadence_rejects_spikes_and_clamps():
+    cadences = [90] * 10 + [400] + [90] * 10 + [-5]
+    smoothed = smooth_cadence(cadences, window=3,
+                              spike_threshold=40, max_cadence=200)
+    assert smoothed.tolist() == [90] * 22
+    clamped = smooth_cadence(cadences, window=1, max_cadence=200)
+    assert clamped.tolist() == [90] * 10 + [200] + [90] * 10 + [0]
+
+
+def test_rejected_spike_leaves_no_bump():
+    # (200 - 60) / 3 is over the threshold - a reference that averaged in the
+    # spike would let it into the next few values
+    smoothed = smooth_cadence([60] * 6 + [250] + [60] * 6, window=3,
+                              spike_threshold=40, max_cadence=200)
+    assert smoothed.tolist() == [60] * 13
+
+
+def test_step_up_is_followed():
+    smoothed = smooth_cadence([0] * 5 + [90] * 20, window=3,
+                              spike_threshold=40, max_cadence=200)
+    # the first two values of the step are taken for spikes, then it's accepted
+    assert smoothed.tolist() == [0] * 7 + [30, 60] + [90] * 16
+
+
+def test_step_down_is_followed():
+    smoothed = smooth_cadence([90] * 20 + [0] * 5, window=3,
+                              spike_threshold=40, max_cadence=200)
+    assert smoothed.tolist() == [90] * 22 + [60, 30, 0]
+
+
+def test_smooth_cadence_rolling_mean():
+    smoothed = smooth_cadence([0, 30, 60, 90, 120], window=3)
+    assert smoothed.tolist() == [0, 15, 30, 60, 90]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 333])
+def test_smoother_chunks_match_full(distances, chunk_size):
+    cadences = generate_cadence_array(distances, 48, 16)
+    expected = smooth_cadence(cadences, window=8, spike_threshold=25,
+                              max_cadence=150)
+    smoother = CadenceSmoother(8, 25, 0, 150)
+    chunks = [smoother.update(cadences[ii:ii + chunk_size])
+              for ii in range(0, len(cadences), chunk_size)]
+    assert np.concatenate(chunks).tolist() == expected.tolist()
+
+
+def test_cadence_array_time_deltas(distances):
+    untimed = generate_cadence_array(distances, 48, 16)
+    seconds = list(range(len(distances)))
+    assert generate_cadence_array(
+        distances, 48, 16, times=seconds).tolist() == untimed.tolist()
+
+    # smart recording - same 8 m/s ride sampled with irregular gaps
+    times = np.cumsum([1, 1, 4, 8, 1, 2, 5, 3])
+    steady = generate_cadence_array(times * 8.0, 48, 16, times=times)
+    assert len(set(steady.tolist())) == 1
+    assert steady[0] == generate_cadence_array([8.0], 48, 16)[0]
+
+
+def test_cadence_chunks_time_deltas():
+    times = np.cumsum(np.random.default_rng(1).integers(1, 9, 1000))
+    distances = times * 7.5
+    expected = generate_cadence_array(distances, 48, 16, times=times)
+    chunks = generate_cadence_chunks(
+        iter(distances), 48, 16, chunk_size=64, times=iter(times))
+    assert np.concatenate(list(chunks)).tolist() == expected.tolist()
+
+
+def test_latlng_distances():
+    boston = (42.3601, -71.0589)
+    new_york = (40.7128, -74.0060)
+    distances = latlng_distances([boston, new_york, new_york, boston])
+    assert distances[0] == 0
+    assert int(distances[1]) == 306108
+    assert distances[2] == distances[1]
+    assert int(distances[3] - distances[2]) == 306108
+
+
+def test_latlng_distances_chunks():
+    rng = np.random.default_rng(2)
+    latlng = np.cumsum(rng.normal(0, 1e-4, (1000, 2)), axis=0) + (40.68, -73.93)
+    expected = latlng_distances(latlng)
+    first = latlng_distances(latlng[:400])
+    rest = latlng_distances(latlng[400:], previous=latlng[399], offset=first[-1])
+    assert np.allclose(np.concatenate((first, rest)), expected)
+
+
+def test_percentile_cutoff_matches_sort(distances):
+    cadences = generate_cadence_array(distances, 48, 16)
+    for percentile in (0, 0.5, 0.96, 1):
+        expected = sorted(cadences)[min(int(len(cadences) * percentile), len(cadences) - 1)]
+        assert percentile_cutoff(cadences, percentile) == expected
+    assert percentile_cutoff([], 0.96) is None
+
+
+def test_streaming_quantile_matches_selection(distances):
+    cadences = np.maximum(generate_cadence_array(distances, 48, 16), 0)
+    quantile = CadenceQuantile()
+    for ii in range(0, len(cadences), 100):
+        quantile.update(cadences[ii:ii + 100])
+    for percentile in (0.1, 0.5, 0.96, 0.999):
+        assert quantile.quantile(percentile) == percentile_cutoff(cadences, percentile)
+
+
+def test_smooth_cadence_percentile_cap(distances):
+    cadences = generate_cadence_array(distances, 48, 16)
+    cutoff = percentile_cutoff(np.maximum(cadences, 0), 0.96)
+    capped = smooth_cadence(cadences, window=1, cutoff_percentile=0.96)
+    assert capped.max() == cutoff
+    # a single chunk through the streaming smoother gives the same cap
+    streamed = CadenceSmoother(1, cutoff_percentile=0.96).update(cadences)
+    assert streamed.tolist() == capped.tolist()
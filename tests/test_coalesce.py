@@ -0,0 +1,50 @@
+import threading
+import time
+
+from flaskr.coalesce import EventCoalescer, merge_events
+from flaskr.scheduler import DelayedScheduler
+
+
+def event(aspect_type: str, object_id: int = 1, **updates) -> dict:
+    return {'object_type': 'activity', 'object_id': object_id, 'aspect_type': aspect_type, 'owner_id': 2,
+            'updates': updates, 'event_time': time.time()}
+
+
+def test_merge_events():
+    merged = merge_events(event('create'), event('update', title='Messy'))
+    merged = merge_events(merged, event('update', title='Morning Ride', type='Ride'))
+    assert merged['aspect_type'] == 'create'
+    assert merged['updates'] == {'title': 'Morning Ride', 'type': 'Ride'}
+    assert merge_events(merged, event('delete'))['aspect_type'] == 'delete'
+    assert 'updates' not in merge_events({'aspect_type': 'update'}, {'aspect_type': 'update'})
+
+
+def test_burst_fires_one_job():
+    scheduler = DelayedScheduler()
+    fired = []
+    done = threading.Event()
+    coalescer = EventCoalescer(lambda event: fired.append(event) or done.set(), window=0.2, scheduler=scheduler)
+    now = time.time()
+    assert not coalescer.add(event('create'), now + 0.05)
+    assert coalescer.add(event('update', title='Morning Ride'), now + 0.1)
+    assert not coalescer.add(event('create', object_id=3), now + 0.05)
+    # one pending call per activity
+    assert len(scheduler) == 2
+    assert done.wait(5)
+    time.sleep(0.15)
+    scheduler.shutdown()
+    assert [(e['object_id'], e['aspect_type'], e['updates']) for e in fired] == [
+        (3, 'create', {}), (1, 'create', {'title': 'Morning Ride'})]
+
+
+def test_window_caps_delay():
+    scheduler = DelayedScheduler(clock=lambda: 0)
+    coalescer = EventCoalescer(print, window=10, scheduler=scheduler)
+    coalescer.add(event('create'), 100)
+    coalescer.add(event('update'), 105)
+    assert coalescer._pending[(2, 1)][2] == 105
+    # later events can't push the job past the first due time + window
+    coalescer.add(event('update'), 200)
+    assert coalescer._pending[(2, 1)][2] == 110
+    assert len(scheduler) == 1
+    scheduler.shutdown()
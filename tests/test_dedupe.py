@@ -0,0 +1,46 @@
+import pytest
+
+from flaskr import subscriptions
+from flaskr.dedupe import SeenSet
+
+
+@pytest.fixture
+def seen(tmp_path, clock):
+    return SeenSet(str(tmp_path / 'state.sqlite3'), ttl=60, clock=clock)
+
+
+def test_add_and_expire(seen, clock):
+    assert 1 not in seen
+    assert seen.add(1)
+    assert not seen.add(1)
+    assert 1 in seen and 2 not in seen
+    clock.now += 61
+    assert 1 not in seen
+    assert len(seen) == 0
+    # an expired id counts as new
+    assert seen.add(1)
+
+
+def test_shared_between_instances(seen, clock):
+    other = SeenSet(seen.path, clock=clock)
+    seen.add(1234)
+    assert 1234 in other
+
+
+def test_prune(seen, clock):
+    seen.max_size = 2
+    for id in range(5):
+        seen.add(id)
+        clock.now += 1
+    clock.now += 56
+    # ids 0 and 1 have expired, and 2 is dropped to fit max_size
+    assert seen.prune() == 3
+    assert [id in seen for id in range(5)] == [False, False, False, True, True]
+
+
+def test_seen_activity_skips_api_calls(seen, monkeypatch):
+    monkeypatch.setattr(subscriptions, 'SEEN_ACTIVITIES', seen)
+    monkeypatch.setattr(subscriptions, 'create_db_conn', lambda: pytest.fail('looked up a seen activity'))
+    seen.add(1234)
+    event = {'object_type': 'activity', 'object_id': 1234, 'aspect_type': 'create', 'owner_id': 2}
+    assert subscriptions.load_event(event) is None
@@ -0,0 +1,83 @@
+import gzip
+import io
+import struct
+
+from flaskr.activities import StreamSet
+from flaskr.fit import FIT_EPOCH, SEMICIRCLES, create_fit, crc16, write_fit
+
+
+def read_messages(data: bytes) -> list:
+    ''' Decodes the data records of a FIT file into (global number, {field number: value}) pairs '''
+    header_size, _, _, data_size, signature = struct.unpack_from('<BBHI4s', data)
+    assert signature == b'.FIT'
+    assert len(data) == header_size + data_size + 2
+    definitions, messages = {}, []
+    offset = header_size
+    while offset < header_size + data_size:
+        record_header = data[offset]
+        offset += 1
+        local_type = record_header & 0x0F
+        if record_header & 0x40:
+            global_number, count = struct.unpack_from('<HB', data, offset + 2)
+            offset += 5
+            fields = [struct.unpack_from('<BBB', data, offset + 3 * ii) for ii in range(count)]
+            offset += 3 * count
+            formats = {1: 'B', 2: 'H', 4: 'I'}
+            layout = '<' + ''.join(
+                formats[size].lower() if base_type == 0x85 else formats[size] for _, size, base_type in fields)
+            definitions[local_type] = (global_number, [number for number, _, _ in fields], struct.Struct(layout))
+        else:
+            global_number, numbers, layout = definitions[local_type]
+            messages.append((global_number, dict(zip(numbers, layout.unpack_from(data, offset)))))
+            offset += layout.size
+    return messages
+
+
+def test_write_fit(stream, activity):
+    output = io.BytesIO()
+    write_fit(stream, activity, output)
+    data = output.getvalue()
+    assert crc16(data[:12]) == struct.unpack_from('<H', data, 12)[0]
+    # the checksum of a file that ends with its own checksum is 0
+    assert crc16(data) == 0
+
+    messages = read_messages(data)
+    assert [number for number, _ in messages] == [0, 21, 20, 20, 20, 21, 19, 18, 34]
+    start = 1631663999 - FIT_EPOCH
+    records = [fields for number, fields in messages if number == 20]
+    assert [r[253] - start for r in records] == [0, 1, 86400]
+    assert records[1][0] == round(40.685524 * SEMICIRCLES)
+    assert records[1][1] == round(-73.931297 * SEMICIRCLES)
+    assert [r[2] for r in records] == [2601, 2600, 2599]
+    assert [r[3] for r in records] == [105, 106, 107]
+    assert [r[4] for r in records] == [0, 88, 91]
+    assert [r[5] for r in records] == [0, 590, 1420]
+    session = messages[7][1]
+    assert session[7] == 86400 * 1000
+    assert session[9] == 1420
+    # zero cadence is left out of the average
+    assert (session[18], session[19]) == (90, 91)
+
+
+def test_write_fit_optional_streams(stream, activity):
+    for key in ('distance', 'altitude', 'heartrate', 'cadence'):
+        del stream[key]
+    output = io.BytesIO()
+    write_fit(stream, activity, output)
+    records = [fields for number, fields in read_messages(output.getvalue()) if number == 20]
+    assert len(records) == 3
+    # distance falls back to the latlng stream
+    assert sorted(records[0]) == [0, 1, 5, 253]
+    assert 0 < records[2][5] < 2000
+
+
+def test_create_fit(stream, activity, tmp_path):
+    buffer = io.BytesIO()
+    assert create_fit(StreamSet.from_json(dict(stream)), activity, buffer)
+    assert create_fit(stream, activity, str(tmp_path / 'ride'))
+    assert buffer.getvalue() == (tmp_path / 'ride.fit').read_bytes()
+
+    compressed = io.BytesIO()
+    assert create_fit(stream, activity, compressed, 'fit.gz')
+    assert gzip.decompress(compressed.getvalue()) == buffer.getvalue()
+    assert create_fit(stream, activity, io.BytesIO(), 'tcx') is False
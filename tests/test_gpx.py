@@ -0,0 +1,223 @@
+from datetime import datetime, timedelta
+import gzip
+import io
+import tarfile
+
+from lxml import etree
+
+from flaskr.gpx import GPXTPX, TimestampFormatter, create_gpx, format_numbers, inject_cadence, write_gpx
+
+GPX = 'http://www.topografix.com/GPX/1/1'
+NAMESPACES = {'gpx': GPX, 'gpxtpx': GPXTPX}
+
+
+def parse(stream, activity):
+    output = io.BytesIO()
+    write_gpx(stream, activity, output)
+    return etree.fromstring(output.getvalue())
+
+
+def test_write_gpx_structure(stream, activity):
+    gpx = parse(stream, activity)
+    assert gpx.get('version') == '1.1'
+    assert gpx.findtext('gpx:metadata/gpx:time', namespaces=NAMESPACES) == activity['start_date']
+    assert gpx.findtext('gpx:trk/gpx:name', namespaces=NAMESPACES) == activity['name']
+    trkpts = gpx.findall('gpx:trk/gpx:trkseg/gpx:trkpt', namespaces=NAMESPACES)
+    assert [(p.get('lat'), p.get('lon')) for p in trkpts][1] == ('40.685524', '-73.931297')
+    assert [p.findtext(f'{{{GPX}}}time') for p in trkpts] == [
+        '2021-09-14T23:59:59Z', '2021-09-15T00:00:00Z', '2021-09-15T23:59:59Z']
+    assert [p.findtext(f'{{{GPX}}}ele') for p in trkpts] == ['20.2', '20.1', '19.8']
+    extension = f'{{{GPX}}}extensions/{{{GPXTPX}}}TrackPointExtension'
+    assert [p.findtext(f'{extension}/{{{GPXTPX}}}hr') for p in trkpts] == ['105', '106', '107']
+    assert [p.findtext(f'{extension}/{{{GPXTPX}}}cad') for p in trkpts] == ['0', '88', '91']
+
+
+def test_write_gpx_optional_streams(stream, activity):
+    for key in ('altitude', 'heartrate', 'cadence'):
+        del stream[key]
+    trkpts = parse(stream, activity).findall(
+        'gpx:trk/gpx:trkseg/gpx:trkpt', namespaces=NAMESPACES)
+    assert len(trkpts) == 3
+    assert all(p.find(f'{{{GPX}}}ele') is None for p in trkpts)
+    assert all(len(p.find(f'{{{GPX}}}extensions/{{{GPXTPX}}}TrackPointExtension')) == 0 for p in trkpts)
+
+
+def test_create_gpx_in_memory(stream, activity, tmp_path):
+    buffer = io.BytesIO()
+    assert create_gpx(stream, activity, buffer, 'gpx')
+    assert create_gpx(stream, activity, str(tmp_path / 'ride'), 'gpx')
+    assert buffer.getvalue() == (tmp_path / 'ride.gpx').read_bytes()
+
+    targz = io.BytesIO()
+    assert create_gpx(stream, activity, targz, 'tar.gz')
+    targz.seek(0)
+    with tarfile.open(fileobj=targz, mode='r:gz') as tar:
+        assert tar.extractfile('activity.gpx').read() == buffer.getvalue()
+
+
+def test_create_gpx_invalid_filetype(stream, activity):
+    assert create_gpx(stream, activity, io.BytesIO(), 'tcx') is False
+
+
+def test_create_gpx_gzip(stream, activity, tmp_path):
+    gpx = io.BytesIO()
+    assert create_gpx(stream, activity, gpx, 'gpx')
+    buffer = io.BytesIO()
+    assert create_gpx(stream, activity, buffer, 'gpx.gz')
+    assert gzip.decompress(buffer.getvalue()) == gpx.getvalue()
+    assert create_gpx(stream, activity, str(tmp_path / 'ride'), 'gpx.gz')
+    assert gzip.decompress((tmp_path / 'ride.gpx.gz').read_bytes()) == gpx.getvalue()
+
+
+def test_format_numbers():
+    values = [40.6855164999, -73.93, 10.0, 0.00001, 19.96]
+    assert format_numbers(values) == [str(value) for value in values]
+    assert format_numbers(values, 7) == ['40.6855165', '-73.93', '10', '0.00001', '19.96']
+    assert format_numbers(values, 1) == ['40.7', '-73.9', '10', '0', '20']
+    assert format_numbers([10.4, 19.6], 0) == ['10', '20']
+
+
+def test_timestamp_formatter():
+    start = datetime(2020, 2, 28, 23, 59, 58)
+    timestamp = TimestampFormatter(start).format
+    for seconds in [0, 1, 2, 59, 3600, 86400, 86401, 86400 * 365]:
+        assert timestamp(seconds) == (start + timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def test_write_gpx_compact(stream, activity):
+    stream['latlng']['data'][0] = [40.68551649, -73.93136651]
+    output = io.BytesIO()
+    write_gpx(stream, activity, output, coordinate_precision=7, elevation_precision=0, pretty_print=False)
+    assert b'\n  ' not in output.getvalue()
+    gpx = etree.fromstring(output.getvalue())
+    trkpts = gpx.findall('gpx:trk/gpx:trkseg/gpx:trkpt', namespaces=NAMESPACES)
+    assert (trkpts[0].get('lat'), trkpts[0].get('lon')) == ('40.6855165', '-73.9313665')
+    assert [p.findtext(f'{{{GPX}}}ele') for p in trkpts] == ['20', '20', '20']
+    assert trkpts[2].findtext(f'{{{GPX}}}time') == '2021-09-15T23:59:59Z'
+
+
+SOURCE = f'''<?xml version="1.0" encoding="UTF-8"?>
+<gpx xmlns="{GPX}" xmlns:gpxtpx="{GPXTPX}" xmlns:device="urn:device" creator="Head Unit" version="1.1">
+ <metadata>
+  <time>2021-09-14T10:00:00Z</time>
+  <extensions><device:serial>1234</device:serial></extensions>
+ </metadata>
+ <trk>
+  <name>Morning &amp; Ride</name>
+  <trkseg>
+   <trkpt lat="40.685516" lon="-73.931366">
+    <time>2021-09-14T10:00:00Z</time>
+    <extensions>
+     <gpxtpx:TrackPointExtension>
+      <gpxtpx:hr>105</gpxtpx:hr>
+      <gpxtpx:Extensions><device:power>200</device:power></gpxtpx:Extensions>
+     </gpxtpx:TrackPointExtension>
+     <device:battery>80</device:battery>
+    </extensions>
+   </trkpt>
+   <trkpt lat="40.685616" lon="-73.931366">
+    <time>2021-09-14T10:00:01Z</time>
+   </trkpt>
+   <trkpt lat="40.685716" lon="-73.931366">
+    <time>2021-09-14T10:00:03Z</time>
+    <extensions><gpxtpx:TrackPointExtension><gpxtpx:cad>77</gpxtpx:cad></gpxtpx:TrackPointExtension></extensions>
+   </trkpt>
+   <trkpt lat="40.685816" lon="-73.931366">
+    <time>2021-09-14T10:00:04Z</time>
+   </trkpt>
+  </trkseg>
+ </trk>
+</gpx>
+'''.encode()
+
+
+def strip_cadence(document: bytes, keep: int = None) -> bytes:
+    ''' Removes the gpxtpx:cad elements (and any extensions only holding one) for comparison '''
+    tree = etree.fromstring(document)
+    for cad in tree.findall('.//gpxtpx:cad', namespaces=NAMESPACES):
+        if cad.text == str(keep):
+            continue
+        parent = cad.getparent()
+        parent.remove(cad)
+        while len(parent) == 0 and parent.tag != f'{{{GPX}}}trkpt':
+            parent, child = parent.getparent(), parent
+            parent.remove(child)
+    return etree.tostring(tree, method='c14n')
+
+
+def test_inject_cadence_passes_everything_through():
+    output = io.BytesIO()
+    assert inject_cadence(io.BytesIO(SOURCE), output, 48, 16) == 4
+    document = output.getvalue()
+    trkpts = etree.fromstring(document).findall('gpx:trk/gpx:trkseg/gpx:trkpt', namespaces=NAMESPACES)
+    cadences = [p.findtext('gpx:extensions/gpxtpx:TrackPointExtension/gpxtpx:cad', namespaces=NAMESPACES)
+                for p in trkpts]
+    # ~11 m/s at 48x16 - the recorded cadence is kept
+    assert cadences == ['0', '105', '77', '105']
+    extension = trkpts[0].find('gpx:extensions/gpxtpx:TrackPointExtension', namespaces=NAMESPACES)
+    assert [etree.QName(child).localname for child in extension] == ['hr', 'cad', 'Extensions']
+    assert b'<trkpt xmlns' not in document
+    source = etree.fromstring(SOURCE)
+    for trkpt in source.iter(f'{{{GPX}}}trkpt'):
+        # whitespace only changes where elements were added
+        trkpt.text = trkpt[0].tail = None
+    result = etree.fromstring(strip_cadence(document, keep=77))
+    for trkpt in result.iter(f'{{{GPX}}}trkpt'):
+        trkpt.text = trkpt[0].tail = None
+    assert etree.tostring(result, method='c14n') == etree.tostring(source, method='c14n')
+
+
+def test_inject_cadence_chunks(tmp_path):
+    expected = io.BytesIO()
+    inject_cadence(io.BytesIO(SOURCE), expected, 48, 16)
+    for chunk_size in (1, 3):
+        output = io.BytesIO()
+        inject_cadence(io.BytesIO(SOURCE), output, 48, 16, chunk_size=chunk_size)
+        assert output.getvalue() == expected.getvalue()
+    source = tmp_path / 'ride.gpx'
+    source.write_bytes(SOURCE)
+    assert inject_cadence(str(source), str(tmp_path / 'out.gpx'), 48, 16) == 4
+    assert (tmp_path / 'out.gpx').read_bytes() == expected.getvalue()
+
+
+def test_inject_cadence_declares_namespace_once():
+    source = SOURCE.replace(f' xmlns:gpxtpx="{GPXTPX}"'.encode(), b'').replace(
+        b'<trkseg>', f'<trkseg xmlns:gpxtpx="{GPXTPX}">'.encode(), 1)
+    plain = etree.fromstring(source)
+    for trkpt in plain.iter(f'{{{GPX}}}trkpt'):
+        for extensions in trkpt.findall(f'{{{GPX}}}extensions'):
+            trkpt.remove(extensions)
+    source = etree.tostring(plain)
+    output = io.BytesIO()
+    inject_cadence(io.BytesIO(source), output, 48, 16)
+    document = output.getvalue()
+    assert document.count(f'xmlns:gpxtpx="{GPXTPX}"'.encode()) == 1
+    assert len(etree.fromstring(document).findall('.//gpxtpx:cad', namespaces=NAMESPACES)) == 4
+
+
+def test_inject_cadence_keeps_comments():
+    source = b'''<?xml version="1.0" encoding="UTF-8"?>
+<!-- exported -->
+<?xml-stylesheet href="ride.xsl"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1">
+ <!-- before trk -->
+ <trk>
+  <trkseg>
+   <!-- before trkpt -->
+   <trkpt lat="40.0" lon="-73.9"><!-- in trkpt --><time>2021-09-14T10:00:00Z</time></trkpt>
+   <?device pause?>
+   <trkpt lat="40.0001" lon="-73.9"><time>2021-09-14T10:00:01Z</time></trkpt>
+  </trkseg>
+ </trk>
+</gpx>
+<!-- end -->
+'''
+    output = io.BytesIO()
+    assert inject_cadence(io.BytesIO(source), output, 48, 16) == 2
+    document = output.getvalue()
+    for node in (b'<!-- exported -->', b'<?xml-stylesheet href="ride.xsl"?>', b'<!-- before trk -->',
+                 b'<!-- before trkpt -->', b'<!-- in trkpt -->', b'<?device pause?>', b'<!-- end -->'):
+        assert document.count(node) == 1
+    assert document.index(b'<!-- before trkpt -->') < document.index(b'<trkpt') < \
+        document.index(b'<?device pause?>') < document.rindex(b'<trkpt')
+    assert len(etree.fromstring(document).findall('.//gpxtpx:cad', namespaces=NAMESPACES)) == 2
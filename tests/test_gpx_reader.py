@@ -0,0 +1,74 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+from flaskr.gpx import write_gpx
+from flaskr.gpx_reader import parse_time, read_gpx
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                           'clean', 'app', 'test-files', 'sort_gpx')
+
+
+def test_read_gpx():
+    streams, activity = read_gpx(os.path.join(FIXTURE_DIR, '20_mi_full_5.gpx'))
+    assert activity == {'name': 'Evening Ride', 'start_date': '2020-07-31T22:23:53Z'}
+    assert streams['latlng']['data'].shape == (150, 2)
+    assert streams['latlng']['data'][0].tolist() == [41.042837, -72.417157]
+    assert streams['time']['data'][:4].tolist() == [0, 2, 3, 4]
+    assert streams['altitude']['data'][:2].tolist() == [23.4, 19.8]
+    assert 'heartrate' not in streams and 'cadence' not in streams
+
+
+def test_read_gpx_heartrate():
+    streams, activity = read_gpx(os.path.join(FIXTURE_DIR, 'today.gpx'))
+    assert activity['name'] == 'Afternoon Ride'
+    assert streams['heartrate']['data'][:2].tolist() == [107, 107]
+    assert streams['heartrate']['original_size'] == 714
+
+
+def test_read_gpx_without_times():
+    streams, activity = read_gpx(os.path.join(FIXTURE_DIR, 'tdf.gpx'))
+    assert activity == {'name': 'tdf', 'start_date': '2020-09-19T23:46:18Z'}
+    size = streams['latlng']['original_size']
+    assert streams['time']['data'].tolist() == list(range(size))
+
+
+def test_read_gpx_with_some_times():
+    trkpts = ''.join(f'<trkpt lat="40.{ii}" lon="-73.9">{time}</trkpt>' for ii, time in enumerate(
+        ['<time>2021-09-14T10:28:25Z</time>', '', '<time>2021-09-14T10:28:35Z</time>']))
+    source = io.BytesIO(f'<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>{trkpts}</trkseg></trk></gpx>'.encode())
+    streams, activity = read_gpx(source)
+    # [0, 1, 10] would mix a point index into the times
+    assert streams['time']['data'].tolist() == [0, 1, 2]
+    assert activity['start_date'] == '2021-09-14T10:28:25Z'
+
+
+def test_read_gpx_round_trip():
+    size = 3
+    stream = {
+        'time': {'data': [0, 1, 86400], 'original_size': size},
+        'latlng': {'data': [[40.685516, -73.931366], [40.685524, -73.931297], [40.68553, -73.9312]], 'original_size': size},
+        'altitude': {'data': [20.2, 20.1, 19.8], 'original_size': size},
+        'heartrate': {'data': [105, 106, 107], 'original_size': size},
+        'cadence': {'data': [0, 88, 91], 'original_size': size},
+    }
+    activity = {'start_date': '2021-09-14T23:59:59Z', 'name': 'late & <windy> ride'}
+    output = io.BytesIO()
+    write_gpx(stream, activity, output)
+    output.seek(0)
+    streams, read_activity = read_gpx(output)
+    assert read_activity == activity
+    for key in stream:
+        assert np.array_equal(streams[key]['data'], stream[key]['data'])
+
+
+@pytest.mark.parametrize('text,expected', [
+    ('2020-07-31T22:23:53Z', 1596234233),
+    ('2020-07-31T22:23:53.750Z', 1596234233),
+    ('2020-07-31T23:23:53+01:00', 1596234233),
+    ('2020-07-31T22:23:53', 1596234233),
+])
+def test_parse_time(text, expected):
+    assert parse_time(text) == expected
@@ -0,0 +1,139 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import multiprocessing
+import os
+
+import pytest
+
+from flaskr import config, create_app, serve, subscriptions
+from flaskr.journal import JobJournal
+from flaskr.scheduler import DelayedScheduler
+
+
+@pytest.fixture
+def journal(tmp_path, clock):
+    return JobJournal(str(tmp_path / 'state.sqlite3'), max_attempts=3, backoff=10, max_backoff=15, clock=clock)
+
+
+def event(object_id: int) -> dict:
+    return {'object_type': 'activity', 'object_id': object_id, 'aspect_type': 'create', 'owner_id': 2}
+
+
+def test_append_burst(journal):
+    with ThreadPoolExecutor(16) as executor:
+        ids = list(executor.map(lambda ii: journal.append(event(ii)), range(200)))
+    assert len(set(ids)) == 200
+    jobs = journal.replay()
+    assert sorted(e['object_id'] for e, _ in jobs) == list(range(200))
+    assert {e['job_id']: e['object_id'] for e, _ in jobs} == dict(zip(ids, range(200)))
+
+
+def test_claim(journal):
+    job_id = journal.append(event(1))
+    assert journal.claim(job_id)
+    assert not journal.claim(job_id)
+    journal.release(job_id)
+    assert journal.claim(job_id)
+    journal.complete(job_id)
+    assert not journal.claim(job_id)
+    assert journal.replay() == []
+
+
+def test_retry_with_backoff_then_dead_letter(journal, clock):
+    job_id = journal.append(event(1))
+    journal.claim(job_id)
+    assert journal.fail(job_id, 'timeout') == clock.now + 10
+    journal.claim(job_id)
+    # capped at max_backoff
+    assert journal.fail(job_id, 'timeout') == clock.now + 15
+    journal.claim(job_id)
+    assert journal.fail(job_id, "LookupError('no token')") is None
+    assert journal.replay() == []
+    assert journal.dead_letters() == [({**event(1), 'job_id': job_id}, 3, "LookupError('no token')")]
+
+
+def test_supersede(journal):
+    first = {**event(1), 'job_id': journal.append(event(1))}
+    later = {**event(1), 'aspect_type': 'update', 'updates': {'title': 'Ride'}}
+    later['job_id'] = journal.append(later)
+    journal.supersede(first['job_id'], {**first, **later, 'aspect_type': 'create'})
+    assert [e for e, _ in journal.replay()] == [{**later, 'aspect_type': 'create'}]
+
+
+def claim_and_exit(path: str, job_id: int) -> None:
+    JobJournal(path).claim(job_id)
+
+
+def test_replay_jobs_of_dead_processes(journal):
+    orphaned, running = journal.append(event(1)), journal.append(event(2))
+    process = multiprocessing.get_context('fork').Process(target=claim_and_exit, args=(journal.path, orphaned))
+    process.start()
+    process.join()
+    assert not journal.claim(orphaned)
+    # claimed by this (living) process
+    assert journal.claim(running)
+    assert [e['job_id'] for e, _ in journal.replay()] == [orphaned]
+
+
+def test_restarted_process_with_same_pid(journal):
+    job_id = journal.append(event(1))
+    # claimed by an earlier process that had this process's pid, e.g. pid 1 of a restarted container
+    journal._connection().execute('UPDATE jobs SET status = ?, claimed_by = ? WHERE id = ?',
+                                  ('running', f'{os.getpid()}:earlier', job_id))
+    assert [e['job_id'] for e, _ in journal.replay()] == [job_id]
+
+
+def test_crashing_job_is_dead_lettered(journal, clock):
+    job_id = journal.append(event(1))
+    for attempt in range(3):
+        journal._connection().execute('UPDATE jobs SET status = ?, claimed_by = ? WHERE id = ?',
+                                      ('running', f'{os.getpid()}:crashed', job_id))
+        replayed = journal.replay()
+    # max_attempts is 3 - every crash counted as one
+    assert replayed == []
+    [(_, attempts, error)] = journal.dead_letters()
+    assert attempts == 3 and 'died' in error
+
+
+def test_failed_event_is_retried(journal, clock, monkeypatch):
+    scheduler = DelayedScheduler(clock=clock)
+    monkeypatch.setattr(subscriptions, 'JOURNAL', journal)
+    monkeypatch.setattr(subscriptions, 'get_scheduler', lambda: scheduler)
+    e = {**event(1), 'job_id': journal.append(event(1))}
+    journal.claim(e['job_id'])
+    job = Future()
+    job.set_exception(LookupError('Cannot find access token for athlete 2'))
+    subscriptions.finish_event(e, job)
+    assert len(scheduler) == 1
+    assert journal.replay()[0][1] == clock.now + 10
+    scheduler.shutdown()
+
+
+def test_replayed_at_server_startup_only(journal, clock, monkeypatch):
+    scheduler = DelayedScheduler(clock=clock)
+    monkeypatch.setattr(subscriptions, 'JOURNAL', journal)
+    monkeypatch.setattr(subscriptions, 'get_scheduler', lambda: scheduler)
+    journal.append(event(1), clock.now + 60)
+    # flask commands and tests create the app too
+    create_app({'TESTING': True})
+    assert len(scheduler) == 0
+    serve()
+    assert len(scheduler) == 1
+    scheduler.shutdown()
+
+
+def test_save(journal):
+    e = {**event(1), 'job_id': journal.append(event(1))}
+    e['checkpoint'] = {'job_key': 'abc'}
+    journal.save(e)
+    assert journal.replay()[0][0] == e
+
+
+def test_state_db_in_temp_dir_is_reported(monkeypatch, caplog):
+    monkeypatch.setattr(subscriptions, 'replay_jobs', lambda: 0)
+    serve()
+    # pytest's tmp_path is in the temp directory
+    assert 'CC_STATE_DB' in caplog.text
+    caplog.clear()
+    monkeypatch.setattr(config, 'STATE_DB', '/var/lib/cadence-calculator/state.sqlite3')
+    serve()
+    assert 'CC_STATE_DB' not in caplog.text
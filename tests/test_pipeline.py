@@ -0,0 +1,207 @@
+import json
+import multiprocessing
+import threading
+import time
+
+from flask import Flask
+import pytest
+
+from flaskr import subscriptions
+from flaskr.cache import ArtifactStore
+from flaskr.coalesce import EventCoalescer
+from flaskr.pipeline import BROWSER, CPU, IO, Pipeline
+from flaskr.scheduler import DelayedScheduler
+
+
+@pytest.fixture
+def pipeline():
+    pipeline = Pipeline(io_workers=2, cpu_workers=1, browser_workers=1, max_jobs=2)
+    yield pipeline
+    pipeline.shutdown()
+
+
+def stage(name: str):
+    def run(value):
+        return value + [(name, threading.current_thread().name.split('_')[0])]
+    run.__name__ = name
+    return run
+
+
+def build(value):
+    # CPU stages run in worker processes
+    return value + [('build', multiprocessing.current_process().name.split('-')[0])]
+
+
+def fail(value):
+    raise ValueError('bad event')
+
+
+def test_stages_run_in_order(pipeline):
+    stages = [(IO, stage('load')), (CPU, build), (BROWSER, stage('delete')), (IO, stage('upload'))]
+    job = pipeline.submit(stages, [])
+    assert job.result(timeout=30) == [('load', 'pipeline-io'), ('build', 'SpawnProcess'),
+                                     ('delete', 'pipeline-browser'), ('upload', 'pipeline-io')]
+
+
+def test_stage_ends_job_early(pipeline):
+    called = []
+    stages = [(IO, lambda value: None), (CPU, called.append)]
+    assert pipeline.submit(stages, 1).result(timeout=5) is None
+    assert not called
+
+
+def test_failed_stage(pipeline):
+    job = pipeline.submit([(IO, stage('load')), (CPU, fail)], [])
+    with pytest.raises(ValueError):
+        job.result(timeout=30)
+    assert pipeline.in_flight == 0
+
+
+def test_full_pipeline(pipeline):
+    release = threading.Event()
+    stages = [(IO, lambda value: release.wait(5) and value)]
+    jobs = [pipeline.submit(stages, ii) for ii in range(3)]
+    # max_jobs is 2 - the third is refused instead of queued
+    assert jobs[2] is None
+    assert pipeline.in_flight == 2
+    release.set()
+    assert [job.result(timeout=5) for job in jobs[:2]] == [0, 1]
+    assert pipeline.in_flight == 0
+    assert pipeline.submit(stages, 3).result(timeout=5) == 3
+
+
+def test_subscribe_when_full(monkeypatch):
+    scheduler = DelayedScheduler()
+    monkeypatch.setattr(subscriptions, 'EVENT_COALESCER', EventCoalescer(subscriptions.submit_event, 60, scheduler))
+    monkeypatch.setattr(subscriptions.config, 'EVENT_MAX_PENDING', 2)
+    app = Flask(__name__)
+    app.register_blueprint(subscriptions.bp)
+    client = app.test_client()
+    events = [{'object_type': 'activity', 'object_id': ii, 'aspect_type': 'create', 'owner_id': 2,
+               'event_time': time.time()} for ii in range(3)]
+    # events wait for Strava to settle before they're handled
+    assert [client.post('/subscribe', json=event).status_code for event in events] == [200, 200, 503]
+    assert len(scheduler) == 2
+    scheduler.shutdown()
+
+
+def test_settled_events_wait_for_room(pipeline, monkeypatch):
+    scheduler = DelayedScheduler()
+    release = threading.Event()
+    handled = []
+    monkeypatch.setattr(subscriptions, 'get_pipeline', lambda: pipeline)
+    monkeypatch.setattr(subscriptions, 'get_scheduler', lambda: scheduler)
+    monkeypatch.setattr(subscriptions, 'EVENT_COALESCER', EventCoalescer(subscriptions.submit_event, 60, scheduler))
+    monkeypatch.setattr(subscriptions.config, 'EVENT_SETTLE_DELAY', 0.01)
+    monkeypatch.setattr(subscriptions.config, 'EVENT_RETRY_DELAY', 0.01)
+    monkeypatch.setattr(subscriptions, 'EVENT_STAGES', [(IO, lambda event: release.wait(5) and handled.append(event))])
+    for ii in range(3):
+        assert subscriptions.schedule_event({'owner_id': 2, 'object_id': ii, 'event_time': time.time()})
+    time.sleep(0.1)
+    # max_jobs is 2 - the third event is offered again until there's room
+    assert pipeline.in_flight == 2 and not handled
+    release.set()
+    deadline = time.time() + 5
+    while len(handled) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert sorted(event['object_id'] for event in handled) == [0, 1, 2]
+    scheduler.shutdown()
+    # finished jobs leave the journal
+    journal = subscriptions.JOURNAL
+    deadline = time.time() + 5
+    while journal.replay() and time.time() < deadline:
+        time.sleep(0.01)
+    assert journal.replay() == []
+
+
+class Unfinished:
+    ''' An activity whose streams or upload fail '''
+    obj = {'id': 1}
+
+    def fetch_streams(self, filetype: str) -> bool:
+        return False
+
+    def upload_file(self, filetype: str, data: bytes) -> int:
+        return None
+
+
+@pytest.mark.parametrize('stages', [
+    [(IO, lambda event: Unfinished()), (IO, subscriptions.fetch_streams)],
+    [(IO, lambda event: (Unfinished(), b'<gpx/>')), (IO, subscriptions.upload_replacement)],
+])
+def test_failed_stage_is_retried(pipeline, stages, monkeypatch):
+    scheduler = DelayedScheduler()
+    monkeypatch.setattr(subscriptions, 'get_pipeline', lambda: pipeline)
+    monkeypatch.setattr(subscriptions, 'get_scheduler', lambda: scheduler)
+    monkeypatch.setattr(subscriptions, 'EVENT_STAGES', stages)
+    journal = subscriptions.JOURNAL
+    event = {'owner_id': 2, 'object_id': 1}
+    event['job_id'] = journal.append(event)
+    start = time.time()
+    subscriptions.submit_event(event)
+    deadline = time.time() + 5
+    while not len(scheduler) and time.time() < deadline:
+        time.sleep(0.01)
+    # the job is kept for a retry rather than completed
+    assert len(scheduler) == 1
+    [(replayed, available_at)] = journal.replay()
+    assert replayed['job_id'] == event['job_id'] and available_at > start
+    attempts, error = journal._connection().execute('SELECT attempts, last_error FROM jobs').fetchone()
+    assert attempts == 1 and 'StageFailed' in error
+    scheduler.shutdown()
+
+
+def test_handle_event_reports_failed_stage(monkeypatch):
+    monkeypatch.setattr(subscriptions, 'EVENT_STAGES', [(IO, lambda event: Unfinished()), (IO, subscriptions.fetch_streams)])
+    assert json.loads(subscriptions.handle_event({}))['status'] == 500
+    monkeypatch.setattr(subscriptions, 'EVENT_STAGES', [(IO, lambda event: None), (IO, subscriptions.fetch_streams)])
+    assert json.loads(subscriptions.handle_event({}))['status'] == 200
+
+
+class Deletable(Unfinished):
+    ''' An activity whose original deletes, but whose replacement fails to upload '''
+    obj = {'id': 1, 'description': '48x16'}
+
+    def delete_activity(self) -> bool:
+        return True
+
+    def artifact_job(self, filetype: str) -> str:
+        return 'job-key'
+
+
+def test_retry_resumes_after_delete(pipeline, tmp_path, monkeypatch):
+    scheduler = DelayedScheduler()
+    monkeypatch.setattr(subscriptions, 'get_pipeline', lambda: pipeline)
+    monkeypatch.setattr(subscriptions, 'get_scheduler', lambda: scheduler)
+    monkeypatch.setattr(subscriptions.config, 'ARTIFACT_DIR', str(tmp_path))
+    monkeypatch.setattr(subscriptions, 'create_db_conn', lambda: None)
+    monkeypatch.setattr(subscriptions, 'get_access_token', lambda supabase, owner_id: 'token')
+    uploaded = []
+    monkeypatch.setattr(subscriptions.Activity, 'upload_file', lambda self, filetype, data: uploaded.append(data) or 2)
+    ArtifactStore().put('job-key', 'digest', b'<gpx/>')
+
+    def load(event):
+        activity = Deletable()
+        activity.event = event
+        return activity, b'<gpx/>'
+
+    monkeypatch.setattr(subscriptions, 'EVENT_STAGES', [(IO, load), (BROWSER, subscriptions.delete_original),
+                                                        (IO, subscriptions.upload_replacement)])
+    journal = subscriptions.JOURNAL
+    event = {'object_type': 'activity', 'object_id': 1, 'aspect_type': 'create', 'owner_id': 2}
+    event['job_id'] = journal.append(event)
+    subscriptions.submit_event(event)
+    deadline = time.time() + 5
+    while not len(scheduler) and time.time() < deadline:
+        time.sleep(0.01)
+    # the original is gone - the journaled job picks up from the generated file
+    [(replayed, _)] = journal.replay()
+    assert replayed['checkpoint'] == {'activity': Deletable.obj, 'job_key': 'job-key'}
+    scheduler.shutdown()
+    subscriptions.submit_event(replayed)
+    deadline = time.time() + 5
+    # replay skips the running job - wait for it to leave the table
+    while journal._connection().execute('SELECT COUNT(*) FROM jobs').fetchone()[0] and time.time() < deadline:
+        time.sleep(0.01)
+    assert uploaded == [b'<gpx/>'] and journal.replay() == []
+    assert 2 in subscriptions.SEEN_ACTIVITIES
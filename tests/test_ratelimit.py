@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from flaskr import ratelimit
+from flaskr.ratelimit import DAILY, HIGH, LOW, SHORT, RateLimiter, RateLimitExceeded, background, parse_header
+from flaskr.strava import StravaClient
+
+
+@pytest.fixture
+def clock(clock, monkeypatch):
+    # 10 minutes into a 15 minute window, 2 hours into the day
+    clock.now = 1_700_006_400 + 2 * 3600 + 600
+    monkeypatch.setattr(ratelimit.time, 'sleep', clock.sleep)
+    return clock
+
+
+@pytest.fixture
+def limiter(tmp_path, clock):
+    limiter = RateLimiter(str(tmp_path / 'state.sqlite3'), background_share=0.5, max_wait=900, clock=clock)
+    limiter.update({'X-RateLimit-Limit': '4,10', 'X-RateLimit-Usage': '0,0'})
+    return limiter
+
+
+def usage(limiter: RateLimiter) -> dict:
+    return {window: row[1] for window, row in limiter._windows(limiter._connection(), limiter.clock()).items()}
+
+
+def test_parse_header():
+    assert parse_header('600,30000') == (600, 30000)
+    assert parse_header(None) is None
+    assert parse_header('600') is None
+
+
+def test_reserve(limiter):
+    assert [limiter.reserve() for _ in range(4)] == [0, 0, 0, 0]
+    assert usage(limiter) == {SHORT: 4, DAILY: 4}
+    # the 15 minute window ends in 5 minutes
+    assert limiter.reserve() == 300
+    assert usage(limiter) == {SHORT: 4, DAILY: 4}
+
+
+def test_priority(limiter):
+    assert limiter.reserve(LOW) == 0
+    assert limiter.reserve(LOW) == 0
+    # half of the window is kept for high priority calls
+    assert limiter.reserve(LOW) == 300
+    with background():
+        assert ratelimit.PRIORITY.get() == LOW
+        assert limiter.reserve() == 300
+    assert ratelimit.PRIORITY.get() == HIGH
+    assert limiter.reserve() == 0
+
+
+def test_shared_and_corrected_by_headers(limiter, tmp_path, clock):
+    other = RateLimiter(limiter.path, clock=clock)
+    assert other.reserve() == 0
+    limiter.update({'X-RateLimit-Limit': '4,10', 'X-RateLimit-Usage': '3,9'})
+    assert usage(other) == {SHORT: 3, DAILY: 9}
+    assert limiter.reserve() == 0
+    # the daily window is used up - it ends at midnight UTC
+    assert other.reserve() == 22 * 3600 - 600
+    with pytest.raises(RateLimitExceeded) as e:
+        other.wait()
+    assert e.value.retry_after == 22 * 3600 - 600
+
+
+def test_windows_start_over(limiter, clock):
+    limiter.update({'X-RateLimit-Limit': '4,10', 'X-RateLimit-Usage': '4,4'})
+    limiter.wait()
+    # slept until the next 15 minute window
+    assert clock.now % 900 == 0
+    assert usage(limiter) == {SHORT: 1, DAILY: 5}
+
+
+def test_429_without_headers(limiter):
+    limiter.update({}, 429)
+    assert limiter.reserve() == 300
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, usage: str) -> None:
+        self.status_code = status_code
+        self.headers = {'X-RateLimit-Limit': '4,10', 'X-RateLimit-Usage': usage}
+
+
+def test_client_waits_after_429(limiter, clock, monkeypatch):
+    responses = [FakeResponse(429, '4,4'), FakeResponse(200, '1,5'), FakeResponse(429, '4,6')]
+    sent = []
+
+    def fake_request(method, url, **kwargs):
+        sent.append((method, clock.now))
+        return responses.pop(0)
+
+    client = StravaClient('https://strava.test', limiter=limiter)
+    monkeypatch.setattr(client.session, 'request', fake_request)
+    start = clock.now
+    assert client.get('/activities/1').status_code == 200
+    assert sent == [('GET', start), ('GET', start + 300)]
+    # uploads aren't sent twice
+    assert client.post('/uploads').status_code == 429
+    assert len(sent) == 3
+
+
+def test_shared_between_threads(limiter):
+    with ThreadPoolExecutor(2) as executor:
+        assert list(executor.map(lambda _: limiter.reserve(), range(4))) == [0, 0, 0, 0]
+    assert usage(limiter) == {SHORT: 4, DAILY: 4}
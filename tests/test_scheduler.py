@@ -0,0 +1,59 @@
+import threading
+import time
+
+import pytest
+
+from flaskr.scheduler import DelayedScheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = DelayedScheduler()
+    yield scheduler
+    scheduler.shutdown()
+
+
+def wait_for(condition, timeout: float = 5) -> None:
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+
+
+def test_calls_run_in_due_order(scheduler):
+    calls = []
+    now = time.time()
+    scheduler.schedule(now + 0.06, calls.append, 'late')
+    scheduler.schedule(now + 0.03, calls.append, 'soon')
+    # due before what the timer thread is already waiting for
+    scheduler.schedule(now, calls.append, 'now')
+    assert len(scheduler) <= 3
+    wait_for(lambda: len(calls) == 3)
+    assert calls == ['now', 'soon', 'late']
+    assert len(scheduler) == 0
+
+
+def test_cancel(scheduler):
+    calls = []
+    entry = scheduler.schedule(time.time() + 0.02, calls.append, 'cancelled')
+    scheduler.schedule(time.time() + 0.04, calls.append, 'kept')
+    assert scheduler.cancel(entry)
+    assert not scheduler.cancel(entry)
+    assert len(scheduler) == 1
+    wait_for(lambda: calls)
+    assert calls == ['kept']
+
+
+def test_failed_call_keeps_timer_running(scheduler):
+    done = threading.Event()
+    scheduler.schedule(time.time(), lambda: 1 / 0)
+    scheduler.schedule(time.time(), done.set)
+    assert done.wait(5)
+
+
+def test_shutdown(scheduler):
+    calls = []
+    scheduler.schedule(time.time() + 60, calls.append, 'never')
+    scheduler.shutdown()
+    assert not calls
+    with pytest.raises(RuntimeError):
+        scheduler.schedule(time.time(), calls.append, 'too late')
@@ -0,0 +1,83 @@
+import asyncio
+import multiprocessing
+
+import httpx
+
+from flaskr import config, strava
+from flaskr.ratelimit import HIGH, LOW, PRIORITY, background
+from flaskr.strava import AsyncRunner, AsyncStravaClient, StravaClient, get_client
+
+
+def test_request(monkeypatch):
+    sent = []
+    client = StravaClient('https://strava.test/api/v3', timeout=(1, 2))
+    monkeypatch.setattr(client.session, 'request', lambda method, url, **kwargs: sent.append((method, url, kwargs)))
+    client.get('/activities/1', 'token', params={'include_all_efforts': 'false'})
+    client.post('https://strava.test/oauth/token', data={'grant_type': 'refresh_token'}, timeout=10)
+    client.delete('/push_subscriptions/2')
+    assert sent == [
+        ('GET', 'https://strava.test/api/v3/activities/1',
+         {'headers': {'Authorization': 'Bearer token'}, 'params': {'include_all_efforts': 'false'}, 'timeout': (1, 2)}),
+        ('POST', 'https://strava.test/oauth/token',
+         {'headers': {}, 'data': {'grant_type': 'refresh_token'}, 'timeout': 10}),
+        ('DELETE', 'https://strava.test/api/v3/push_subscriptions/2', {'headers': {}, 'timeout': (1, 2)}),
+    ]
+
+
+def test_client_defaults():
+    client = StravaClient()
+    assert client.base_url == config.API_ENDPOINT
+    assert client.timeout == (config.STRAVA_CONNECT_TIMEOUT, config.STRAVA_READ_TIMEOUT)
+    assert client.session.get_adapter(config.API_ENDPOINT)._pool_maxsize == config.STRAVA_POOL_SIZE
+
+
+def child_client_is(queue, parent_client) -> None:
+    queue.put(get_client() is parent_client)
+
+
+def test_get_client_per_process(monkeypatch):
+    monkeypatch.setattr(strava, '_clients', {})
+    client = get_client()
+    assert get_client() is client
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=child_client_is, args=(queue, client))
+    process.start()
+    shared = queue.get(timeout=10)
+    process.join()
+    # the forked child builds its own pool instead of reusing the parent's sockets
+    assert not shared
+    assert get_client() is client
+
+
+def test_async_request():
+    sent = []
+
+    def handler(request):
+        sent.append((request.method, str(request.url), request.headers.get('Authorization')))
+        return httpx.Response(200, json={'id': 1})
+
+    async def main():
+        async with AsyncStravaClient('https://strava.test/api/v3', timeout=(1, 2),
+                                     transport=httpx.MockTransport(handler)) as client:
+            assert client.client.timeout == httpx.Timeout(2, connect=1)
+            responses = await asyncio.gather(
+                client.get('/activities/1', 'token'), client.post('https://strava.test/oauth/token'))
+            return [response.json() for response in responses]
+
+    assert asyncio.run(main()) == [{'id': 1}, {'id': 1}]
+    assert sent == [('GET', 'https://strava.test/api/v3/activities/1', 'Bearer token'),
+                    ('POST', 'https://strava.test/oauth/token', None)]
+
+
+def test_runner_keeps_priority():
+    runner = AsyncRunner(AsyncStravaClient('https://strava.test', transport=httpx.MockTransport(lambda request: None)))
+
+    async def priority():
+        return PRIORITY.get()
+
+    assert runner.run(priority()) == HIGH
+    with background():
+        assert runner.run(priority()) == LOW
+    runner.close()
+    assert runner.loop.is_closed()